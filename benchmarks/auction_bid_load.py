@@ -0,0 +1,109 @@
+"""
+Fires bursts of concurrent bids at a single auction through
+Mongo.place_auction_bid, with and without the Redis bid queue. It checks that
+the highest accepted bid wins and that only the winner's coins are held, and
+reports how long the bursts took.
+
+Transactions need MongoDB running as a replica set. Runs against a scratch
+database, by default mongodb://localhost:27017/poketwo_benchmark, and Redis
+at redis://localhost.
+"""
+
+import asyncio
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import aioredis
+from motor.motor_asyncio import AsyncIOMotorClient
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from cogs.mongo import BidFailed, Mongo
+
+NUM_BIDDERS = int(os.getenv("BENCHMARK_NUM_BIDDERS", 50))
+NUM_ROUNDS = int(os.getenv("BENCHMARK_NUM_ROUNDS", 5))
+BALANCE = 1_000_000
+HOST_ID = 1
+AUCTION_ID = 1
+
+
+async def setup(db):
+    await db.member.delete_many({})
+    await db.pokemon.delete_many({})
+
+    await db.member.insert_one({"_id": HOST_ID, "balance": 0})
+    await db.member.insert_many([{"_id": 100 + i, "balance": BALANCE} for i in range(NUM_BIDDERS)])
+    await db.pokemon.insert_one(
+        {
+            "owner_id": HOST_ID,
+            "owned_by": "auction",
+            "species_id": 1,
+            "auction_data": {
+                "_id": AUCTION_ID,
+                "guild_id": 1,
+                "current_bid": 0,
+                "bid_increment": 10,
+                "bidder_id": None,
+                "ends": datetime.utcnow() + timedelta(hours=1),
+            },
+        }
+    )
+
+
+async def run(mongo, *, queue):
+    await setup(mongo.db)
+    accepted = []
+    failures = {}
+
+    async def bid(bidder_id, amount):
+        try:
+            await Mongo.place_auction_bid(mongo, AUCTION_ID, bidder_id, amount, queue=queue)
+        except BidFailed as e:
+            failures[e.message_id] = failures.get(e.message_id, 0) + 1
+        else:
+            accepted.append((amount, bidder_id))
+
+    start = time.perf_counter()
+    for i in range(NUM_ROUNDS):
+        base = i * NUM_BIDDERS * 10
+        bids = [bid(100 + j, base + random.randint(1, NUM_BIDDERS) * 10) for j in range(NUM_BIDDERS)]
+        await asyncio.gather(*bids)
+    elapsed = time.perf_counter() - start
+
+    auction = await mongo.db.pokemon.find_one({"auction_data._id": AUCTION_ID})
+    winning_bid, winner = max(accepted)
+    assert auction["auction_data"]["current_bid"] == winning_bid
+    assert auction["auction_data"]["bidder_id"] == winner
+
+    # Every outbid bidder was refunded, so only the winning bid is held.
+    async for member in mongo.db.member.find({"_id": {"$ne": HOST_ID}}):
+        expected = BALANCE - winning_bid if member["_id"] == winner else BALANCE
+        assert member["balance"] == expected, member
+
+    print(
+        f"queue={str(queue):<5}  {NUM_ROUNDS}x{NUM_BIDDERS} bids in {elapsed * 1000:>6.0f} ms, "
+        f"{len(accepted)} accepted, rejected: {failures}"
+    )
+
+
+async def main():
+    client = AsyncIOMotorClient(os.getenv("BENCHMARK_DATABASE_URI", "mongodb://localhost:27017"))
+    db = client[os.getenv("BENCHMARK_DATABASE_NAME", "poketwo_benchmark")]
+    redis = await aioredis.create_redis_pool(os.getenv("BENCHMARK_REDIS_URI", "redis://localhost"))
+    mongo = SimpleNamespace(client=client, db=db, bot=SimpleNamespace(redis=redis))
+    mongo.place_auction_bid = lambda *args, **kwargs: Mongo.place_auction_bid(mongo, *args, **kwargs)
+
+    await run(mongo, queue=False)
+    await run(mongo, queue=True)
+    print("balances reconcile")
+
+    redis.close()
+    await redis.wait_closed()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,205 @@
+"""
+Runs battles headless through the battle engine (helpers.battle) across a
+process pool, and checks after every turn that no pokémon's HP is out of
+bounds, that inflicted ailments were applied, and that actions were carried
+out in priority order. Reports how many turns per second were resolved.
+
+Battles use random teams and random actions. Set BENCHMARK_RECORD to a path
+to save them as JSON lines, and BENCHMARK_REPLAY to replay saved battles
+instead, with the same results.
+
+Needs the game data in data/.
+"""
+
+import json
+import os
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import data
+from helpers.battle import BattleEngine, Battler, Side
+
+NUM_BATTLES = int(os.getenv("BENCHMARK_NUM_BATTLES", 10_000))
+NUM_WORKERS = int(os.getenv("BENCHMARK_NUM_WORKERS", os.cpu_count()))
+RECORD = os.getenv("BENCHMARK_RECORD")
+REPLAY = os.getenv("BENCHMARK_REPLAY")
+
+BATCH_SIZE = 100
+TEAM_SIZE = 3
+MAX_TURNS = 200
+PASS_CHANCE = 0.02
+FLEE_CHANCE = 0.002
+STATS = ("atk", "defn", "satk", "sdef", "spd")
+
+game_data = None
+species_pool = None
+
+
+def init_worker():
+    global game_data, species_pool
+    game_data = data.DataManager(None)
+    species_pool = [x for x in game_data.all_pokemon() if x.catchable]
+
+
+def random_team(rng):
+    team = []
+    for _ in range(TEAM_SIZE):
+        species = rng.choice(species_pool)
+        level = rng.randint(1, 100)
+        learnable = sorted({x.move.id for x in species.moves if level >= x.method.level})
+        team.append(
+            {
+                "species_id": species.id,
+                "level": level,
+                "moves": rng.sample(learnable, min(4, len(learnable))),
+                "ivs": [rng.randint(0, 31) for _ in range(6)],
+            }
+        )
+    return team
+
+
+def make_battler(spec):
+    species = game_data.species_by_number(spec["species_id"])
+    level = spec["level"]
+    iv_hp, *ivs = spec["ivs"]
+
+    if species.id == 292:
+        max_hp = 1
+    else:
+        max_hp = (2 * species.base_stats.hp + iv_hp + 5) * level // 100 + level + 10
+
+    # Neutral nature, so no multipliers.
+    stats = [(2 * getattr(species.base_stats, stat) + iv + 5) * level // 100 + 5 for stat, iv in zip(STATS, ivs)]
+    return Battler(species, level, spec["moves"], max_hp, *stats)
+
+
+def random_action(rng, side):
+    if rng.random() < FLEE_CHANCE:
+        return {"type": "flee"}
+
+    options = [{"type": "move", "value": x} for x in side.selected.moves]
+    options += [
+        {"type": "switch", "value": idx} for idx, x in enumerate(side.pokemon) if x is not side.selected and x.hp > 0
+    ]
+    if len(options) == 0 or rng.random() < PASS_CHANCE:
+        return {"type": "pass"}
+    return rng.choice(options)
+
+
+def check_turn(engine, steps):
+    violations = []
+
+    for side in engine.sides:
+        for battler in side.pokemon:
+            if not 0 <= battler.hp <= battler.max_hp:
+                violations.append(f"hp out of bounds: {battler.hp}/{battler.max_hp}")
+
+    priorities = [x.priority for x in steps]
+    if priorities != sorted(priorities, reverse=True):
+        violations.append(f"steps out of priority order: {priorities}")
+
+    for step in steps:
+        if step.kind == "move" and step.result.success and step.result.ailment:
+            if step.result.ailment not in step.target.ailments:
+                violations.append(f"{step.result.ailment} from {step.move.name} not applied")
+
+    return violations
+
+
+def play(battle, rng):
+    """Plays out a battle, with its recorded actions if it has any, or random
+    ones that get recorded. Returns how many turns it took, and any invariants
+    that didn't hold.
+    """
+
+    # Moves roll their own damage and effects, so this makes replays match.
+    random.seed(battle["seed"])
+
+    sides = [Side([make_battler(x) for x in team]) for team in battle["teams"]]
+    engine = BattleEngine(sides)
+    recorded = battle.setdefault("actions", [])
+    replaying = len(recorded) > 0
+    violations = []
+    turns = 0
+
+    while not engine.over and turns < MAX_TURNS:
+        if replaying:
+            if turns >= len(recorded):
+                break
+            actions = recorded[turns]
+        else:
+            actions = [random_action(rng, side) for side in sides]
+            recorded.append(actions)
+
+        steps = engine.resolve_turn(
+            [dict(x, value=game_data.move_by_number(x["value"])) if x["type"] == "move" else x for x in actions]
+        )
+        violations += [f"battle {battle['seed']} turn {turns}: {x}" for x in check_turn(engine, steps)]
+        turns += 1
+
+    return turns, violations
+
+
+def run_batch(battles):
+    turns = 0
+    violations = []
+    start = time.perf_counter()
+
+    for battle in battles:
+        if "teams" not in battle:
+            rng = random.Random(battle["seed"])
+            battle["teams"] = [random_team(rng), random_team(rng)]
+        else:
+            rng = None
+        n, v = play(battle, rng)
+        turns += n
+        violations += v
+
+    return turns, violations, time.perf_counter() - start, battles if RECORD else None
+
+
+def main():
+    if REPLAY:
+        with open(REPLAY) as f:
+            battles = [json.loads(line) for line in f]
+    else:
+        battles = [{"seed": i} for i in range(NUM_BATTLES)]
+
+    batches = [battles[i : i + BATCH_SIZE] for i in range(0, len(battles), BATCH_SIZE)]
+
+    total_turns = 0
+    engine_time = 0
+    violations = []
+    recorded = []
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(NUM_WORKERS, initializer=init_worker) as pool:
+        for turns, v, elapsed, battles in pool.map(run_batch, batches):
+            total_turns += turns
+            engine_time += elapsed
+            violations += v
+            recorded += battles or []
+    elapsed = time.perf_counter() - start
+
+    print(f"{sum(len(x) for x in batches)} battles, {total_turns} turns on {NUM_WORKERS} workers")
+    print(f"wall clock:  {elapsed:.2f} s, {total_turns / elapsed:,.0f} turns/s (including loading game data)")
+    print(f"per worker:  {total_turns / engine_time:,.0f} turns/s")
+
+    if RECORD:
+        with open(RECORD, "w") as f:
+            for battle in recorded:
+                f.write(json.dumps(battle) + "\n")
+        print(f"recorded to {RECORD}")
+
+    for violation in violations[:20]:
+        print(violation)
+    assert len(violations) == 0, f"{len(violations)} invariant violations"
+    print("invariants hold")
+
+
+if __name__ == "__main__":
+    main()
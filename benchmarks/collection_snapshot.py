@@ -0,0 +1,114 @@
+"""
+Compares the aggregation path and the columnar snapshot path (helpers.snapshot)
+for filtering and sorting a synthetic 500k-pokémon collection.
+
+Runs against a scratch database, by default mongodb://localhost:27017/poketwo_benchmark.
+"""
+
+import os
+import random
+import sys
+import time
+
+from pymongo import ASCENDING, MongoClient
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from helpers import snapshot
+
+NUM_POKEMON = int(os.getenv("BENCHMARK_NUM_POKEMON", 500_000))
+OWNER_ID = 1
+
+client = MongoClient(os.getenv("BENCHMARK_DATABASE_URI", "mongodb://localhost:27017"))
+db = client[os.getenv("BENCHMARK_DATABASE_NAME", "poketwo_benchmark")]
+
+PIPELINES = {
+    "order by number": [{"$sort": {"idx": 1}}],
+    "--legendary, order by iv": [
+        {"$match": {"species_id": {"$in": list(range(144, 152))}}},
+        {"$sort": {"iv_total": -1}},
+    ],
+    "--shiny --level >50": [
+        {"$match": {"shiny": True}},
+        {"$match": {"level": {"$gt": 50}}},
+        {"$sort": {"idx": 1}},
+    ],
+    "--triple 31, order by level": [
+        {"$match": {"$or": [{"iv_hp": 31, "iv_atk": 31, "iv_defn": 31}, {"iv_satk": 31, "iv_sdef": 31, "iv_spd": 31}]}},
+        {"$sort": {"level": -1}},
+    ],
+}
+
+
+def populate():
+    db.pokemon.drop()
+    db.pokemon.create_index([("owner_id", ASCENDING), ("owned_by", ASCENDING), ("idx", ASCENDING)])
+
+    batch = []
+    for i in range(1, NUM_POKEMON + 1):
+        ivs = [random.randint(0, 31) for _ in range(6)]
+        batch.append(
+            {
+                "owner_id": OWNER_ID,
+                "owned_by": "user",
+                "idx": i,
+                "species_id": random.randint(1, 905),
+                "level": random.randint(1, 100),
+                "xp": 0,
+                "nature": "Hardy",
+                "iv_hp": ivs[0],
+                "iv_atk": ivs[1],
+                "iv_defn": ivs[2],
+                "iv_satk": ivs[3],
+                "iv_sdef": ivs[4],
+                "iv_spd": ivs[5],
+                "iv_total": sum(ivs),
+                "shiny": random.randint(1, 4096) == 1,
+                "favorite": random.random() < 0.01,
+                "moves": [],
+            }
+        )
+        if len(batch) >= 10_000:
+            db.pokemon.insert_many(batch)
+            batch = []
+    if batch:
+        db.pokemon.insert_many(batch)
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def first_page_aggregation(pipeline):
+    full = [{"$match": {"owner_id": OWNER_ID, "owned_by": "user"}}, *pipeline]
+    count = list(db.pokemon.aggregate([*full, {"$count": "num_matches"}], allowDiskUse=True))
+    page = list(db.pokemon.aggregate([*full, {"$limit": 20}], allowDiskUse=True))
+    return count, page
+
+
+def first_page_snapshot(collection, pipeline):
+    rows = collection.evaluate(pipeline)
+    ids = collection.object_ids(rows[:20])
+    page = list(db.pokemon.find({"_id": {"$in": ids}}))
+    return len(rows), page
+
+
+if __name__ == "__main__":
+    if db.pokemon.estimated_document_count() != NUM_POKEMON:
+        print(f"Populating {NUM_POKEMON} pokémon...")
+        populate()
+
+    documents, elapsed = timed(
+        lambda: list(db.pokemon.find({"owner_id": OWNER_ID, "owned_by": "user"}, snapshot.PROJECTION))
+    )
+    print(f"snapshot fetch: {elapsed * 1000:.0f} ms")
+    collection, elapsed = timed(lambda: snapshot.CollectionSnapshot.from_documents(0, documents))
+    print(f"snapshot build: {elapsed * 1000:.0f} ms, {collection.nbytes / 1024 / 1024:.1f} MiB")
+    print()
+
+    for name, pipeline in PIPELINES.items():
+        _, aggregation = timed(lambda: first_page_aggregation(pipeline))
+        _, columnar = timed(lambda: first_page_snapshot(collection, pipeline))
+        print(f"{name:<32} aggregation {aggregation * 1000:>8.1f} ms    snapshot {columnar * 1000:>8.1f} ms")
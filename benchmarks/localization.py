@@ -0,0 +1,124 @@
+"""
+Measures how many ctx._ and localized_embed calls per second the Lang cog's
+compiled formatters manage, against formatting through the Fluent resolver on
+every call like before. Also measures ctx._ as commands call it, looking up the
+user's locale in the Lang cog's locale pool.
+
+Uses the en-US files in lang/.
+"""
+
+import asyncio
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import structlog
+from fluent.runtime import FluentResourceLoader
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from bot import ClusterBot
+from cogs.lang import FLUENT_FILES, Fluent, Lang
+
+NUM_CALLS = int(os.getenv("BENCHMARK_NUM_CALLS", 100_000))
+
+MESSAGES = {
+    "no variables": ("trade-none", {}),
+    "variables": ("trade-completed", {"a": "Ash", "b": "Misty"}),
+    "number": ("profile-caught-category-total", {"amount": 1234}),
+    "select": ("cleanup", {"count": 3}),
+    "function": ("auctions-not-set-up", {}),
+}
+
+EMBEDS = {
+    "passthrough only": ("battle-selection-embed", {}),
+    "fields, ordered": (
+        "market-stats-embed",
+        {
+            "field_ordering": ["prices", "volume", "recent"],
+            "pokemon": "Pikachu",
+            "count": 100,
+            "median": 1000,
+            "low": 800,
+            "high": 1500,
+            "today": 3,
+            "week": 20,
+            "month": 100,
+            "recent": "1,000 pc",
+        },
+    ),
+}
+
+
+def format_uncompiled(fluent, msg_id, args):
+    # What Fluent.format_value did before messages were compiled.
+    base_msg_id = msg_id
+    attribute_name = None
+    if "." in msg_id:
+        base_msg_id, attribute_name = msg_id.split(".")
+
+    for bundle in fluent._bundles():
+        if not bundle.has_message(base_msg_id):
+            continue
+        msg = bundle.get_message(base_msg_id)
+        value = msg.value
+        if attribute_name is not None:
+            value = msg.attributes[attribute_name]
+        if not value:
+            continue
+        val, errors = bundle.format_pattern(value, args)
+        if errors:
+            continue
+        return val
+    return msg_id
+
+
+def rate(func):
+    start = time.perf_counter()
+    for _ in range(NUM_CALLS):
+        func()
+    return NUM_CALLS / (time.perf_counter() - start)
+
+
+def main():
+    start = time.perf_counter()
+    fluent = Fluent(
+        ["en-US"],
+        list(FLUENT_FILES),
+        FluentResourceLoader(os.path.join(os.path.dirname(__file__), "..", "lang", "{locale}")),
+        functions={"COMMAND": lambda command: f"`@Pokétwo {command}`"},
+    )
+    print(f"load and compile: {(time.perf_counter() - start) * 1000:.0f} ms")
+    print()
+
+    for name, (msg_id, args) in MESSAGES.items():
+        assert fluent.format_value(msg_id, args) == format_uncompiled(fluent, msg_id, args)
+        compiled = rate(lambda: fluent.format_value(msg_id, args))
+        uncompiled = rate(lambda: format_uncompiled(fluent, msg_id, args))
+        print(f"ctx._ {name:<24} compiled {compiled:>12,.0f}/s    resolver {uncompiled:>12,.0f}/s")
+
+    lang_root = os.path.join(os.path.dirname(__file__), "..", "lang", "{locale}")
+    lang = Lang(SimpleNamespace(config=SimpleNamespace(LANG_ROOT=lang_root), loop=asyncio.new_event_loop()))
+    lang.bot.loop.run_until_complete(lang.cog_load())
+    msg_id, args = MESSAGES["variables"]
+
+    def format_in_context():
+        with lang.localize("en-US", "p!"):
+            return lang.fluent.format_value(msg_id, args)
+
+    print(f"ctx._ {'variables, via pool':<24} {rate(format_in_context):>21,.0f}/s")
+    print()
+
+    bot = SimpleNamespace(lang=fluent, log=structlog.get_logger())
+    bot._ = lambda message_id, **kwargs: fluent.format_value(message_id, kwargs)
+
+    for name, (msg_id, kwargs) in EMBEDS.items():
+        embed = ClusterBot.localized_embed(bot, msg_id, **kwargs)
+        assert embed.title != fluent.format_value("localization-error"), msg_id
+        embeds = rate(lambda: ClusterBot.localized_embed(bot, msg_id, **kwargs))
+        print(f"localized_embed {name:<18} {embeds:>12,.0f}/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Measures how long a log call takes on the thread that makes it (the event loop,
+in the bot) with the queued logging pipeline in helpers.logs, against rendering
+and writing each event right away like before. Events are written to /dev/null.
+
+Also measures creating a command context's logger, which used to bind a dozen
+fields for every message, command or not.
+"""
+
+import logging
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import structlog
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from helpers import logs
+
+NUM_EVENTS = int(os.getenv("BENCHMARK_NUM_EVENTS", 50_000))
+
+
+def configure(processors, renderer):
+    structlog.reset_defaults()
+    structlog.configure(
+        processors=[*processors, structlog.stdlib.ProcessorFormatter.wrap_for_formatter],
+        logger_factory=structlog.stdlib.LoggerFactory(),
+        cache_logger_on_first_use=True,
+    )
+    return structlog.stdlib.ProcessorFormatter(
+        processors=[structlog.stdlib.ProcessorFormatter.remove_processors_meta, renderer]
+    )
+
+
+def context_fields(ctx):
+    return {
+        "guild": ctx.guild.name,
+        "guild_id": ctx.guild.id,
+        "channel": ctx.channel.name,
+        "channel_id": ctx.channel.id,
+        "user_id": ctx.author.id,
+        "user": str(ctx.author),
+        "message": ctx.message.content,
+        "message_id": ctx.message.id,
+        "command": ctx.command,
+        "command_args": [],
+        "command_kwargs": {},
+    }
+
+
+def rate(func):
+    start = time.perf_counter()
+    for i in range(NUM_EVENTS):
+        func(i)
+    return NUM_EVENTS / (time.perf_counter() - start)
+
+
+def main():
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    devnull = open(os.devnull, "w")
+
+    ctx = SimpleNamespace(
+        guild=SimpleNamespace(name="Pokétwo", id=716390832034414685),
+        channel=SimpleNamespace(name="general", id=716390832034414688),
+        author=SimpleNamespace(id=398686833153933313, __str__=lambda: "oliver#0001"),
+        message=SimpleNamespace(content="p!catch pikachu", id=1110000000000000000),
+        command="catch",
+    )
+    ctx.log_fields = lambda: context_fields(ctx)
+
+    # Before: rendered and written on the calling thread, fields bound eagerly.
+    formatter = configure([structlog.stdlib.add_log_level], structlog.processors.JSONRenderer())
+    handler = logging.StreamHandler(devnull)
+    handler.setFormatter(formatter)
+    root.addHandler(handler)
+    log = structlog.get_logger()
+
+    before_bind = rate(lambda i: log.bind(**context_fields(ctx)))
+    before_event = rate(lambda i: log.bind(**context_fields(ctx)).info("pokemon_spawned", i=i))
+    root.removeHandler(handler)
+
+    # After: queued for the writer thread, fields added only for logged events.
+    sampler = logs.Sampler()
+    formatter = configure(
+        [structlog.stdlib.filter_by_level, sampler, logs.add_context_fields, structlog.stdlib.add_log_level],
+        structlog.processors.JSONRenderer(serializer=logs.dumps),
+    )
+    # Unbounded, so no events are dropped when the writer falls behind.
+    writer = logs.start_writer(formatter, queue_size=0)
+    writer.handlers[0].setStream(devnull)
+    log = structlog.get_logger()
+
+    after_bind = rate(lambda i: log.bind(_ctx=ctx))
+    after_event = rate(lambda i: log.bind(_ctx=ctx).info("pokemon_spawned", i=i))
+    sampler.rates["pokemon_spawned"] = 0.1
+    after_sampled = rate(lambda i: log.bind(_ctx=ctx).info("pokemon_spawned", i=i))
+
+    start = time.perf_counter()
+    writer.stop()
+    drained = time.perf_counter() - start
+
+    print(f"orjson: {'yes' if logs.orjson is not None else 'no'}")
+    print(f"context logger           before {before_bind:>10,.0f}/s    after {after_bind:>10,.0f}/s")
+    print(f"event, with context      before {before_event:>10,.0f}/s    after {after_event:>10,.0f}/s")
+    print(f"event, sampled at 10%                          after {after_sampled:>10,.0f}/s")
+    print(f"writer caught up {drained * 1000:.0f} ms after the last event")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Fires many simultaneous buyers at a single market listing through
+Mongo.purchase_listing, and checks that exactly one of them wins and that no
+coins are created or lost.
+
+Transactions need MongoDB running as a replica set. Runs against a scratch
+database, by default mongodb://localhost:27017/poketwo_benchmark.
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+import structlog
+from motor.motor_asyncio import AsyncIOMotorClient
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from cogs.mongo import Mongo, PurchaseFailed
+from helpers.audit_log import AuditLog
+
+NUM_BUYERS = int(os.getenv("BENCHMARK_NUM_BUYERS", 50))
+PRICE = 1000
+SELLER_ID = 1
+LISTING_ID = 1
+
+
+async def setup(db):
+    await db.member.delete_many({})
+    await db.pokemon.delete_many({})
+    await db.logs.delete_many({})
+
+    await db.member.insert_one({"_id": SELLER_ID, "balance": 0, "next_idx": 1})
+    await db.member.insert_many(
+        # Every other buyer can't afford it.
+        [{"_id": 100 + i, "balance": PRICE if i % 2 == 0 else PRICE - 1, "next_idx": 1} for i in range(NUM_BUYERS)]
+    )
+    await db.pokemon.insert_one(
+        {
+            "owner_id": SELLER_ID,
+            "owned_by": "market",
+            "species_id": 1,
+            "market_data": {"_id": LISTING_ID, "price": PRICE},
+        }
+    )
+
+
+async def total_balance(db):
+    result = await db.member.aggregate([{"$group": {"_id": None, "total": {"$sum": "$balance"}}}]).to_list(None)
+    return result[0]["total"]
+
+
+async def main():
+    client = AsyncIOMotorClient(os.getenv("BENCHMARK_DATABASE_URI", "mongodb://localhost:27017"))
+    db = client[os.getenv("BENCHMARK_DATABASE_NAME", "poketwo_benchmark")]
+    spill_path = os.path.join(tempfile.mkdtemp(), "audit_log.bson")
+    mongo = SimpleNamespace(client=client, db=db, audit_log=AuditLog(db.logs, spill_path, log=structlog.get_logger()))
+
+    await setup(db)
+    before = await total_balance(db)
+
+    async def buy(buyer_id):
+        try:
+            await Mongo.purchase_listing(mongo, buyer_id, LISTING_ID, PRICE)
+        except PurchaseFailed as e:
+            return str(e)
+        return "bought"
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(buy(100 + i) for i in range(NUM_BUYERS)))
+    elapsed = time.perf_counter() - start
+
+    winners = [100 + i for i, x in enumerate(results) if x == "bought"]
+    print(f"{NUM_BUYERS} buyers in {elapsed * 1000:.0f} ms: {results.count('bought')} bought, ", end="")
+    print(f"{results.count('listing-no-longer-exists')} too late, {results.count('not-enough-coins')} too poor")
+
+    assert len(winners) == 1, winners
+    (winner,) = winners
+
+    pokemon = await db.pokemon.find_one({"species_id": 1})
+    assert pokemon["owner_id"] == winner and pokemon["owned_by"] == "user" and "market_data" not in pokemon
+
+    seller = await db.member.find_one({"_id": SELLER_ID})
+    buyer = await db.member.find_one({"_id": winner})
+    assert seller["balance"] == PRICE
+    assert buyer["balance"] == 0 and buyer["next_idx"] == 2
+    assert await db.member.count_documents({"_id": {"$ne": winner}, "next_idx": {"$ne": 1}}) == 0
+    assert await total_balance(db) == before
+
+    # The purchase is logged once the transaction commits, through the buffer.
+    await mongo.audit_log.flush()
+    assert await db.logs.count_documents({"event": "market"}) == 1
+
+    print("balances reconcile")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,115 @@
+"""
+Compares the old client-side reindex loop with the server-side
+$setWindowFields/$merge reindex (Mongo.reindex_pokemon) on a synthetic
+collection of 1M pokémon with gaps in their numbering, and checks that both
+produce the same numbering.
+
+Needs MongoDB 5.0 or newer. Runs against a scratch database, by default
+mongodb://localhost:27017/poketwo_benchmark.
+"""
+
+import os
+import random
+import time
+
+from pymongo import ASCENDING, MongoClient, UpdateOne
+
+NUM_POKEMON = int(os.getenv("BENCHMARK_NUM_POKEMON", 1_000_000))
+OWNER_ID = 1
+
+client = MongoClient(os.getenv("BENCHMARK_DATABASE_URI", "mongodb://localhost:27017"))
+db = client[os.getenv("BENCHMARK_DATABASE_NAME", "poketwo_benchmark")]
+
+
+def populate():
+    db.pokemon.drop()
+    db.pokemon.create_index([("owner_id", ASCENDING), ("owned_by", ASCENDING), ("idx", ASCENDING)])
+
+    # Leave gaps, like releasing pokémon does.
+    indices = random.sample(range(1, NUM_POKEMON * 2), NUM_POKEMON)
+
+    batch = []
+    for idx in indices:
+        batch.append(
+            {
+                "owner_id": OWNER_ID,
+                "owned_by": "user",
+                "idx": idx,
+                "species_id": random.randint(1, 905),
+                "level": random.randint(1, 100),
+            }
+        )
+        if len(batch) >= 10_000:
+            db.pokemon.insert_many(batch)
+            batch = []
+    if batch:
+        db.pokemon.insert_many(batch)
+
+    db.member.replace_one({"_id": OWNER_ID}, {"_id": OWNER_ID, "next_idx": NUM_POKEMON * 2}, upsert=True)
+
+
+def snapshot_indices():
+    return {x["_id"]: x["idx"] for x in db.pokemon.find({"owner_id": OWNER_ID}, {"idx": 1})}
+
+
+def restore_indices(indices):
+    ops = [UpdateOne({"_id": k}, {"$set": {"idx": v}}) for k, v in indices.items()]
+    for i in range(0, len(ops), 10_000):
+        db.pokemon.bulk_write(ops[i : i + 10_000], ordered=False)
+    db.member.update_one({"_id": OWNER_ID}, {"$set": {"next_idx": NUM_POKEMON * 2}})
+
+
+def reindex_loop():
+    mons = db.pokemon.find({"owner_id": OWNER_ID, "owned_by": "user"}).sort("idx")
+
+    ops = []
+    idx = 1
+    for pokemon in mons:
+        ops.append(UpdateOne({"_id": pokemon["_id"]}, {"$set": {"idx": idx}}))
+        idx += 1
+
+        if len(ops) >= 1000:
+            db.pokemon.bulk_write(ops)
+            ops = []
+
+    if ops:
+        db.pokemon.bulk_write(ops)
+
+
+def reindex_server():
+    next_idx = db.member.find_one({"_id": OWNER_ID})["next_idx"]
+    query = {"owner_id": OWNER_ID, "owned_by": "user", "idx": {"$lt": next_idx}}
+    pipeline = [
+        {"$match": query},
+        {"$setWindowFields": {"sortBy": {"idx": 1}, "output": {"idx": {"$documentNumber": {}}}}},
+        {"$project": {"idx": 1}},
+        {"$merge": {"into": "pokemon", "on": "_id", "whenMatched": "merge", "whenNotMatched": "discard"}},
+    ]
+    list(db.pokemon.aggregate(pipeline, allowDiskUse=True))
+
+
+def timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    if db.pokemon.estimated_document_count() != NUM_POKEMON:
+        print(f"Populating {NUM_POKEMON} pokémon...")
+        populate()
+
+    original = snapshot_indices()
+
+    elapsed = timed(reindex_loop)
+    print(f"client-side loop:  {elapsed:.2f} s")
+    expected = snapshot_indices()
+    restore_indices(original)
+
+    elapsed = timed(reindex_server)
+    print(f"server-side merge: {elapsed:.2f} s")
+    actual = snapshot_indices()
+    restore_indices(original)
+
+    assert actual == expected, "server-side reindex produced a different numbering"
+    print("numbering matches")
@@ -0,0 +1,54 @@
+"""
+Compares adding pokémon to a trade with the old list-based trade state, which
+checked every pokémon already in the trade for duplicates, and TradeSession,
+for trade addall of up to 3000 pokémon.
+"""
+
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from cogs.trading import TradeSession
+
+TRADE_SIZE = int(os.getenv("BENCHMARK_TRADE_SIZE", 3000))
+
+
+def make_pokemon(start, end):
+    return [SimpleNamespace(id=f"{i:024x}", idx=i) for i in range(start, end)]
+
+
+def addall_list(side, pokemon):
+    side.extend([x for x in pokemon if all((type(i) == int or x.idx != i.idx for i in side))])
+
+
+def addall_session(trade, user_id, pokemon):
+    for x in pokemon:
+        trade.add_pokemon(user_id, x)
+
+
+def timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    a, b = SimpleNamespace(id=1), SimpleNamespace(id=2)
+
+    # Add half the trade, then addall the full range on top of it, so half of
+    # the second batch are duplicates.
+    first, second = make_pokemon(1, TRADE_SIZE // 2 + 1), make_pokemon(1, TRADE_SIZE + 1)
+
+    side = []
+    elapsed = timed(lambda: addall_list(side, first)) + timed(lambda: addall_list(side, second))
+    print(f"list:         {elapsed * 1000:>8.1f} ms, {len(side)} pokémon")
+
+    trade = TradeSession(a, b, None)
+    elapsed = timed(lambda: addall_session(trade, a.id, first)) + timed(lambda: addall_session(trade, a.id, second))
+    print(f"TradeSession: {elapsed * 1000:>8.1f} ms, {trade.num_pokemon(a.id)} pokémon")
+
+    elapsed = timed(lambda: [trade.page(a.id, i) for i in range(trade.num_pages())])
+    print(f"all pages:    {elapsed * 1000:>8.1f} ms, {trade.num_pages()} pages")
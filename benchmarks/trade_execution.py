@@ -0,0 +1,121 @@
+"""
+Compares the old trade execution, which updated each traded pokémon on its
+own, with the single-transaction Mongo.execute_trade, on trades of 10, 1000
+and 3000 pokémon per side. Checks that both sides end up with each other's
+pokémon, numbered after their own, and that no coins are created or lost.
+
+Transactions need MongoDB running as a replica set. Runs against a scratch
+database, by default mongodb://localhost:27017/poketwo_benchmark, and Redis
+at redis://localhost.
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+import aioredis
+import structlog
+from motor.motor_asyncio import AsyncIOMotorClient
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from cogs.mongo import Mongo
+from helpers.audit_log import AuditLog
+
+SIZES = [int(x) for x in os.getenv("BENCHMARK_TRADE_SIZES", "10,1000,3000").split(",")]
+BALANCE = 1_000_000
+A, B = 1, 2
+
+
+async def setup(db, size):
+    await db.member.delete_many({})
+    await db.pokemon.delete_many({})
+    await db.logs.delete_many({})
+
+    await db.member.insert_many([{"_id": x, "balance": BALANCE, "redeems": 10, "next_idx": size + 1} for x in (A, B)])
+
+    pokemon = {}
+    for owner in (A, B):
+        result = await db.pokemon.insert_many(
+            [{"owner_id": owner, "owned_by": "user", "idx": i + 1, "species_id": 1} for i in range(size)]
+        )
+        pokemon[owner] = result.inserted_ids
+    return pokemon
+
+
+async def execute_loop(mongo, pokemon, pokecoins):
+    # What send_trade used to do, minus the compensating refunds.
+    db = mongo.db
+    for user, partner in ((A, B), (B, A)):
+        await db.member.find_one_and_update({"_id": user}, {"$inc": {"balance": -pokecoins[user]}})
+        await db.member.update_one({"_id": partner}, {"$inc": {"balance": pokecoins[user]}})
+
+    for user, partner in ((A, B), (B, A)):
+        member = await db.member.find_one_and_update({"_id": partner}, {"$inc": {"next_idx": len(pokemon[user])}})
+        idx = member["next_idx"]
+        for pokemon_id in pokemon[user]:
+            await db.pokemon.update_one({"_id": pokemon_id}, {"$set": {"owner_id": partner, "idx": idx}})
+            idx += 1
+
+    await db.logs.insert_one({"event": "trade", "users": [A, B], "pokemon": {str(k): v for k, v in pokemon.items()}})
+
+
+async def execute_transaction(mongo, pokemon, pokecoins):
+    await Mongo.execute_trade(mongo, [A, B], pokecoins, {A: 1, B: 0}, pokemon, {pokemon[A][0]: 2})
+
+
+async def check(db, pokemon, size):
+    for user, partner in ((A, B), (B, A)):
+        received = await db.pokemon.find({"owner_id": partner, "idx": {"$gt": size}}).sort("idx").to_list(None)
+        assert [x["_id"] for x in received] == pokemon[user]
+        assert [x["idx"] for x in received] == list(range(size + 1, size * 2 + 1))
+
+    members = await db.member.find().to_list(None)
+    assert sum(x["balance"] for x in members) == BALANCE * 2
+    assert all(x["next_idx"] == size * 2 + 1 for x in members)
+    assert await db.logs.count_documents({"event": "trade"}) == 1
+
+
+async def main():
+    client = AsyncIOMotorClient(os.getenv("BENCHMARK_DATABASE_URI", "mongodb://localhost:27017"))
+    db = client[os.getenv("BENCHMARK_DATABASE_NAME", "poketwo_benchmark")]
+    redis = await aioredis.create_redis_pool(os.getenv("BENCHMARK_REDIS_URI", "redis://localhost"))
+    spill_path = os.path.join(tempfile.mkdtemp(), "audit_log.bson")
+    mongo = SimpleNamespace(
+        client=client,
+        db=db,
+        bot=SimpleNamespace(redis=redis),
+        audit_log=AuditLog(db.logs, spill_path, log=structlog.get_logger()),
+    )
+    mongo.bump_collection_version = lambda *members: Mongo.bump_collection_version(mongo, *members)
+
+    pokecoins = {A: 500, B: 0}
+
+    for size in SIZES:
+        timings = []
+        for execute in (execute_loop, execute_transaction):
+            pokemon = await setup(db, size)
+            start = time.perf_counter()
+            await execute(mongo, pokemon, pokecoins)
+            timings.append(time.perf_counter() - start)
+            # Trades are logged once the transaction commits, through the buffer.
+            await mongo.audit_log.flush()
+            await check(db, pokemon, size)
+
+        loop, transaction = timings
+        print(
+            f"{size:>5} pokémon per side    "
+            f"per-pokémon updates {loop * 1000:>8.1f} ms    transaction {transaction * 1000:>8.1f} ms"
+        )
+
+    print("trades reconcile")
+
+    redis.close()
+    await redis.wait_closed()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
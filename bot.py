@@ -1,4 +1,7 @@
+import asyncio
+import graphlib
 import logging
+import time
 
 import aiohttp
 import discord
@@ -13,7 +16,9 @@ from pythonjsonlogger import jsonlogger
 
 import cogs
 import helpers
-from helpers import checks
+from helpers import checks, logs, metrics
+from helpers.loop_monitor import STALL_THRESHOLD, LoopMonitor
+from helpers.supervisor import SupervisorClient
 
 uvloop.install()
 
@@ -73,9 +78,13 @@ class ClusterBot(commands.AutoShardedBot):
             super().__init__(**kwargs, color=color)
 
     def __init__(self, **kwargs):
+        self.started_at = time.perf_counter()
         self.cluster_name = kwargs.pop("cluster_name")
         self.cluster_idx = kwargs.pop("cluster_idx")
         self.config = kwargs.pop("config", None)
+        self.supervisor_fd = kwargs.pop("supervisor_fd", None)
+        self.supervisor = None
+        self.loop_monitor = None
         if self.config is None:
             self.config = __import__("config")
 
@@ -83,6 +92,9 @@ class ClusterBot(commands.AutoShardedBot):
 
         super().__init__(**kwargs, command_prefix=determine_prefix, strip_after_prefix=True)
 
+        metrics.instrument_discord_http(self.http)
+        self.slow_command_threshold = getattr(self.config, "SLOW_COMMAND_THRESHOLD", None)
+
         # Load extensions
 
         self.add_check(
@@ -108,6 +120,7 @@ class ClusterBot(commands.AutoShardedBot):
 
     def setup_logging(self):
         self.log: structlog.BoundLogger = structlog.get_logger()
+        self.log_sampler = logs.Sampler(getattr(self.config, "LOG_SAMPLE_RATES", None))
 
         def add_cluster_name(logger, name, event_dict):
             event_dict["cluster"] = self.cluster_name
@@ -118,7 +131,14 @@ class ClusterBot(commands.AutoShardedBot):
 
         structlog.configure(
             processors=[
+                # These run on the thread that logs, so do as little as they
+                # can. Rendering happens on the writer thread.
+                structlog.stdlib.filter_by_level,
+                self.log_sampler,
+                logs.add_context_fields,
                 *shared_processors,
+                # Exceptions can't be looked up from the writer thread.
+                structlog.processors.format_exc_info,
                 structlog.stdlib.ProcessorFormatter.wrap_for_formatter,
             ],
             logger_factory=structlog.stdlib.LoggerFactory(),
@@ -133,15 +153,15 @@ class ClusterBot(commands.AutoShardedBot):
             processors=[
                 # Remove _record & _from_structlog.
                 structlog.stdlib.ProcessorFormatter.remove_processors_meta,
-                structlog.dev.ConsoleRenderer() if self.config.DEBUG else structlog.processors.JSONRenderer(),
+                (
+                    structlog.dev.ConsoleRenderer()
+                    if self.config.DEBUG
+                    else structlog.processors.JSONRenderer(serializer=logs.dumps)
+                ),
             ],
         )
 
-        handler = logging.StreamHandler()
-        handler.setFormatter(formatter)
-        root_logger = logging.getLogger()
-        root_logger.addHandler(handler)
-        root_logger.setLevel(logging.INFO)
+        self.log_writer = logs.start_writer(formatter)
 
     async def get_context(self, message, *, cls=helpers.context.PoketwoContext):
         return await super().get_context(message, cls=cls)
@@ -162,6 +182,10 @@ class ClusterBot(commands.AutoShardedBot):
     def redis(self):
         return self.get_cog("Redis").pool
 
+    @property
+    def bus(self):
+        return self.get_cog("Redis").bus
+
     @property
     def data(self):
         return self.get_cog("Data").instance
@@ -250,24 +274,18 @@ class ClusterBot(commands.AutoShardedBot):
             If ``field_ordering`` is specified but a field name was missing.
         """
 
-        error_title = self._("localization-error")
-        error_embed = discord.Embed(color=discord.Color.red(), title=error_title)
+        def error_embed() -> discord.Embed:
+            return discord.Embed(color=discord.Color.red(), title=self._("localization-error"))
 
-        result = self.lang.get_message(message_id)
-        if not result:
+        layout = self.lang.get_embed_layout(message_id)
+        if not layout:
             self.log.error("no such message id", message_id=message_id)
-            return error_embed
-
-        msg, bundle = result
-        attributes = msg.attributes
+            return error_embed()
 
         embed = discord.Embed()
 
-        PASSTHROUGH_FIELDS = ("title", "description", "url", "footer-text")
-        for field in PASSTHROUGH_FIELDS:
-            if field not in attributes:
-                continue
-            val, errors = bundle.format_pattern(attributes[field], kwargs)
+        for field, formatter in layout.passthrough:
+            val, errors = formatter(kwargs)
             if errors:
                 self.log.error(
                     "failed to format passthrough field for localized embed",
@@ -275,40 +293,25 @@ class ClusterBot(commands.AutoShardedBot):
                     field=field,
                     errors=errors,
                 )
-                return error_embed
+                return error_embed()
             if field == "footer-text":
                 embed.set_footer(text=val)
             else:
                 setattr(embed, field, val)
 
         def format_field_attribute(*, field: str, key: str) -> str | None:
-            key = f"field-{field}-{key}"
-
             try:
-                title_message = attributes[key]
+                formatter = layout.fields[field][key]
             except KeyError:
                 return None
 
-            val, errors = bundle.format_pattern(title_message, kwargs)
+            val, errors = formatter(kwargs)
 
             if errors:
                 return None
             return val
 
-        def extract_field_name(fluent_attribute: str) -> str:
-            return fluent_attribute[fluent_attribute.find("-") + 1 : fluent_attribute.rfind("-")]
-
-        discovered_field_names = {
-            name
-            for key in attributes
-            if key.startswith("field-") and (name := extract_field_name(key)) not in ignored_fields
-        }
-        if field_ordering:
-            discovered_field_names = sorted(
-                discovered_field_names, key=lambda field_name: field_ordering.index(field_name)
-            )
-
-        for field_name in discovered_field_names:
+        for field_name in layout.field_names(ignored_fields, field_ordering):
             name = format_field_attribute(field=field_name, key="name")
             # We aren't passing the default to `get` here because we want to fall
             # back even if the value is present, but `None`.
@@ -325,7 +328,7 @@ class ClusterBot(commands.AutoShardedBot):
                     message_id=message_id,
                     field_name=field_name,
                 )
-                return error_embed
+                return error_embed()
 
         return embed
 
@@ -336,16 +339,81 @@ class ClusterBot(commands.AutoShardedBot):
         dm = await self.create_dm(user)
         return await dm.send(*args, **kwargs)
 
+    async def load_cog(self, name):
+        """Loads a cog extension, then waits for any of its cogs that own a
+        connection to be ready.
+        """
+
+        start = time.perf_counter()
+        await self.load_extension(f"cogs.{name}")
+        loaded = time.perf_counter()
+
+        for cog in list(self.cogs.values()):
+            if type(cog).__module__ == f"cogs.{name}" and hasattr(cog, "wait_until_ready"):
+                await cog.wait_until_ready()
+
+        self.log.info(
+            "cog_loaded",
+            cog=name,
+            load_ms=round((loaded - start) * 1000, 1),
+            ready_ms=round((time.perf_counter() - loaded) * 1000, 1),
+        )
+
+    async def load_cogs(self):
+        """Loads every default cog, each as soon as the cogs it depends on (see
+        ``cogs.dependencies``) are loaded and ready.
+        """
+
+        graph = graphlib.TopologicalSorter({x: cogs.dependencies.get(x, ()) for x in cogs.default})
+        graph.prepare()
+        pending = {}
+
+        try:
+            while graph.is_active():
+                for name in graph.get_ready():
+                    pending[asyncio.create_task(self.load_cog(name))] = name
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    graph.done(pending.pop(task))
+                    task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
     async def setup_hook(self):
-        self.http_session = aiohttp.ClientSession()
-        await self.load_extension("jishaku")
-        for i in cogs.default:
-            await self.load_extension(f"cogs.{i}")
-        self.log.info(f"init", shard_ids=self.shard_ids, shard_count=self.shard_count)
+        self.http_session = aiohttp.ClientSession(trace_configs=[metrics.http_trace_config()])
+        self.loop_monitor = LoopMonitor(
+            self.loop, self.log, stall_threshold=getattr(self.config, "LOOP_STALL_THRESHOLD", None) or STALL_THRESHOLD
+        )
+        if getattr(self.config, "LOOP_MONITOR", False):
+            self.loop_monitor.start()
+        if self.supervisor_fd is not None:
+            self.supervisor = SupervisorClient(self, self.supervisor_fd)
+            await self.supervisor.connect()
+        await asyncio.gather(self.load_extension("jishaku"), self.load_cogs())
+        self.log.info(
+            f"init",
+            shard_ids=self.shard_ids,
+            shard_count=self.shard_count,
+            elapsed_s=round(time.perf_counter() - self.started_at, 2),
+        )
 
     async def on_ready(self):
         self.log.info("ready")
 
+    async def before_identify_hook(self, shard_id, *, initial=False):
+        # Clusters run by the supervisor on the same host take turns, unless
+        # it's gone, in which case this cluster goes at its own pace.
+        if self.supervisor is not None:
+            try:
+                return await self.supervisor.acquire_identify(shard_id)
+            except ConnectionError:
+                self.log.warning("supervisor.disconnected", shard_id=shard_id)
+        return await super().before_identify_hook(shard_id, initial=initial)
+
+    async def on_shard_connect(self, shard_id):
+        self.log.info("shard_connect", shard_id=shard_id, elapsed_s=round(time.perf_counter() - self.started_at, 2))
+
     async def on_shard_ready(self, shard_id):
         self.log.info("shard_ready", shard_id=shard_id)
 
@@ -357,18 +425,34 @@ class ClusterBot(commands.AutoShardedBot):
         if ctx.command is None:
             return
 
-        if not (
-            ctx.command.name in CONCURRENCY_LIMITED_COMMANDS
-            or (ctx.command.root_parent and ctx.command.root_parent.name in CONCURRENCY_LIMITED_COMMANDS)
-        ):
-            return await super().invoke(ctx)
-
-        try:
-            async with RedisLock(self.redis, f"command:{ctx.author.id}", 60, 1):
-                return await super().invoke(ctx)
-        except LockTimeoutError:
-            await ctx.reply(ctx._("error-command-redis-locked"))
+        with metrics.trace_command(ctx.command.qualified_name, ctx.log, self.slow_command_threshold):
+            # Anything formatted while the command runs is in the user's locale,
+            # not just what goes through ctx.
+            lang = self.get_cog("Lang")
+            ctx.locale = await lang.fetch_locale(ctx.author)
+
+            with lang.localize(ctx.locale, ctx.clean_prefix):
+                if not (
+                    ctx.command.name in CONCURRENCY_LIMITED_COMMANDS
+                    or (ctx.command.root_parent and ctx.command.root_parent.name in CONCURRENCY_LIMITED_COMMANDS)
+                ):
+                    return await super().invoke(ctx)
+
+                try:
+                    async with RedisLock(self.redis, f"command:{ctx.author.id}", 60, 1) as lock:
+                        ctx.command_lock = lock
+                        return await super().invoke(ctx)
+                except LockTimeoutError:
+                    await ctx.reply(ctx._("error-command-redis-locked"))
 
     async def close(self):
         self.log.info("close")
+        if self.supervisor is not None:
+            self.supervisor.close()
+        if self.loop_monitor is not None:
+            self.loop_monitor.stop()
+        # Before the Mongo client is closed along with the cogs.
+        if (mongo := self.get_cog("Mongo")) is not None:
+            await mongo.audit_log.close()
         await super().close()
+        self.log_writer.stop()
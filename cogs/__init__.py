@@ -7,6 +7,7 @@ default = (
     "data",
     "help",
     "market",
+    "metrics",
     "mongo",
     "pokemon",
     "quests",
@@ -18,3 +19,12 @@ default = (
     "pride_2023",
     "lang",
 )
+
+# The cogs each cog needs loaded, and ready, before it's loaded itself. Cogs
+# that don't depend on each other are loaded concurrently. This only needs to
+# cover what a cog uses while loading, or in tasks it starts that don't wait
+# for the bot to be ready, since nothing else runs until every cog is loaded.
+dependencies = {
+    "pride_2023": ("data",),
+    "trading": ("redis",),
+}
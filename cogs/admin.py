@@ -1,19 +1,68 @@
+import asyncio
+import contextlib
+import io
+import os
 import random
 import typing
 from datetime import datetime
 
+import discord
+import humanfriendly
 from discord.ext import commands
 
+from helpers import profiling
 from helpers.converters import FetchUserConverter, TimeDelta, strfdelta
 
 from . import mongo
 
+# The longest a profile can be asked for, in seconds.
+PROFILE_MAX_DURATION = 300
+
+# How large attachments can be outside of guilds, whose limit depends on boosts.
+ATTACHMENT_SIZE_LIMIT = 8 * 1024 * 1024
+
+# How many of the allocations that grew the most memory snapshots show.
+MEMORY_TOP_ALLOCATIONS = 10
+
+
+def signed_size(size):
+    return ("+" if size >= 0 else "-") + humanfriendly.format_size(abs(size), binary=True)
+
+
+def format_growth(stat):
+    frame = stat.traceback[-1]
+    where = f"{profiling.short_filename(frame.filename)}:{frame.lineno}"
+    return f"{signed_size(stat.size_diff):>12} {stat.count_diff:>+8} {where}"
+
+
+def structure_sizes(bot):
+    """Returns how many entries long-lived structures that grow with traffic
+    hold, to tell which of them memory growth is in.
+    """
+
+    sizes = {
+        "bot.menus": len(bot.menus),
+        "bot.trades": len(getattr(bot, "trades", ())),
+        "bot.cooldown_users": len(getattr(bot, "cooldown_users", ())),
+        "bot.cooldown_guilds": len(getattr(bot, "cooldown_guilds", ())),
+        "command cooldowns": sum(len(x._buckets._cache) for x in bot.walk_commands()),
+    }
+    if (mongo := bot.get_cog("Mongo")) is not None:
+        sizes["mongo.query_cache"] = len(mongo.query_cache)
+    if (battling := bot.get_cog("Battling")) is not None:
+        sizes["battling.battles"] = len(battling.battles)
+    return sizes
+
 
 class Administration(commands.Cog):
     """Commands for bot administration."""
 
     def __init__(self, bot: commands.Bot):
         self.bot = bot
+        self.profiler = None
+        self.profiler_stopped = asyncio.Event()
+        self.memory = profiling.MemoryTracker()
+        self.structure_sizes = None
 
     @commands.is_owner()
     @commands.group(aliases=("am",), invoke_without_command=True, case_insensitive=True)
@@ -66,6 +115,27 @@ class Administration(commands.Cog):
         users_msg = ", ".join(f"**{x}**" for x in users)
         await ctx.send(ctx._("unsuspended-users", users=users_msg))
 
+    @commands.is_owner()
+    @admin.command(aliases=("rpd",))
+    async def reconcilepokedex(self, ctx, users: commands.Greedy[FetchUserConverter]):
+        """Recompute pokédex counts for one or more users, or every stale user if none are given."""
+
+        if len(users) > 0:
+            await self.bot.mongo.reconcile_pokedex_counts([x.id for x in users])
+            count = len(users)
+        else:
+            count = await self.bot.mongo.reconcile_all_pokedex_counts(stale_only=True)
+
+        await ctx.send(ctx._("reconcilepokedex-completed", count=count))
+
+    @commands.is_owner()
+    @admin.command(aliases=("rmi",))
+    async def reconcilemarket(self, ctx):
+        """Rebuild the market search index from the current listings."""
+
+        count = await self.bot.mongo.reconcile_market_index()
+        await ctx.send(ctx._("reconcilemarket-completed", count=count))
+
     @commands.is_owner()
     @admin.command(aliases=("spawn",))
     async def randomspawn(self, ctx):
@@ -165,6 +235,7 @@ class Administration(commands.Cog):
                 "idx": await self.bot.mongo.fetch_next_idx(user),
             }
         )
+        await self.bot.mongo.bump_collection_version(user)
 
         await ctx.send(ctx._("give-completed", pokemon=str(species), user=str(user)))
 
@@ -202,8 +273,150 @@ class Administration(commands.Cog):
             )
 
         await self.bot.mongo.db.pokemon.insert_many(pokemon)
+        await self.bot.mongo.bump_collection_version(user)
         await ctx.send(ctx._("setup-completed", number=num, user=str(user)))
 
+    @commands.is_owner()
+    @admin.command(aliases=("lm",))
+    async def loopmonitor(self, ctx, action: typing.Literal["on", "off"] = None):
+        """Turn the event loop monitor on or off, or show what it's seen."""
+
+        monitor = self.bot.loop_monitor
+
+        if action == "on":
+            monitor.start()
+            return await ctx.send(ctx._("loopmonitor-started"))
+        if action == "off":
+            monitor.stop()
+            return await ctx.send(ctx._("loopmonitor-stopped"))
+        if not monitor.running:
+            return await ctx.send(ctx._("loopmonitor-not-running"))
+
+        message = ctx._(
+            "loopmonitor-status",
+            lag=round(monitor.lag * 1000, 1),
+            maxLag=round(monitor.max_lag * 1000, 1),
+            threshold=round(monitor.stall_threshold * 1000),
+            stalls=monitor.stall_count,
+            tasks=sum(monitor.tasks.values()),
+            topTasks="\n".join(f"{count:>6} {name}" for name, count in monitor.tasks.most_common(15)),
+        )
+
+        # The stacks of recent stalls are too long for a message.
+        stalls = [x.format() for x in monitor.stalls]
+        if len(stalls) > 0:
+            file = discord.File(io.BytesIO("\n\n".join(stalls).encode()), filename="stalls.txt")
+            return await ctx.send(message, file=file)
+        await ctx.send(message)
+
+    @commands.is_owner()
+    @admin.command(aliases=("ls",))
+    async def logsample(self, ctx, event: str, rate: float = None):
+        """Set the fraction of events of a kind this cluster logs, or stop sampling them."""
+
+        if rate is None or rate >= 1:
+            self.bot.log_sampler.rates.pop(event, None)
+            return await ctx.send(ctx._("logsample-cleared", event=event))
+
+        self.bot.log_sampler.rates[event] = max(rate, 0)
+        await ctx.send(ctx._("logsample-set", event=event, rate=max(rate, 0)))
+
+    @commands.is_owner()
+    @admin.group(aliases=("prof",), invoke_without_command=True, case_insensitive=True)
+    async def profile(self, ctx, seconds: int = 30):
+        """Profile this cluster for a number of seconds."""
+
+        if self.profiler is not None and self.profiler.running:
+            return await ctx.send(ctx._("profile-already-running"))
+
+        seconds = max(min(seconds, PROFILE_MAX_DURATION), 1)
+        self.profiler = profiler = profiling.SamplingProfiler()
+        self.profiler_stopped.clear()
+        profiler.start()
+        await ctx.send(ctx._("profile-started", cluster=self.bot.cluster_name, seconds=seconds))
+
+        try:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self.profiler_stopped.wait(), seconds)
+        finally:
+            await self.bot.loop.run_in_executor(None, profiler.stop)
+
+        directory = getattr(self.bot.config, "PROFILE_DIR", None) or profiling.DEFAULT_PROFILE_DIR
+        name = f"profile-{self.bot.cluster_name}-{datetime.utcnow():%Y%m%d-%H%M%S}"
+        paths = await self.bot.loop.run_in_executor(None, profiler.write, directory, name)
+
+        limit = ctx.guild.filesize_limit if ctx.guild else ATTACHMENT_SIZE_LIMIT
+        files = [discord.File(x) for x in paths if os.path.getsize(x) <= limit]
+        await ctx.reply(
+            ctx._(
+                "profile-completed",
+                samples=profiler.sample_count,
+                seconds=round(profiler.duration, 1),
+                path=os.path.join(directory, name),
+            ),
+            files=files,
+        )
+
+    @commands.is_owner()
+    @profile.command(name="stop")
+    async def profile_stop(self, ctx):
+        """Stop profiling this cluster early."""
+
+        if self.profiler is None or not self.profiler.running:
+            return await ctx.send(ctx._("profile-not-running"))
+
+        self.profiler_stopped.set()
+
+    @commands.is_owner()
+    @admin.group(aliases=("mem",), invoke_without_command=True, case_insensitive=True)
+    async def memory(self, ctx):
+        """Take a memory snapshot, and show what grew since the last one."""
+
+        if not self.memory.running:
+            return await ctx.send(ctx._("memory-not-running"))
+
+        total, diff = await self.bot.loop.run_in_executor(None, self.memory.snapshot)
+        sizes, self.structure_sizes = self.structure_sizes, structure_sizes(self.bot)
+
+        if diff is None:
+            return await ctx.send(ctx._("memory-snapshot-first", size=humanfriendly.format_size(total, binary=True)))
+
+        growth = [x for x in diff if x.size_diff > 0]
+        top = "\n".join(format_growth(x) for x in growth[:MEMORY_TOP_ALLOCATIONS])
+        structures = "\n".join(
+            f"{name:<20} {count:>8} ({count - (sizes or {}).get(name, 0):+})"
+            for name, count in self.structure_sizes.items()
+        )
+        report = "\n\n".join(str(x) + "\n" + "\n".join(x.traceback.format()) for x in growth[:100])
+
+        await ctx.send(
+            ctx._(
+                "memory-snapshot",
+                size=humanfriendly.format_size(total, binary=True),
+                diff=signed_size(sum(x.size_diff for x in diff)),
+                top=top or "-",
+                structures=structures,
+            ),
+            file=discord.File(io.BytesIO(report.encode()), filename="memory.txt"),
+        )
+
+    @commands.is_owner()
+    @memory.command(name="start")
+    async def memory_start(self, ctx, frames: int = profiling.MEMORY_TRACE_FRAMES):
+        """Start tracing memory allocations on this cluster."""
+
+        self.memory.start(frames)
+        await ctx.send(ctx._("memory-started", frames=frames))
+
+    @commands.is_owner()
+    @memory.command(name="stop")
+    async def memory_stop(self, ctx):
+        """Stop tracing memory allocations on this cluster."""
+
+        self.memory.stop()
+        self.structure_sizes = None
+        await ctx.send(ctx._("memory-stopped"))
+
 
 async def setup(bot: commands.Bot):
     await bot.add_cog(Administration(bot))
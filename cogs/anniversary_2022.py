@@ -336,6 +336,7 @@ class Anniversary(commands.Cog):
         await self.bot.mongo.update_member(ctx.author, update)
         if len(added_pokemon) > 0:
             await self.bot.mongo.db.pokemon.insert_many(added_pokemon)
+            await self.bot.mongo.bump_collection_version(ctx.author)
         await ctx.send(embed=embed)
 
     @commands.is_owner()
@@ -1,13 +1,34 @@
+import asyncio
 import contextlib
-from datetime import datetime, timedelta
+import time
+from datetime import datetime, timedelta, timezone
 
 import discord
 import humanfriendly
-from discord.ext import commands, tasks
+from discord.ext import commands
 
+from cogs.mongo import BidFailed
 from helpers import checks, constants, converters, flags, pagination
 from helpers.utils import FakeUser
 
+# Atomically removes and returns the auctions in a shard's schedule that are
+# due, so each one is only ever claimed by a single scheduler.
+CLAIM_DUE_AUCTIONS = """
+local due = redis.call("ZRANGEBYSCORE", KEYS[1], "-inf", ARGV[1], "LIMIT", 0, ARGV[2])
+if #due > 0 then
+    redis.call("ZREM", KEYS[1], unpack(due))
+end
+return due
+"""
+
+AUCTION_CONCURRENCY = 10
+AUCTION_CLAIM_BATCH_SIZE = 100
+
+# The scheduler never sleeps for longer than this, and re-reads the running
+# auctions from the database this often in case any were missed or failed.
+AUCTION_MAX_SLEEP = 60
+AUCTION_RESYNC_INTERVAL = 600
+
 
 class AuctionConverter(commands.Converter):
     async def convert(self, ctx, arg):
@@ -29,64 +50,113 @@ class Auctions(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
-        self.check_auctions.start()
+        self.auction_scheduled = asyncio.Event()
+        self.auction_semaphore = asyncio.Semaphore(AUCTION_CONCURRENCY)
+        self.scheduler = self.bot.loop.create_task(self.run_scheduler())
+
+    # Scheduling
+
+    def schedule_key(self, guild_id):
+        shard_id = (guild_id >> 22) % (self.bot.shard_count or 1)
+        return f"auctions:{shard_id}"
 
-    @tasks.loop(seconds=20)
-    async def check_auctions(self):
-        auctions = self.bot.mongo.db.pokemon.find(
-            {"owned_by": "auction", "auction_data.ends": {"$lt": datetime.utcnow()}}
+    async def schedule_auction(self, auction_id, guild_id, ends):
+        await self.bot.redis.zadd(
+            self.schedule_key(guild_id), ends.replace(tzinfo=timezone.utc).timestamp(), auction_id
         )
-        async for auction in auctions:
-            try:
-                async with await self.bot.mongo.client.start_session() as s:
-                    async with s.start_transaction():
-                        await self.end_auction(auction)
-            except Exception as e:
-                raise
-                self.bot.log.error("check_auctions.error", auction=auction)
+        self.auction_scheduled.set()
+
+    async def sync_schedule(self):
+        """Schedules every running auction in this cluster's shards."""
 
-    @check_auctions.before_loop
-    async def before_check_auctions(self):
+        keys = {f"auctions:{x}" for x in self.bot.shard_ids or [0]}
+        async for auction in self.bot.mongo.db.pokemon.find({"owned_by": "auction"}, {"auction_data": 1}):
+            data = auction["auction_data"]
+            if self.schedule_key(data["guild_id"]) in keys:
+                await self.schedule_auction(data["_id"], data["guild_id"], data["ends"])
+
+    async def run_scheduler(self):
         await self.bot.wait_until_ready()
 
+        keys = [f"auctions:{x}" for x in self.bot.shard_ids or [0]]
+        last_sync = 0
+
+        while True:
+            try:
+                if time.time() - last_sync > AUCTION_RESYNC_INTERVAL:
+                    await self.sync_schedule()
+                    last_sync = time.time()
+
+                self.auction_scheduled.clear()
+                delay = AUCTION_MAX_SLEEP
+
+                for key in keys:
+                    due = await self.bot.redis.eval(
+                        CLAIM_DUE_AUCTIONS, keys=[key], args=[time.time(), AUCTION_CLAIM_BATCH_SIZE]
+                    )
+                    for auction_id in due:
+                        self.bot.loop.create_task(self.end_auction(int(auction_id)))
+                    if len(due) == AUCTION_CLAIM_BATCH_SIZE:
+                        delay = 0
+
+                    for _, ends in await self.bot.redis.zrange(key, 0, 0, withscores=True):
+                        delay = min(delay, ends - time.time())
+
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self.auction_scheduled.wait(), max(delay, 0))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.bot.log.exception("auction_scheduler.error")
+                await asyncio.sleep(AUCTION_MAX_SLEEP)
+
     async def try_get_member(self, guild, id):
         if user := self.bot.get_user(id):
             return user
-        with contextlib.suppress(discord.HTTPException):
-            return await guild.fetch_member(id)
+        if guild is not None:
+            with contextlib.suppress(discord.HTTPException):
+                return await guild.fetch_member(id)
         with contextlib.suppress(discord.HTTPException):
             return await self.bot.fetch_user(id)
         return FakeUser(id)
 
-    async def end_auction(self, auction):
-        if (auction_guild := self.bot.get_guild(auction["auction_data"]["guild_id"])) is None:
-            return
+    async def end_auction(self, auction_id):
+        async with self.auction_semaphore:
+            auction = await self.bot.mongo.db.pokemon.find_one({"owned_by": "auction", "auction_data._id": auction_id})
+            if auction is None:
+                return
+
+            data = auction["auction_data"]
+            if data["ends"] > datetime.utcnow():
+                # A bid extended the auction after it was claimed.
+                return await self.schedule_auction(auction_id, data["guild_id"], data["ends"])
 
-        guild = await self.bot.mongo.fetch_guild(auction_guild)
+            if await self.transfer_auction(auction) is False:
+                return
+
+        auction_guild = self.bot.get_guild(data["guild_id"])
         pokemon = self.bot.mongo.Pokemon.build_from_mongo(auction)
         host = await self.try_get_member(auction_guild, auction["owner_id"])
-        new_owner = host
 
-        if auction["auction_data"]["bidder_id"] is not None:
-            bidder = await self.try_get_member(auction_guild, auction["auction_data"]["bidder_id"])
-            new_owner = bidder
+        if data["bidder_id"] is not None:
+            bidder = await self.try_get_member(auction_guild, data["bidder_id"])
 
-            embed = self.make_base_embed(host, pokemon, auction["auction_data"]["_id"])
-            embed.title = self.bot._("auction-title-sold", pokemon=f"{pokemon:l}", id=auction["auction_data"]["_id"])
-            auction_ended_info = self.bot._(
-                "auction-ended-details", coins=auction["auction_data"]["current_bid"], bidder=bidder.mention
-            )
+            embed = self.make_base_embed(host, pokemon, data["_id"])
+            embed.title = self.bot._("auction-title-sold", pokemon=f"{pokemon:l}", id=data["_id"])
+            auction_ended_info = self.bot._("auction-ended-details", coins=data["current_bid"], bidder=bidder.mention)
             embed.add_field(name=self.bot._("auction-details"), value="\n".join(auction_ended_info))
             embed.set_footer(text=self.bot._("auction-ended"))
 
-            if auction_channel := auction_guild.get_channel(guild.auction_channel):
-                with contextlib.suppress(discord.HTTPException):
-                    await auction_channel.send(embed=embed)
+            if auction_guild is not None:
+                guild = await self.bot.mongo.fetch_guild(auction_guild)
+                if auction_channel := auction_guild.get_channel(guild.auction_channel):
+                    with contextlib.suppress(discord.HTTPException):
+                        await auction_channel.send(embed=embed)
             with contextlib.suppress(discord.HTTPException):
                 msg = self.bot._(
                     "auction-ended",
-                    id=auction["auction_data"]["_id"],
-                    bid=f"{auction['auction_data']['current_bid']:,}",
+                    id=data["_id"],
+                    bid=f"{data['current_bid']:,}",
                     pokemon=f"{pokemon:pl}",
                 )
                 await host.send(msg)
@@ -94,40 +164,75 @@ class Auctions(commands.Cog):
                 msg = self.bot._(
                     "won-auction",
                     pokemon=f"{pokemon:pl}",
-                    bid=f"{auction['auction_data']['current_bid']:,}",
-                    id=auction["auction_data"]["_id"],
+                    bid=f"{data['current_bid']:,}",
+                    id=data["_id"],
                 )
                 await bidder.send(msg)
+        else:
+            with contextlib.suppress(discord.HTTPException):
+                msg = self.bot._("auction-ended-no-bids", id=data["_id"], pokemon=f"{pokemon:pl}")
+                await host.send(msg)
+
+    async def transfer_auction(self, auction):
+        """Gives an ended auction's pokémon to the highest bidder (or back to the
+        host if there were no bids), and pays the host in one transaction, then
+        logs the sale. Returns False if the auction had changed or already
+        ended, in which case nothing is written.
+        """
 
-            await self.bot.mongo.update_member(host, {"$inc": {"balance": auction["auction_data"]["current_bid"]}})
-            await self.bot.mongo.db.logs.insert_one(
+        data = auction["auction_data"]
+        new_owner_id = auction["owner_id"] if data["bidder_id"] is None else data["bidder_id"]
+
+        async def transfer(s):
+            member = await self.bot.mongo.db.member.find_one_and_update(
+                {"_id": new_owner_id}, {"$inc": {"next_idx": 1}}, projection={"next_idx": 1}, session=s
+            )
+            result = await self.bot.mongo.db.pokemon.update_one(
+                {
+                    "_id": auction["_id"],
+                    "owned_by": "auction",
+                    "auction_data._id": data["_id"],
+                    "auction_data.bidder_id": data["bidder_id"],
+                    "auction_data.current_bid": data["current_bid"],
+                    "auction_data.ends": {"$lte": datetime.utcnow()},
+                },
+                {
+                    "$set": {"owner_id": new_owner_id, "owned_by": "user", "idx": member["next_idx"]},
+                    "$unset": {"auction_data": 1},
+                },
+                session=s,
+            )
+            if result.modified_count == 0:
+                await s.abort_transaction()
+                return False
+
+            if data["bidder_id"] is not None:
+                await self.bot.mongo.db.member.update_one(
+                    {"_id": auction["owner_id"]}, {"$inc": {"balance": data["current_bid"]}}, session=s
+                )
+            return True
+
+        async with await self.bot.mongo.client.start_session() as s:
+            if not await s.with_transaction(transfer):
+                return False
+
+        if data["bidder_id"] is not None:
+            self.bot.mongo.audit_log.write(
                 {
                     "event": "auction",
-                    "user": auction["auction_data"]["bidder_id"],
+                    "user": data["bidder_id"],
                     "item": auction["_id"],
                     "seller_id": auction["owner_id"],
-                    "listing_id": auction["auction_data"]["_id"],
-                    "price": auction["auction_data"]["current_bid"],
+                    "species_id": auction["species_id"],
+                    "shiny": auction["shiny"],
+                    "listing_id": data["_id"],
+                    "price": data["current_bid"],
                 }
             )
-        else:
-            with contextlib.suppress(discord.HTTPException):
-                msg = self.bot._("auction-ended-no-bids", id=auction["auction_data"]["_id"], pokemon=f"{pokemon:pl}")
-                await host.send(msg)
-
-        # ok, bid
 
-        await self.bot.mongo.db.pokemon.update_one(
-            {"owned_by": "auction", "auction_data._id": auction["auction_data"]["_id"]},
-            {
-                "$set": {
-                    "owner_id": new_owner.id,
-                    "owned_by": "user",
-                    "idx": await self.bot.mongo.fetch_next_idx(new_owner),
-                },
-                "$unset": {"auction_data": 1},
-            },
-        )
+        await self.bot.redis.hdel("db:member", auction["owner_id"], new_owner_id)
+        await self.bot.mongo.bump_collection_version(auction["owner_id"], new_owner_id)
+        return True
 
     def make_base_embed(self, author, pokemon, auction_id):
         embed = self.bot.Embed(
@@ -276,6 +381,8 @@ class Auctions(commands.Cog):
                 }
             },
         )
+        await self.bot.mongo.bump_collection_version(ctx.author)
+        await self.schedule_auction(counter["next"], ctx.guild.id, ends)
 
         embed = self.make_base_embed(ctx.author, pokemon, counter["next"])
         embed.add_field(
@@ -387,60 +494,20 @@ class Auctions(commands.Cog):
 
         # go!
 
-        auction = await self.bot.mongo.db.pokemon.find_one(
-            {"owned_by": "auction", "auction_data._id": auction["auction_data"]["_id"]}
-        )
-
-        if auction is None:
-            return await ctx.send(ctx._("unknown-auction"))
-
-        if bid < auction["auction_data"]["current_bid"] + auction["auction_data"]["bid_increment"]:
-            return await ctx.send(
-                ctx._(
-                    "bid-minimum",
-                    minimum=auction["auction_data"]["current_bid"] + auction["auction_data"]["bid_increment"],
-                )
+        try:
+            auction, ends = await self.bot.mongo.place_auction_bid(
+                auction["auction_data"]["_id"],
+                ctx.author.id,
+                bid,
+                queue=getattr(self.bot.config, "AUCTION_BID_QUEUE", False),
             )
+        except BidFailed as e:
+            return await ctx.send(ctx._(e.message_id, **e.kwargs))
 
-        if auction["auction_data"]["ends"] < datetime.utcnow():
-            return await ctx.send(ctx._("auction-ended"))
-
-        member = await self.bot.mongo.fetch_member_info(ctx.author)
-        if member.balance < bid:
-            return await ctx.send(ctx._("not-enough-coins"))
-
-        # ok, bid
-
-        res = await self.bot.mongo.db.member.find_one_and_update({"_id": ctx.author.id}, {"$inc": {"balance": -bid}})
-        await self.bot.redis.hdel("db:member", ctx.author.id)
-        if res["balance"] < bid:
-            await self.bot.mongo.update_member(ctx.author, {"$inc": {"balance": bid}})
-            return await ctx.send(ctx._("not-enough-coins"))
-
-        # check to make sure still there
-
-        update = {
-            "$set": {
-                "auction_data.current_bid": bid,
-                "auction_data.bidder_id": ctx.author.id,
-            }
-        }
-
-        if datetime.utcnow() + timedelta(minutes=5) > auction["auction_data"]["ends"]:
-            update["$set"]["auction_data.ends"] = datetime.utcnow() + timedelta(minutes=5)
-
-        r = await self.bot.mongo.db.pokemon.update_one(
-            {"owned_by": "auction", "auction_data._id": auction["auction_data"]["_id"]}, update
-        )
-
-        if r.modified_count == 0:
-            await self.bot.mongo.update_member(ctx.author, {"$inc": {"balance": bid}})
-            return await ctx.send(ctx._("auction-ended-already"))
+        if ends != auction["auction_data"]["ends"]:
+            await self.schedule_auction(auction["auction_data"]["_id"], auction["auction_data"]["guild_id"], ends)
 
         if auction["auction_data"]["bidder_id"] is not None:
-            await self.bot.mongo.update_member(
-                auction["auction_data"]["bidder_id"], {"$inc": {"balance": auction["auction_data"]["current_bid"]}}
-            )
             self.bot.loop.create_task(
                 self.bot.send_dm(
                     auction["auction_data"]["bidder_id"],
@@ -477,10 +544,10 @@ class Auctions(commands.Cog):
             text=ctx._(
                 "auction-bid-cta",
                 command=f"auction bid {auction['auction_data']['_id']} <bid>",
-                delta=converters.strfdelta(auction["auction_data"]["ends"] - datetime.utcnow()),
+                delta=converters.strfdelta(ends - datetime.utcnow()),
             )
         )
-        embed.timestamp = auction["auction_data"]["ends"]
+        embed.timestamp = ends
 
         auction_channel = ctx.guild.get_channel(guild.auction_channel)
         if auction_channel is not None:
@@ -640,7 +707,7 @@ class Auctions(commands.Cog):
         await ctx.send(embed=embed)
 
     def cog_unload(self):
-        self.check_auctions.cancel()
+        self.scheduler.cancel()
 
 
 async def setup(bot: commands.Bot):
@@ -1,6 +1,6 @@
 import asyncio
 import math
-import pickle
+import time
 import typing
 from datetime import datetime
 from enum import Enum
@@ -9,9 +9,22 @@ from urllib.parse import urlencode, urljoin
 import discord
 from discord.ext import commands, tasks
 
-import data.constants
-from data import models
 from helpers import checks, constants, converters, pagination
+from helpers.battle import MAX_PASSED_TURNS, BattleEngine, Battler, Side
+
+# Discord only sends DM events to shard 0, so move requests go to whichever
+# cluster has it. That cluster announces itself under this key, with this TTL
+# in seconds, refreshed at this interval.
+DM_CLUSTER_KEY = "dm_cluster"
+DM_CLUSTER_TTL = 15
+DM_CLUSTER_HEARTBEAT = 5
+
+# How long a trainer has to pick an action before they pass.
+MOVE_REQUEST_TIMEOUT = 35
+
+# How long a battle waits for a decision at most, in case the request or the
+# decision was lost on the way, after which the trainer passes.
+MOVE_DECISION_TIMEOUT = 2 * MOVE_REQUEST_TIMEOUT
 
 
 def in_battle(bool=True):
@@ -23,38 +36,19 @@ def in_battle(bool=True):
     return commands.check(predicate)
 
 
-def get_priority(action, selected):
-    if action["type"] == "move":
-        s = selected.spd
-        if "Paralysis" in selected.ailments:
-            s *= 0.5
-        return (
-            action["value"].priority * 1e20 + selected.spd * data.constants.STAT_STAGE_MULTIPLIERS[selected.stages.spd]
-        )
-
-    return 1e99
-
-
 class Stage(Enum):
     SELECT = 1
     PROGRESS = 2
     END = 3
 
 
-class Trainer:
+class Trainer(Side):
     def __init__(self, user: discord.Member, bot):
+        super().__init__()
         self.user = user
-        self.pokemon = []
-        self.selected_idx = 0
         self.done = False
         self.bot = bot
 
-    @property
-    def selected(self):
-        if self.selected_idx == -1:
-            return None
-        return self.pokemon[self.selected_idx]
-
     async def get_action(self, message):
         actions = {}
 
@@ -92,19 +86,46 @@ class Trainer:
 
         # Send request
 
-        await self.bot.redis.rpush(
-            "move_request",
-            pickle.dumps(
-                {
-                    "cluster_idx": self.bot.cluster_idx,
-                    "user_id": self.user.id,
-                    "species_id": self.selected.species.id,
-                    "actions": actions,
-                }
-            ),
-        )
+        request = {
+            "cluster_idx": self.bot.cluster_idx,
+            "user_id": self.user.id,
+            "species_id": self.selected.species.id,
+            "actions": actions,
+            "requested_at": int(time.time() * 1000),
+        }
+
+        dm_cluster = await self.bot.redis.get(DM_CLUSTER_KEY)
+        if dm_cluster is None or int(dm_cluster) == self.bot.cluster_idx:
+            # Nobody has shard 0 right now, or we do, so handle it here.
+            self.bot.dispatch("move_request", request)
+        else:
+            await self.bot.bus.publish("move_request", request, cluster=int(dm_cluster))
 
-        uid, action = await self.bot.wait_for("move_decide", check=lambda u, a: u == self.user.id)
+        def check(user_id, action, requested_at, waited):
+            return user_id == self.user.id and requested_at == request["requested_at"]
+
+        deadline = time.monotonic() + MOVE_DECISION_TIMEOUT
+        while True:
+            timeout = max(min(MOVE_REQUEST_TIMEOUT, deadline - time.monotonic()), 0)
+            try:
+                _, action, _, waited = await self.bot.wait_for("move_decide", timeout=timeout, check=check)
+                break
+            except asyncio.TimeoutError:
+                # Keep waiting for as long as the cluster that has the request
+                # is still up, up to the deadline, otherwise the trainer passes.
+                if time.monotonic() >= deadline or (
+                    dm_cluster is not None and await self.bot.redis.get(DM_CLUSTER_KEY) != dm_cluster
+                ):
+                    action = {"type": "pass", "text": self.bot._("action-pass-text")}
+                    waited = None
+                    break
+
+        if waited is not None:
+            self.bot.log.info(
+                "battle.move_round_trip",
+                latency_ms=int(time.time() * 1000) - request["requested_at"] - waited,
+                dm_cluster=int(dm_cluster) if dm_cluster is not None else self.bot.cluster_idx,
+            )
 
         await self.user.send(self.bot._("selected-action", jumpUrl=message.jump_url, action=action["text"]))
 
@@ -119,7 +140,7 @@ class Battle:
         self.trainers = [Trainer(x, ctx.bot) for x in users]
         self.channel = ctx.channel
         self.stage = Stage.SELECT
-        self.passed_turns = 0
+        self.engine = BattleEngine(self.trainers)
         self.ctx = ctx
         self.bot = ctx.bot
         self.manager = manager
@@ -177,20 +198,13 @@ class Battle:
             return
 
         actions = await asyncio.gather(self.trainers[0].get_action(message), self.trainers[1].get_action(message))
+        steps = self.engine.resolve_turn(actions)
 
-        if actions[0]["type"] == "pass" and actions[1]["type"] == "pass":
-            self.passed_turns += 1
-
-        if self.passed_turns >= 3:
+        if self.engine.passed_turns >= MAX_PASSED_TURNS:
             await self.channel.send(self.ctx._("trainers-repeatedly-passing"))
             self.end()
             return
 
-        iterl = list(zip(actions, self.trainers, reversed(self.trainers)))
-
-        for action, trainer, opponent in iterl:
-            action["priority"] = get_priority(action, trainer.selected)
-
         embed = self.bot.Embed(
             title=self.ctx._(
                 "battle-between",
@@ -200,17 +214,13 @@ class Battle:
         )
         embed.set_footer(text=self.ctx._("next-round-begins-in", seconds=5))
 
-        for trainer in self.trainers:
-            if "Burn" in trainer.selected.ailments:
-                trainer.selected.hp -= 1 / 16 * trainer.selected.max_hp
-            if "Poison" in trainer.selected.ailments:
-                trainer.selected.hp -= 1 / 8 * trainer.selected.max_hp
-
-        for action, trainer, opponent in sorted(iterl, key=lambda x: x[0]["priority"], reverse=True):
+        for step in steps:
+            trainer = self.trainers[step.side]
+            opponent = self.trainers[1 - step.side]
             title = None
             text = None
 
-            if action["type"] == "flee":
+            if step.kind == "flee":
                 # battle's over
                 await self.channel.send(
                     self.ctx._("opponent-has-fled", opponent=opponent.user.mention, fleeingTrainer=trainer.user.mention)
@@ -219,42 +229,32 @@ class Battle:
                 self.end()
                 return
 
-            elif action["type"] == "switch":
-                trainer.selected_idx = action["value"]
+            elif step.kind == "switch":
                 title = self.ctx._("switched-pokemon-title", trainer=trainer.user.display_name)
-                text = self.ctx._("switched-pokemon-text", pokemon=str(trainer.selected.species))
-
-            elif action["type"] == "move":
-                # calculate damage amount
-
-                move = action["value"]
+                text = self.ctx._("switched-pokemon-text", pokemon=str(step.battler.species))
 
-                result = move.calculate_turn(trainer.selected, opponent.selected)
+            elif step.kind == "move":
+                move = step.move
+                result = step.result
 
-                title = self.ctx._("trainer-used-move", move=move.name, pokemon=str(trainer.selected.species))
+                title = self.ctx._("trainer-used-move", move=move.name, pokemon=str(step.battler.species))
                 text = "\n".join([self.ctx._("dealt-damage", damage=result.damage, move=move.name)] + result.messages)
 
                 if result.success:
-                    opponent.selected.hp -= result.damage
-                    trainer.selected.hp += result.healing
-                    trainer.selected.hp = min(trainer.selected.hp, trainer.selected.max_hp)
-
                     if result.healing > 0:
                         text += "\n" + self.ctx._(
-                            "restored-hp", pokemon=str(trainer.selected.species), healed=result.healing
+                            "restored-hp", pokemon=str(step.battler.species), healed=result.healing
                         )
                     elif result.healing < 0:
                         text += "\n" + self.ctx._(
-                            "took-damage", pokemon=str(trainer.selected.species), damage=-result.healing
+                            "took-damage", pokemon=str(step.battler.species), damage=-result.healing
                         )
 
                     if result.ailment:
                         text += "\n" + self.ctx._("ailment-inflicted", ailment=result.ailment)
-                        opponent.selected.ailments.add(result.ailment)
 
                     for change in result.stat_changes:
                         if move.target_id == 7:
-                            target = trainer.selected
                             if change.change < 0:
                                 text += "\n" + self.ctx._(
                                     "lowered-user-stat", stat=constants.STAT_NAMES[change.stat], change=-change.change
@@ -265,7 +265,6 @@ class Battle:
                                 )
 
                         else:
-                            target = opponent.selected
                             if change.change < 0:
                                 text += "\n" + self.ctx._(
                                     "lowered-opponent-stat",
@@ -277,35 +276,20 @@ class Battle:
                                     "raised-opponent-stat", change=change.change, stat=constants.STAT_NAMES[change.stat]
                                 )
 
-                        setattr(
-                            target.stages,
-                            change.stat,
-                            getattr(target.stages, change.stat) + change.change,
-                        )
-
                 else:
                     text = "It missed!"
 
-            # check if fainted
-
-            if opponent.selected.hp <= 0:
-                opponent.selected.hp = 0
+            if step.fainted is not None:
                 title = title or self.ctx._("fainted")
-                text = (text or "") + self.ctx._("pokemon-has-fainted", pokemon=str(opponent.selected.species))
+                text = (text or "") + self.ctx._("pokemon-has-fainted", pokemon=str(step.fainted.species))
 
-                try:
-                    opponent.selected_idx = next(idx for idx, x in enumerate(opponent.pokemon) if x.hp > 0)
-                except StopIteration:
+                if self.engine.over:
                     # battle's over
                     self.end()
-                    opponent.selected_idx = -1
                     self.bot.dispatch("battle_win", self, trainer.user)
                     await self.channel.send(self.ctx._("won-battle", victor=trainer.user.mention))
                     return
 
-                embed.add_field(name=title, value=text, inline=False)
-                break
-
             if title is not None:
                 embed.add_field(name=title, value=text, inline=False)
 
@@ -414,50 +398,48 @@ class Battling(commands.Cog):
         if not hasattr(self.bot, "battles"):
             self.bot.battles = BattleManager()
 
-        self.process_move_decisions.start()
-        if self.bot.cluster_idx == 0:
-            self.process_move_requests.start()
+        self.bot.loop.create_task(self.subscribe())
 
     def reload_battling(self):
         for battle in self.bot.battles.battles.values():
             battle.stage = Stage.END
         self.bot.battles = BattleManager()
 
-    @tasks.loop(seconds=0.1)
-    async def process_move_requests(self):
-        with await self.bot.redis as r:
-            req = await r.blpop("move_request")
-            data = pickle.loads(req[1])
-            self.bot.dispatch(
-                "move_request",
-                data["cluster_idx"],
-                data["user_id"],
-                data["species_id"],
-                data["actions"],
-            )
-
-    @process_move_requests.before_loop
-    async def before_process_move_requests(self):
+    async def subscribe(self):
         await self.bot.wait_until_ready()
+        self.bot.bus.subscribe("move_decide", self.handle_move_decide, cluster=self.bot.cluster_idx)
+        if self.has_dm_shard:
+            self.bot.bus.subscribe("move_request", self.handle_move_request, cluster=self.bot.cluster_idx)
+            self.announce_dm_cluster.start()
 
-    @tasks.loop(seconds=0.1)
-    async def process_move_decisions(self):
-        with await self.bot.redis as r:
-            req = await r.blpop(f"move_decide:{self.bot.cluster_idx}")
-            data = pickle.loads(req[1])
-            self.bot.dispatch(
-                "move_decide",
-                data["user_id"],
-                data["action"],
-            )
+    @property
+    def has_dm_shard(self):
+        return self.bot.shard_ids is None or 0 in self.bot.shard_ids
+
+    @tasks.loop(seconds=DM_CLUSTER_HEARTBEAT)
+    async def announce_dm_cluster(self):
+        await self.bot.redis.set(DM_CLUSTER_KEY, self.bot.cluster_idx, expire=DM_CLUSTER_TTL)
+
+    async def handle_move_request(self, data):
+        self.bot.dispatch("move_request", data)
+
+    async def handle_move_decide(self, data):
+        self.bot.dispatch(
+            "move_decide",
+            data["user_id"],
+            data["action"],
+            data["requested_at"],
+            data["waited"],
+        )
 
-    @process_move_decisions.before_loop
-    async def before_process_move_decisions(self):
-        await self.bot.wait_until_ready()
+    async def ask_for_action(self, request):
+        """DMs the trainer the actions they can take, and returns the one they
+        pick, through a reaction or a command.
+        """
 
-    @commands.Cog.listener()
-    async def on_move_request(self, cluster_idx, user_id, species_id, actions):
-        species = self.bot.data.species_by_number(species_id)
+        user_id = request["user_id"]
+        actions = request["actions"]
+        species = self.bot.data.species_by_number(request["species_id"])
 
         embed = self.bot.Embed(title=self.bot._("move-request-cta", pokemon=str(species)))
 
@@ -480,7 +462,7 @@ class Battling(commands.Cog):
 
         async def listen_for_reactions():
             try:
-                payload = await self.bot.wait_for("raw_reaction_add", timeout=35, check=check)
+                payload = await self.bot.wait_for("raw_reaction_add", timeout=MOVE_REQUEST_TIMEOUT, check=check)
                 action = actions[payload.emoji.name]
                 self.bot.dispatch("battle_move", user_id, action["command"])
             except asyncio.TimeoutError:
@@ -488,22 +470,41 @@ class Battling(commands.Cog):
 
         self.bot.loop.create_task(listen_for_reactions())
 
-        try:
-            while True:
-                _, move_name = await self.bot.wait_for("battle_move", timeout=35, check=lambda u, m: u == user_id)
-                try:
-                    action = next(x for x in actions.values() if x["command"].lower() == move_name.lower())
-                except StopIteration:
-                    await self.bot.send_dm(user_id, self.bot._("move-request-invalid-move"))
-                else:
-                    break
-        except asyncio.TimeoutError:
-            action = {"type": "pass", "text": self.bot._("action-pass-text")}
+        while True:
+            _, move_name = await self.bot.wait_for(
+                "battle_move", timeout=MOVE_REQUEST_TIMEOUT, check=lambda u, m: u == user_id
+            )
+            try:
+                return next(x for x in actions.values() if x["command"].lower() == move_name.lower())
+            except StopIteration:
+                await self.bot.send_dm(user_id, self.bot._("move-request-invalid-move"))
 
-        await self.bot.redis.rpush(
-            f"move_decide:{cluster_idx}",
-            pickle.dumps({"user_id": user_id, "action": action}),
-        )
+    @commands.Cog.listener()
+    async def on_move_request(self, request):
+        received_at = int(time.time() * 1000)
+        user_id = request["user_id"]
+
+        if received_at - request["requested_at"] > MOVE_REQUEST_TIMEOUT * 1000:
+            # Redelivered after a restart, and the battle has most likely moved
+            # on already, so the trainer passes.
+            action = {"type": "pass", "text": self.bot._("action-pass-text")}
+        else:
+            try:
+                action = await self.ask_for_action(request)
+            except (asyncio.TimeoutError, discord.HTTPException):
+                # They didn't pick in time, or can't be DMed, so they pass.
+                action = {"type": "pass", "text": self.bot._("action-pass-text")}
+
+        decision = {
+            "user_id": user_id,
+            "action": action,
+            "requested_at": request["requested_at"],
+            "waited": int(time.time() * 1000) - received_at,
+        }
+        if request["cluster_idx"] == self.bot.cluster_idx:
+            self.bot.dispatch("move_decide", user_id, action, decision["requested_at"], decision["waited"])
+        else:
+            await self.bot.bus.publish("move_decide", decision, cluster=request["cluster_idx"])
 
     @checks.has_started()
     @in_battle(False)
@@ -578,10 +579,7 @@ class Battling(commands.Cog):
                     await ctx.send(ctx._("pokemon-already-in-party", index=pokemon.idx))
                     return
 
-            pokemon.hp = pokemon.hp
-            pokemon.stages = models.StatStages()
-            pokemon.ailments = set()
-            trainer.pokemon.append(pokemon)
+            trainer.pokemon.append(Battler.from_pokemon(pokemon))
 
             if len(trainer.pokemon) == 3:
                 trainer.done = True
@@ -751,8 +749,10 @@ class Battling(commands.Cog):
         await ctx.send(ctx._("battle-canceled"))
 
     def cog_unload(self):
-        if self.bot.cluster_idx == 0:
-            self.process_move_requests.cancel()
+        self.bot.bus.unsubscribe("move_decide", cluster=self.bot.cluster_idx)
+        if self.has_dm_shard:
+            self.bot.bus.unsubscribe("move_request", cluster=self.bot.cluster_idx)
+            self.announce_dm_cluster.cancel()
 
 
 async def setup(bot: commands.Bot):
@@ -1,4 +1,3 @@
-import pickle
 import random
 import sys
 import traceback
@@ -11,7 +10,7 @@ import humanfriendly
 from discord.channel import TextChannel
 from discord.ext import commands, flags, tasks
 
-from helpers import checks, constants, converters
+from helpers import checks, constants, converters, metrics
 from helpers.views import ConfirmTermsOfServiceView
 
 GENERAL_CHANNEL_NAMES = {"welcome", "general", "lounge", "chat", "talk", "main"}
@@ -32,7 +31,7 @@ class Bot(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         headers = {"Authorization": self.bot.config.DBL_TOKEN}
-        self.dbl_session = aiohttp.ClientSession(headers=headers)
+        self.dbl_session = aiohttp.ClientSession(headers=headers, trace_configs=[metrics.http_trace_config()])
 
         self.post_count.start()
 
@@ -41,7 +40,7 @@ class Bot(commands.Cog):
             self.remind_votes.start()
 
         self.cd = commands.CooldownMapping.from_cooldown(5, 3, commands.BucketType.user)
-        self.bot.loop.create_task(self.process_dms())
+        self.bot.loop.create_task(self.subscribe())
 
     async def bot_check(self, ctx):
         if ctx.invoked_with.lower() == "help":
@@ -53,13 +52,12 @@ class Bot(commands.Cog):
 
         return True
 
-    async def process_dms(self):
+    async def subscribe(self):
         await self.bot.wait_until_ready()
-        with await self.bot.redis as r:
-            while True:
-                req = await r.blpop("send_dm")
-                uid, content = pickle.loads(req[1])
-                self.bot.loop.create_task(self.bot.send_dm(uid, content))
+        self.bot.bus.subscribe("send_dm", self.handle_send_dm)
+
+    async def handle_send_dm(self, data):
+        self.bot.loop.create_task(self.bot.send_dm(data["user_id"], data["content"]))
 
     @commands.Cog.listener()
     async def on_message_edit(self, before, after):
@@ -398,26 +396,19 @@ class Bot(commands.Cog):
         """View your profile."""
 
         member = await self.bot.mongo.fetch_member_info(ctx.author)
-
-        pokemon_caught = []
-        pokemon_caught.append(
-            ctx._("profile-caught-category-total", amount=await self.bot.mongo.fetch_pokedex_sum(ctx.author))
-        )
-
-        for name, filt in (
-            ("mythical", self.bot.data.list_mythical),
-            ("legendary", self.bot.data.list_legendary),
-            ("ultra-beast", self.bot.data.list_ub),
-        ):
-            pokemon_caught.append(
-                ctx._(
-                    f"profile-caught-category-{name}",
-                    amount=await self.bot.mongo.fetch_pokedex_sum(
-                        ctx.author,
-                        [{"$match": {"k": {"$in": [str(x) for x in filt]}}}],
-                    ),
-                )
+        if self.bot.mongo.pokedex_counts_stale(member):
+            await self.bot.mongo.reconcile_pokedex_counts([ctx.author.id])
+            member = await self.bot.mongo.fetch_member_info(ctx.author)
+
+        pokemon_caught = [
+            ctx._(f"profile-caught-category-{name}", amount=member.pokedex_counts.get(key, 0))
+            for name, key in (
+                ("total", "total"),
+                ("mythical", "mythical"),
+                ("legendary", "legendary"),
+                ("ultra-beast", "ub"),
             )
+        ]
 
         pokemon_caught.append(ctx._("profile-caught-category-shiny", amount=member.shinies_caught))
 
@@ -440,6 +431,7 @@ class Bot(commands.Cog):
         await ctx.send(embed=embed)
 
     def cog_unload(self):
+        self.bot.bus.unsubscribe("send_dm")
         self.post_count.cancel()
 
         if self.bot.cluster_idx == 0 and self.bot.config.DBL_TOKEN is not None:
@@ -265,6 +265,7 @@ class Christmas(commands.Cog):
         await self.bot.mongo.update_member(ctx.author, update)
         if len(inserts) > 0:
             await self.bot.mongo.db.pokemon.insert_many(inserts)
+            await self.bot.mongo.bump_collection_version(ctx.author)
 
         embed = self.bot.Embed(title=f"Opened {amount}x {NAMES[type]}...", description="\n".join(text))
         embed.set_author(icon_url=ctx.author.display_avatar.url, name=str(ctx.author))
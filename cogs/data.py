@@ -1,8 +1,10 @@
+import functools
 from importlib import reload
 
 from discord.ext import commands
 
 import data
+from helpers import data_snapshot
 
 
 class Data(commands.Cog):
@@ -11,7 +13,19 @@ class Data(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
         reload(data)
-        self.instance = data.DataManager(getattr(bot.config, "ASSETS_BASE_URL", None))
+
+    async def cog_load(self):
+        # Loading the game data takes a while, so this is done in another
+        # thread, while other cogs load.
+        self.instance, _ = await self.bot.loop.run_in_executor(
+            None,
+            functools.partial(
+                data_snapshot.load_or_parse,
+                getattr(self.bot.config, "ASSETS_BASE_URL", None),
+                getattr(self.bot.config, "DATA_SNAPSHOT_PATH", None) or data_snapshot.DEFAULT_PATH,
+                log=self.bot.log,
+            ),
+        )
 
 
 async def setup(bot: commands.Bot):
@@ -256,6 +256,7 @@ class Halloween(commands.Cog):
                     "idx": await self.bot.mongo.fetch_next_idx(ctx.author),
                 }
             )
+            await self.bot.mongo.bump_collection_version(ctx.author)
             message += f" Use `{ctx.clean_prefix}info latest` to view it!"
 
         elif item["action"] == "badge":
@@ -314,6 +315,7 @@ class Halloween(commands.Cog):
                 text.append(f"{self.bot.mongo.Pokemon.build_from_mongo(pokemon):lni} ({sum(ivs) / 186:.2%} IV)")
 
                 await self.bot.mongo.db.pokemon.insert_one(pokemon)
+                await self.bot.mongo.bump_collection_version(ctx.author)
 
             await self.bot.mongo.update_member(ctx.author, {"$inc": {"premium_balance": shards}})
 
@@ -147,6 +147,7 @@ class Halloween(commands.Cog):
             text = f"{self.bot.mongo.Pokemon.build_from_mongo(pokemon):lni} ({sum(ivs) / 186:.2%} IV)"
 
             await self.bot.mongo.db.pokemon.insert_one(pokemon)
+            await self.bot.mongo.bump_collection_version(ctx.author)
 
         else:
             text = "Nothing"
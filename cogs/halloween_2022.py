@@ -144,6 +144,7 @@ class Halloween(commands.Cog):
             {"owner_id": ctx.author.id, "_id": {"$in": list(ids)}},
             {"$set": {"owned_by": "offered"}},
         )
+        await self.bot.mongo.bump_collection_version(ctx.author)
         await self.bot.mongo.update_member(ctx.author, {"$inc": {"halloween_tickets_2022": result.modified_count}})
         await ctx.send(
             f"You offered {result.modified_count} pokémon. You received {result.modified_count:,} **🎫 Trick-or-Treat Tickets**!"
@@ -245,6 +246,7 @@ class Halloween(commands.Cog):
             {"owner_id": ctx.author.id, "_id": {"$in": [x.id async for x in pokemon]}},
             {"$set": {"owned_by": "offered"}},
         )
+        await self.bot.mongo.bump_collection_version(ctx.author)
 
         await self.bot.mongo.update_member(ctx.author, {"$inc": {"halloween_tickets_2022": result.modified_count}})
 
@@ -334,6 +336,7 @@ class Halloween(commands.Cog):
         await self.bot.mongo.update_member(ctx.author, update)
         if len(inserts) > 0:
             await self.bot.mongo.db.pokemon.insert_many(inserts)
+            await self.bot.mongo.bump_collection_version(ctx.author)
 
         if len(text) == 1:
             embed = self.bot.Embed(title=text[0][0], description=text[0][1])
@@ -1,10 +1,19 @@
 __all__ = ("Lang", "setup")
 
-from typing import Any, Tuple, cast
+import functools
+import threading
+from collections import OrderedDict
+from contextvars import ContextVar
+from typing import Any, Callable, Tuple, cast
 
+from babel import Locale
+import discord
 from discord.ext import commands
-from fluent.runtime import FluentResourceLoader, FluentLocalization, FluentBundle
-from fluent.runtime.resolver import Message
+from fluent.runtime import FluentResourceLoader, FluentLocalization, FluentBundle, resolver
+from fluent.runtime.resolver import MAX_PART_LENGTH, Message, Pattern
+from fluent.runtime.types import FluentType
+from fluent.runtime.utils import native_to_fluent
+from fluent.syntax.ast import BaseNode
 import structlog
 
 # The listing of all Fluent localization files to load.
@@ -26,16 +35,250 @@ FLUENT_FILES = (
     "admin.ftl",
 )
 
+# The locale every other locale falls back to, which is always loaded.
+DEFAULT_LOCALE = "en-US"
+
+DEFAULT_PREFIX = "@Pokétwo "
+
+# How much memory the loaded locales may take up, in bytes, before the least
+# recently used ones are evicted.
+LANG_MEMORY_BUDGET = 64 * 1024 * 1024
+
+# Parsed and compiled, a locale takes up roughly this many times the size of
+# its Fluent source.
+LOCALE_SIZE_FACTOR = 64
+
+# The attributes of a message that ``localized_embed`` copies onto the embed.
+PASSTHROUGH_FIELDS = ("title", "description", "url", "footer-text")
+
+# How many formatted numbers to keep around.
+NUMBER_CACHE_SIZE = 4096
+
+FormatResult = Tuple[str, list[Exception]]
+Formatter = Callable[[dict[str, Any] | None], FormatResult]
+
+# The locale to format messages in, and the prefix the COMMAND function formats
+# commands with. These are context-local, so each command formats messages for
+# whoever ran it, even when many run concurrently.
+current_locale: ContextVar[str] = ContextVar("current_locale", default=DEFAULT_LOCALE)
+current_prefix: ContextVar[str] = ContextVar("current_prefix", default=DEFAULT_PREFIX)
+
+
+def _is_static(bundle: FluentBundle, node: Any, seen: set[int]) -> bool:
+    """Returns whether a resolver node formats the same regardless of the
+    variables it's given, ie. it doesn't use any variables or functions, and
+    neither do any messages or terms it references.
+    """
+    if isinstance(node, (resolver.VariableReference, resolver.FunctionReference)):
+        return False
+
+    if isinstance(node, (resolver.MessageReference, resolver.TermReference)):
+        if getattr(node, "arguments", None):
+            return False
+        try:
+            entry = bundle._lookup(node.id.name, term=isinstance(node, resolver.TermReference))
+            pattern = entry.attributes[node.attribute.name] if node.attribute else entry.value
+        except LookupError:
+            return False
+        if pattern is None:
+            return False
+        if id(pattern) in seen:
+            return True
+        seen.add(id(pattern))
+        return _is_static(bundle, pattern, seen)
+
+    if isinstance(node, list):
+        return all(_is_static(bundle, x, seen) for x in node)
+
+    if isinstance(node, BaseNode):
+        return all(_is_static(bundle, x, seen) for x in vars(node).values())
+
+    return True
+
+
+@functools.lru_cache(maxsize=NUMBER_CACHE_SIZE)
+def _format_number(kind: type, value: int | float, locale: Locale) -> str:
+    # Formatting numbers through Babel is slow, and the same ones come up a lot.
+    return native_to_fluent(value).format(locale)
+
+
+def compile_pattern(bundle: FluentBundle, pattern: Pattern) -> Formatter:
+    """Compiles a Fluent pattern into a function that formats it with a dict of
+    variables, returning the result and any errors like ``format_pattern``.
+
+    Patterns that don't depend on their variables are formatted once, here.
+    Patterns made of text, variables and such static references are formatted
+    by joining strings. Anything else, like select expressions and function
+    calls, goes through the Fluent resolver as usual.
+    """
+
+    def resolve(args: dict[str, Any] | None) -> FormatResult:
+        return bundle.format_pattern(pattern, args)
+
+    if _is_static(bundle, pattern, set()):
+        value, errors = bundle.format_pattern(pattern)
+        if errors:
+            return resolve
+        result = (cast(str, value), [])
+        return lambda args: result
+
+    # Each part is either a string, or a 1-tuple of a variable name.
+    parts: list[str | tuple[str]] = []
+    # The Fluent compiler collapses patterns with a single element into just
+    # that element.
+    elements = pattern.elements if isinstance(pattern, resolver.Pattern) else [pattern]
+
+    for element in elements:
+        if isinstance(element, resolver.TextElement):
+            part = element.value
+        elif isinstance(expression := getattr(element, "expression", element), resolver.VariableReference):
+            if bundle.use_isolating:
+                return resolve
+            part = (expression.id.name,)
+        elif _is_static(bundle, element, set()):
+            part, errors = bundle.format_pattern(resolver.Pattern([element]))
+            if errors:
+                return resolve
+        else:
+            return resolve
+
+        if parts and isinstance(part, str) and isinstance(parts[-1], str):
+            parts[-1] += part
+        else:
+            parts.append(part)
+
+    locale = bundle._babel_locale
+
+    def format(args: dict[str, Any] | None) -> FormatResult:
+        out = []
+        for part in parts:
+            if type(part) is str:
+                out.append(part)
+                continue
+            try:
+                value = args[part[0]]
+            except (KeyError, TypeError):
+                return resolve(args)
+            if type(value) in (int, float):
+                value = _format_number(type(value), value, locale)
+            elif type(value) is not str:
+                value = native_to_fluent(value)
+                if not isinstance(value, FluentType):
+                    return resolve(args)
+                value = value.format(locale)
+            if len(value) > MAX_PART_LENGTH:
+                return resolve(args)
+            out.append(value)
+        return "".join(out), []
+
+    return format
+
+
+class EmbedLayout:
+    """The attributes of a message that ``localized_embed`` uses, compiled:
+    the passthrough attributes present, and the name and value of each field,
+    in the order they're defined.
+    """
+
+    __slots__ = ("passthrough", "fields", "_orders")
+
+    def __init__(self, bundle: FluentBundle, message: Message):
+        self.passthrough = [
+            (field, compile_pattern(bundle, message.attributes[field]))
+            for field in PASSTHROUGH_FIELDS
+            if field in message.attributes
+        ]
+        self.fields: dict[str, dict[str, Formatter]] = {}
+        for key, pattern in message.attributes.items():
+            if key.startswith("field-"):
+                name = key[key.find("-") + 1 : key.rfind("-")]
+                self.fields.setdefault(name, {})[key[key.rfind("-") + 1 :]] = compile_pattern(bundle, pattern)
+        self._orders: dict[tuple[tuple[str, ...], tuple[str, ...]], list[str]] = {}
+
+    def field_names(self, ignored_fields: list[str], field_ordering: list[str]) -> list[str]:
+        """Returns the names of the fields to add, in order. Raises
+        ``ValueError`` if ``field_ordering`` is missing one of them.
+        """
+        key = (tuple(ignored_fields), tuple(field_ordering))
+        try:
+            return self._orders[key]
+        except KeyError:
+            pass
+
+        names = [x for x in self.fields if x not in ignored_fields]
+        if field_ordering:
+            names.sort(key=field_ordering.index)
+        self._orders[key] = names
+        return names
+
+
+class CompiledBundle(FluentBundle):
+    """A ``FluentBundle`` that compiles its messages and attributes into
+    formatters once all of its resources have been added, see
+    ``compile_pattern``. Embed layouts are compiled when first used.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.formatters: dict[str, Formatter] | None = None
+        self._embed_layouts: dict[str, EmbedLayout] = {}
+
+    def compile(self) -> None:
+        if self.formatters is not None:
+            return
+
+        formatters = {}
+        for msg_id in self._messages:
+            msg = self.get_message(msg_id)
+            if msg.value:
+                formatters[msg_id] = compile_pattern(self, msg.value)
+            for name, pattern in msg.attributes.items():
+                if pattern:
+                    formatters[f"{msg_id}.{name}"] = compile_pattern(self, pattern)
+        self.formatters = formatters
+
+    def get_embed_layout(self, msg_id: str) -> EmbedLayout:
+        try:
+            return self._embed_layouts[msg_id]
+        except KeyError:
+            pass
+
+        layout = self._embed_layouts[msg_id] = EmbedLayout(self, self.get_message(msg_id))
+        return layout
+
 
 class Fluent(FluentLocalization):
     """A subclass of ``python-fluent``'s ``FluentLocalization`` class that
     enables quick message attribute lookups via dot syntax (like
     ``message.attribute``). This isn't normally possible with the base class
     implementation.
+
+    Every message and attribute is compiled into a formatter when loaded, see
+    ``compile_pattern``. Bundles that are already loaded, like those shared
+    between locales by ``LocalePool``, may be passed in as ``bundles``.
     """
 
     _log: structlog.BoundLogger = structlog.get_logger()
 
+    def __init__(self, *args: Any, bundles: list[CompiledBundle] | None = None, **kwargs: Any):
+        kwargs.setdefault("bundle_class", CompiledBundle)
+        super().__init__(*args, **kwargs)
+        if bundles is not None:
+            self._bundle_cache = list(bundles)
+            self._bundle_it = iter(())
+        self._formatters: dict[str, list[Formatter]] = {}
+        self._embed_layouts: dict[str, EmbedLayout | None] = {}
+        self.compile()
+
+    def compile(self) -> None:
+        """Compiles every bundle. For each message ID, the formatters are kept
+        in fallback order.
+        """
+        for bundle in self._bundles():
+            bundle.compile()
+            for key, formatter in bundle.formatters.items():
+                self._formatters.setdefault(key, []).append(formatter)
+
     def get_message(self, msg_id: str) -> Tuple[Message, FluentBundle] | None:
         """Looks up a message by ID from all bundles.
 
@@ -47,6 +290,19 @@ class Fluent(FluentLocalization):
 
             return (bundle.get_message(msg_id), bundle)
 
+    def get_embed_layout(self, msg_id: str) -> EmbedLayout | None:
+        """Returns the compiled embed layout of a message, or ``None`` if the
+        message wasn't found.
+        """
+        try:
+            return self._embed_layouts[msg_id]
+        except KeyError:
+            pass
+
+        result = self.get_message(msg_id)
+        layout = self._embed_layouts[msg_id] = result and result[1].get_embed_layout(msg_id)
+        return layout
+
     def format_value(self, msg_id: str, args: dict[str, Any] | None = None) -> str:
         """Looks up a message by ID from all bundles, supporting dotted access
         for attributes.
@@ -56,32 +312,158 @@ class Fluent(FluentLocalization):
 
         If the message wasn't found, then the message ID itself is returned.
         """
-        base_msg_id = msg_id
-        attribute_name: str | None = None
-        if "." in msg_id:
-            base_msg_id, attribute_name = msg_id.split(".")
+        for formatter in self._formatters.get(msg_id, ()):
+            val, errors = formatter(args)
 
-        for bundle in self._bundles():
-            if not bundle.has_message(base_msg_id):
+            if errors:
+                self._log.error("fluent error", errors=errors)
                 continue
 
-            msg = bundle.get_message(base_msg_id)
+            return val
+        return msg_id
+
 
-            value = msg.value
-            if attribute_name is not None:
-                value = msg.attributes[attribute_name]
+def fallback_chain(locale: str) -> list[str]:
+    """Returns the locales messages are looked up in for a locale, in order:
+    the locale itself, each less specific locale, and then the default locale.
+    """
+    parts = locale.split("-")
+    chain = ["-".join(parts[:i]) for i in range(len(parts), 0, -1)]
+    chain = list(dict.fromkeys([*chain, DEFAULT_LOCALE]))
+    return chain[: chain.index(DEFAULT_LOCALE) + 1]
 
-            if not value:
-                continue
 
-            val, errors = bundle.format_pattern(value, args)
+class LocalePool:
+    """Loads each locale's Fluent resources the first time it's used, and
+    keeps the loaded locales within a memory budget, evicting the least
+    recently used first. The default locale is never evicted.
 
-            if errors:
-                self._log.error("fluent error", errors=errors)
+    Each locale is parsed and compiled once, into bundles that are shared by
+    the localizations of every locale that falls back to it. Locales may be
+    loaded from another thread, so as not to block the event loop.
+    """
+
+    _log: structlog.BoundLogger = structlog.get_logger()
+
+    def __init__(
+        self,
+        resource_ids: list[str],
+        resource_loader: FluentResourceLoader,
+        *,
+        functions: dict[str, Callable[..., Any]] | None = None,
+        budget: int = LANG_MEMORY_BUDGET,
+    ):
+        self.resource_ids = resource_ids
+        self.resource_loader = resource_loader
+        self.functions = functions
+        self.budget = budget
+        self.nbytes = 0
+        self._locales: OrderedDict[str, tuple[list[CompiledBundle], int]] = OrderedDict()
+        self._localizations: dict[str, Fluent] = {}
+        self._lock = threading.RLock()
+        self._last_used: Fluent | None = None
+        self.get(DEFAULT_LOCALE)
+
+    def __contains__(self, locale: str) -> bool:
+        return locale in self._localizations
+
+    def get(self, locale: str) -> Fluent:
+        """Returns the localization for a locale, loading it and the locales
+        it falls back to if they aren't already.
+        """
+        fluent = self._localizations.get(locale)
+        if fluent is not None:
+            if fluent is not self._last_used:
+                self._touch(fluent)
+            return fluent
+
+        chain = fallback_chain(locale)
+
+        while True:
+            loaded = {x: self._load(x, chain) for x in chain if x not in self._locales}
+
+            with self._lock:
+                for x, (bundles, nbytes) in loaded.items():
+                    if x not in self._locales:
+                        self._locales[x] = (bundles, nbytes)
+                        self.nbytes += nbytes
+
+                # Another thread may have evicted part of the chain meanwhile.
+                if any(x not in self._locales for x in chain):
+                    continue
+
+                fluent = self._localizations[locale] = Fluent(
+                    chain,
+                    self.resource_ids,
+                    self.resource_loader,
+                    functions=self.functions,
+                    bundles=[bundle for x in chain for bundle in self._locales[x][0]],
+                )
+                self._touch(fluent)
+                self._evict(keep=chain)
+                return fluent
+
+    def _touch(self, fluent: Fluent) -> None:
+        with self._lock:
+            for x in fluent.locales:
+                if x in self._locales:
+                    self._locales.move_to_end(x)
+            self._last_used = fluent
+
+    def _load(self, locale: str, chain: list[str]) -> tuple[list[CompiledBundle], int]:
+        """Parses a locale's resources into compiled bundles, and returns them
+        with roughly how much memory they take up.
+        """
+        bundles = []
+        nbytes = 0
+        for resources in self.resource_loader.resources(locale, self.resource_ids):
+            bundle = CompiledBundle(chain[chain.index(locale) :], functions=self.functions, use_isolating=False)
+            for resource in resources:
+                bundle.add_resource(resource)
+                nbytes += resource.span.end * LOCALE_SIZE_FACTOR
+            bundle.compile()
+            bundles.append(bundle)
+        self._log.info("lang.loaded", locale=locale, nbytes=nbytes)
+        return bundles, nbytes
+
+    def _evict(self, keep: list[str]) -> None:
+        pinned = {*keep, *fallback_chain(DEFAULT_LOCALE)}
+        for locale in list(self._locales):
+            if self.nbytes <= self.budget:
+                break
+            if locale in pinned:
                 continue
 
-            return cast(str, val)
-        return msg_id
+            _, nbytes = self._locales.pop(locale)
+            self.nbytes -= nbytes
+            for key in [k for k, v in self._localizations.items() if locale in v.locales]:
+                del self._localizations[key]
+            self._log.info("lang.evicted", locale=locale, nbytes=nbytes)
+
+
+class Localized:
+    """Sets the current locale and prefix for the duration of a ``with`` block,
+    see ``Lang.localize``. A class rather than a generator based context
+    manager, since it's entered on every ``ctx._`` call.
+    """
+
+    __slots__ = ("locale", "prefix", "_tokens")
+
+    def __init__(self, locale: str, prefix: str):
+        self.locale = locale
+        self.prefix = prefix
+        self._tokens = None
+
+    def __enter__(self) -> None:
+        # Usually both are already set for the command being run.
+        if current_locale.get() != self.locale or current_prefix.get() != self.prefix:
+            self._tokens = (current_locale.set(self.locale), current_prefix.set(self.prefix))
+
+    def __exit__(self, *exc_info: Any) -> None:
+        if self._tokens is not None:
+            current_locale.reset(self._tokens[0])
+            current_prefix.reset(self._tokens[1])
+            self._tokens = None
 
 
 class Lang(commands.Cog):
@@ -94,15 +476,46 @@ class Lang(commands.Cog):
         # XXX: This is implemented here and not in Fluent itself for flexibility
         # reasons; a future iteration of this might want to format the result
         # dynamically in a way that Fluent won't be able to express.
-        return f"`{self._last_known_prefix}{command}`"
+        return f"`{current_prefix.get()}{command}`"
 
     def __init__(self, bot: commands.Bot):
         self.bot = bot
         self._fluent_loader = FluentResourceLoader(bot.config.LANG_ROOT)
-        self.fluent = Fluent(
-            ["en-US"], list(FLUENT_FILES), self._fluent_loader, functions={"COMMAND": self._fluent_command}
+
+    async def cog_load(self) -> None:
+        # Loading the default locale takes a while, so this is done in another
+        # thread, while other cogs load.
+        self.pool = await self.bot.loop.run_in_executor(
+            None,
+            functools.partial(
+                LocalePool,
+                list(FLUENT_FILES),
+                self._fluent_loader,
+                functions={"COMMAND": self._fluent_command},
+                budget=getattr(self.bot.config, "LANG_MEMORY_BUDGET", LANG_MEMORY_BUDGET),
+            ),
         )
-        self._last_known_prefix: str | None = "@Pokétwo "
+
+    @property
+    def fluent(self) -> Fluent:
+        """The localization for the current locale."""
+        return self.pool.get(current_locale.get())
+
+    def localize(self, locale: str | None, prefix: str) -> "Localized":
+        """Formats messages in a locale, or the default one if it's ``None``,
+        and with a command prefix, within a ``with`` block.
+        """
+        return Localized(locale or DEFAULT_LOCALE, prefix)
+
+    async def fetch_locale(self, user: discord.abc.User) -> str:
+        """Returns a user's preferred locale, from their cached member info,
+        and loads it in the background if it isn't already.
+        """
+        member = await self.bot.mongo.fetch_member_info(user)
+        locale = member and member.locale or DEFAULT_LOCALE
+        if locale not in self.pool:
+            await self.bot.loop.run_in_executor(None, self.pool.get, locale)
+        return locale
 
 
 async def setup(bot: commands.Bot):
@@ -1,9 +1,28 @@
-import asyncio
+import math
+from collections import defaultdict
+from datetime import datetime, timedelta
 
-from discord.ext import commands
+from bson.objectid import ObjectId
+from discord.ext import commands, tasks
 
+from cogs.mongo import MARKET_INDEX_FIELDS, PurchaseFailed
 from helpers import checks, constants, converters, flags, pagination
 
+# Price statistics keep the prices of this many most recent sales per species,
+# and sales volume for this many days.
+MARKET_STATS_SALES = 100
+MARKET_STATS_DAYS = 30
+MARKET_STATS_BATCH_SIZE = 5000
+
+# Log entries newer than this aren't processed yet, since entries inserted by
+# other clusters around the same time may not be ordered by _id.
+MARKET_STATS_DELAY = timedelta(seconds=30)
+
+
+def percentile(values, p):
+    """Returns the nearest-rank percentile of a sorted list."""
+    return values[max(0, math.ceil(p * len(values)) - 1)]
+
 
 class Market(commands.Cog):
     """A marketplace to buy and sell pokémon."""
@@ -11,6 +30,94 @@ class Market(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
 
+        if self.bot.cluster_idx == 0:
+            self.update_price_stats.start()
+
+    @tasks.loop(minutes=1)
+    async def update_price_stats(self):
+        while await self.process_price_stats_batch() == MARKET_STATS_BATCH_SIZE:
+            pass
+
+    async def process_price_stats_batch(self):
+        """Folds the next batch of market and auction sales from the logs into
+        the per-species price statistics. Returns the number of log entries read.
+        """
+
+        checkpoint = await self.bot.mongo.db.counter.find_one({"_id": "market_stats"})
+
+        query = {
+            "_id": {"$lt": ObjectId.from_datetime(datetime.utcnow() - MARKET_STATS_DELAY)},
+            "event": {"$in": ["market", "auction"]},
+        }
+        if checkpoint is not None:
+            query["_id"]["$gt"] = checkpoint["last_log_id"]
+
+        logs = await self.bot.mongo.db.logs.find(query).sort("_id", 1).limit(MARKET_STATS_BATCH_SIZE).to_list(None)
+        if len(logs) == 0:
+            return 0
+
+        # Older log entries don't have the species, so look it up from the pokémon.
+        missing = [x["item"] for x in logs if "species_id" not in x]
+        pokemon = {}
+        if len(missing) > 0:
+            async for x in self.bot.mongo.db.pokemon.find({"_id": {"$in": missing}}, {"species_id": 1, "shiny": 1}):
+                pokemon[x["_id"]] = x
+
+        sales = defaultdict(list)
+        for x in logs:
+            if "species_id" in x:
+                key = x["species_id"], bool(x.get("shiny"))
+            elif x["item"] in pokemon:
+                key = pokemon[x["item"]]["species_id"], bool(pokemon[x["item"]].get("shiny"))
+            else:
+                continue
+            # Entries can be inserted long after the sale, see helpers.audit_log,
+            # so _id is only the time for older ones.
+            sold_at = x.get("time") or x["_id"].generation_time.replace(tzinfo=None)
+            sales[key].append({"price": x["price"], "time": sold_at})
+
+        for (species_id, shiny), new_sales in sales.items():
+            await self.update_species_price_stats(species_id, shiny, new_sales)
+
+        await self.bot.mongo.db.counter.update_one(
+            {"_id": "market_stats"}, {"$set": {"last_log_id": logs[-1]["_id"]}}, upsert=True
+        )
+        return len(logs)
+
+    @update_price_stats.before_loop
+    async def before_update_price_stats(self):
+        await self.bot.wait_until_ready()
+
+    async def update_species_price_stats(self, species_id, shiny, new_sales):
+        key = {"species_id": species_id, "shiny": shiny}
+        stats = await self.bot.mongo.db.market_stats.find_one({"_id": key}) or {}
+
+        recent = [*stats.get("sales", []), *new_sales][-MARKET_STATS_SALES:]
+        prices = sorted(x["price"] for x in recent)
+
+        volume = dict(stats.get("volume", {}))
+        for x in new_sales:
+            day = x["time"].strftime("%Y-%m-%d")
+            volume[day] = volume.get(day, 0) + 1
+        cutoff = (datetime.utcnow() - timedelta(days=MARKET_STATS_DAYS)).strftime("%Y-%m-%d")
+
+        await self.bot.mongo.db.market_stats.replace_one(
+            {"_id": key},
+            {
+                "sales": recent,
+                "volume": {k: v for k, v in volume.items() if k >= cutoff},
+                "median": percentile(prices, 0.5),
+                "p10": percentile(prices, 0.1),
+                "p90": percentile(prices, 0.9),
+                "updated_at": datetime.utcnow(),
+            },
+            upsert=True,
+        )
+
+    def cog_unload(self):
+        if self.bot.cluster_idx == 0:
+            self.update_price_stats.cancel()
+
     @commands.group(aliases=("marketplace", "m"), invoke_without_command=True, case_insensitive=True)
     async def market(self, ctx, **flags):
         """Buy or sell pokémon on the Pokétwo marketplace."""
@@ -66,8 +173,8 @@ class Market(commands.Cog):
         """Search pokémon from the marketplace."""
 
         def map_field(field):
-            if field == "_id":
-                return f"market_data._id"
+            if field == "market_data.price":
+                return "price"
             return field
 
         aggregations = await self.bot.get_cog("Pokemon").create_filter(
@@ -83,12 +190,15 @@ class Market(commands.Cog):
             return " " * (len(str(n)) - len(str(p))) + str(p)
 
         def prepare_page(menu, items):
-            menu.maxn = max(x["market_data"]["_id"] for x in items)
+            menu.maxn = max(x["_id"] for x in items)
 
         def format_item(menu, x):
-            pokemon = self.bot.mongo.Pokemon.build_from_mongo(x)
-            return f"`{padn(x['market_data']['_id'], menu.maxn)}`　**{pokemon:li}**　•　{pokemon.iv_total / 186:.2%}　•　{x['market_data']['price']:,} pc"
+            pokemon = self.bot.mongo.Pokemon.build_from_mongo(
+                {"_id": x["pokemon_id"], **{k: x.get(k) for k in MARKET_INDEX_FIELDS}}
+            )
+            return f"`{padn(x['_id'], menu.maxn)}`　**{pokemon:li}**　•　{pokemon.iv_total / 186:.2%}　•　{x['price']:,} pc"
 
+        count = await self.bot.mongo.fetch_market_count(aggregations)
         pokemon = self.bot.mongo.fetch_market_list(aggregations)
 
         pages = pagination.ContinuablePages(
@@ -98,8 +208,8 @@ class Market(commands.Cog):
                 prepare_page=prepare_page,
                 format_item=format_item,
                 per_page=20,
+                count=count,
             ),
-            allow_last=False,
             allow_go=False,
         )
         self.bot.menus[ctx.author.id] = pages
@@ -160,15 +270,8 @@ class Market(commands.Cog):
         if counter is None:
             counter = {"next": 0}
 
-        pokemon_dict = await self.bot.mongo.db.pokemon.find_one_and_update(
-            {"_id": pokemon.id},
-            {
-                "$set": {
-                    "owned_by": "market",
-                    "market_data": {"_id": counter["next"], "price": price},
-                }
-            },
-        )
+        pokemon_dict = await self.bot.mongo.create_listing(pokemon.id, counter["next"], price)
+        await self.bot.mongo.bump_collection_version(ctx.author)
 
         self.bot.dispatch("market_add", ctx.author, pokemon_dict)
 
@@ -213,6 +316,8 @@ class Market(commands.Cog):
                 "$unset": {"market_data": 1},
             },
         )
+        await self.bot.mongo.db.market_index.delete_one({"_id": id})
+        await self.bot.mongo.bump_collection_version(ctx.author)
 
         await ctx.send(
             ctx._("market-remove-completed", ivPercentage=pokemon.iv_percentage * 100, pokemon=str(pokemon.species))
@@ -256,48 +361,14 @@ class Market(commands.Cog):
 
         # buy
 
-        listing = await self.bot.mongo.db.pokemon.find_one({"owned_by": "market", "market_data._id": id})
-        if listing is None:
-            return await ctx.send(ctx._("listing-no-longer-exists"))
-
-        member = await self.bot.mongo.fetch_member_info(ctx.author)
-        if member.balance < listing["market_data"]["price"]:
-            return await ctx.send(ctx._("not-enough-coins"))
-
-        # to try to avoid race conditions
-        await asyncio.sleep(1)
-
-        listing = await self.bot.mongo.db.pokemon.find_one({"owned_by": "market", "market_data._id": id})
-        if listing is None:
-            return await ctx.send(ctx._("listing-no-longer-exists"))
+        try:
+            listing = await self.bot.mongo.purchase_listing(ctx.author.id, id, listing["market_data"]["price"])
+        except PurchaseFailed as e:
+            return await ctx.send(ctx._(str(e)))
 
-        member = await self.bot.mongo.fetch_member_info(ctx.author)
-        if member.balance < listing["market_data"]["price"]:
-            return await ctx.send(ctx._("not-enough-coins"))
+        await self.bot.redis.hdel("db:member", ctx.author.id, listing["owner_id"])
+        await self.bot.mongo.bump_collection_version(ctx.author, listing["owner_id"])
 
-        listing = await self.bot.mongo.db.pokemon.find_one_and_update(
-            {"_id": listing["_id"], "owned_by": "market"},
-            {
-                "$set": {
-                    "owner_id": ctx.author.id,
-                    "owned_by": "user",
-                    "idx": await self.bot.mongo.fetch_next_idx(ctx.author),
-                },
-                "$unset": {"market_data": 1},
-            },
-        )
-        if listing is None:
-            return await ctx.send(ctx._("listing-no-longer-exists"))
-
-        res = await self.bot.mongo.db.member.find_one_and_update(
-            {"_id": ctx.author.id}, {"$inc": {"balance": -listing["market_data"]["price"]}}
-        )
-        await self.bot.redis.hdel("db:member", ctx.author.id)
-        if res["balance"] < listing["market_data"]["price"]:
-            await self.bot.mongo.update_member(ctx.author, {"$inc": {"balance": listing["market_data"]["price"]}})
-            return await ctx.send(ctx._("not-enough-coins"))
-
-        await self.bot.mongo.update_member(listing["owner_id"], {"$inc": {"balance": listing["market_data"]["price"]}})
         await ctx.send(
             ctx._(
                 "buy-completed",
@@ -321,19 +392,43 @@ class Market(commands.Cog):
 
         self.bot.dispatch("market_buy", ctx.author, listing)
 
-        try:
-            await self.bot.mongo.db.logs.insert_one(
-                {
-                    "event": "market",
-                    "user": ctx.author.id,
-                    "item": listing["_id"],
-                    "seller_id": listing["owner_id"],
-                    "price": listing["market_data"]["price"],
-                    "listing_id": listing["market_data"]["_id"],
-                }
-            )
-        except:
-            pass
+    @checks.has_started()
+    @commands.cooldown(3, 5, commands.BucketType.user)
+    @market.command(aliases=("st", "prices"))
+    async def stats(self, ctx, *, species: str):
+        """View recent sale prices of a pokémon on the marketplace."""
+
+        search, shiny = species, False
+        if search.lower().startswith("shiny "):
+            search, shiny = search[6:], True
+
+        species = self.bot.data.species_by_name(search)
+        if species is None:
+            return await ctx.send(ctx._("unknown-pokemon-matching", matching=search))
+
+        pokemon = f"✨ {species}" if shiny else str(species)
+        stats = await self.bot.mongo.db.market_stats.find_one({"_id": {"species_id": species.id, "shiny": shiny}})
+        if stats is None:
+            return await ctx.send(ctx._("no-market-stats", pokemon=pokemon))
+
+        today = datetime.utcnow()
+        days = [(today - timedelta(days=i)).strftime("%Y-%m-%d") for i in range(MARKET_STATS_DAYS)]
+
+        embed = ctx.localized_embed(
+            "market-stats-embed",
+            block_fields=["recent"],
+            pokemon=pokemon,
+            median=stats["median"],
+            low=stats["p10"],
+            high=stats["p90"],
+            recent=", ".join(f"{x['price']:,}" for x in reversed(stats["sales"][-5:])),
+            today=stats["volume"].get(days[0], 0),
+            week=sum(stats["volume"].get(x, 0) for x in days[:7]),
+            month=sum(stats["volume"].get(x, 0) for x in days),
+            count=len(stats["sales"]),
+        )
+        embed.color = constants.PINK
+        await ctx.send(embed=embed)
 
     @checks.has_started()
     @commands.cooldown(3, 5, commands.BucketType.user)
@@ -0,0 +1,42 @@
+from aiohttp import web
+from discord.ext import commands
+
+from helpers import metrics
+
+
+class Metrics(commands.Cog):
+    """For exposing metrics to Prometheus."""
+
+    def __init__(self, bot: commands.Bot):
+        self.bot = bot
+        self.runner = None
+
+    async def cog_load(self):
+        # Each cluster listens on its own port, offset from METRICS_PORT by its
+        # index, so that clusters on the same host don't clash.
+        port = getattr(self.bot.config, "METRICS_PORT", None)
+        if port is None:
+            return
+
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle_metrics)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+
+        host = getattr(self.bot.config, "METRICS_HOST", None) or "127.0.0.1"
+        await web.TCPSite(self.runner, host, port + self.bot.cluster_idx).start()
+        self.bot.log.info("metrics.listening", host=host, port=port + self.bot.cluster_idx)
+
+    async def handle_metrics(self, request):
+        return web.Response(
+            body=metrics.REGISTRY.render().encode(),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
+
+    async def cog_unload(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+
+async def setup(bot: commands.Bot):
+    await bot.add_cog(Metrics(bot))
@@ -1,18 +1,42 @@
+import hashlib
+import json
 import math
+import os
 import pickle
 import random
 from datetime import datetime, timedelta, timezone
 
 import discord
 import pymongo
+from aioredis_lock import LockTimeoutError, RedisLock
 from bson.objectid import ObjectId
 from discord.ext import commands
+from expiringdict import ExpiringDict
 from motor.motor_asyncio import AsyncIOMotorClient
 from suntime import Sun
 from umongo import Document, EmbeddedDocument, Instance, MixinDocument, fields
 
 from data import models
-from helpers import constants
+from helpers import audit_log, constants, metrics, snapshot
+
+POKEDEX_CATEGORIES = ("mythical", "legendary", "ub")
+
+# Bump this whenever the way ``pokedex_counts`` is computed changes (e.g. the
+# category lists), so stale counts get recomputed.
+POKEDEX_COUNTS_VERSION = 1
+
+# Collection query results are cached as lists of ``_id`` values, so they stay
+# correct for fields that change without bumping the collection version (xp).
+QUERY_CACHE_MAX_LEN = 500
+QUERY_CACHE_MAX_AGE = 300
+QUERY_CACHE_MAX_IDS = 2000
+
+# The fields of a listed pokémon copied into the market index, i.e. the ones
+# market search can filter and sort on.
+MARKET_INDEX_FIELDS = ("owner_id", "species_id", "level", "shiny", "has_color", *constants.IV_FIELDS, "iv_total")
+
+# What index entries get for fields that pokémon documents don't always have.
+MARKET_INDEX_DEFAULTS = {"shiny": False, "has_color": False}
 
 random_iv = lambda: random.randint(0, 31)
 random_nature = lambda: random.choice(constants.NATURES)
@@ -247,6 +271,7 @@ class Member(Document):
 
     # Pokédex
     pokedex = fields.DictField(fields.StringField(), fields.IntegerField(), default=dict)
+    pokedex_counts = fields.DictField(fields.StringField(), fields.IntegerField(), default=None)
     shinies_caught = fields.IntegerField(default=0)
 
     # Shop
@@ -278,6 +303,7 @@ class Member(Document):
     show_balance = fields.BooleanField(default=True)
     silence = fields.BooleanField(default=False)
     catch_mention = fields.BooleanField(default=True)
+    locale = fields.StringField(default=None)
 
     # Quests
     badges = fields.DictField(fields.StringField(), fields.BooleanField(), default=dict)
@@ -422,12 +448,48 @@ class Sponsor(Document):
     reward_tier = fields.IntegerField()
 
 
+class PurchaseFailed(Exception):
+    """Raised when a market purchase can't go through. The message is the
+    localization message id of the reason why.
+    """
+
+
+class TradeFailed(Exception):
+    """Raised when a trade can't be executed. The message is the localization
+    message id of the reason why.
+    """
+
+
+class BidFailed(Exception):
+    """Raised when an auction bid can't go through, with the localization
+    message id of the reason why and any variables it needs.
+    """
+
+    def __init__(self, message_id, **kwargs):
+        super().__init__(message_id)
+        self.message_id = message_id
+        self.kwargs = kwargs
+
+
+class CommandListener(pymongo.monitoring.CommandListener):
+    """Records how long each database command takes."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        metrics.record("mongo", event.command_name, event.duration_micros / 1e6)
+
+    def failed(self, event):
+        metrics.record("mongo", event.command_name, event.duration_micros / 1e6)
+
+
 class Mongo(commands.Cog):
     """For database operations."""
 
     def __init__(self, bot: commands.Bot):
         self.bot = bot
-        self.client = AsyncIOMotorClient(bot.config.DATABASE_URI, io_loop=bot.loop)
+        self.client = AsyncIOMotorClient(bot.config.DATABASE_URI, io_loop=bot.loop, event_listeners=[CommandListener()])
         self.db = self.client[bot.config.DATABASE_NAME]
         instance = Instance(self.db)
 
@@ -447,12 +509,41 @@ class Mongo(commands.Cog):
             setattr(self, x, instance.register(g[x]))
             getattr(self, x).bot = bot
 
+        self.query_cache = ExpiringDict(max_len=QUERY_CACHE_MAX_LEN, max_age_seconds=QUERY_CACHE_MAX_AGE)
+
+        # Columnar snapshots of very large collections, see helpers.snapshot
+        self.snapshot_min_size = getattr(bot.config, "COLLECTION_SNAPSHOT_MIN_SIZE", None)
+        self.snapshots = None
+        if self.snapshot_min_size is not None and snapshot.np is not None:
+            self.snapshots = snapshot.SnapshotCache(
+                getattr(bot.config, "COLLECTION_SNAPSHOT_BUDGET", 256 * 1024 * 1024)
+            )
+
+        # Writes to the logs collection are buffered, see helpers.audit_log
+        spill_dir = getattr(bot.config, "AUDIT_LOG_SPILL_DIR", None) or audit_log.DEFAULT_SPILL_DIR
+        self.audit_log = audit_log.AuditLog(
+            self.db.logs, os.path.join(spill_dir, f"{bot.cluster_idx}.bson"), log=bot.log
+        )
+        self.audit_log.start()
+
+        self._connect_task = self.bot.loop.create_task(self.connect())
+
+    async def cog_unload(self):
+        await self.audit_log.close()
+
+    async def connect(self):
+        # Connects up front, rather than on the first query.
+        await self.client.admin.command("ping")
+
+    async def wait_until_ready(self):
+        await self._connect_task
+
     async def fetch_member_info(self, member: discord.Member):
-        val = await self.bot.redis.hget(f"db:member", member.id)
+        val = await self.bot.redis.hget("db:member", member.id)
         if val is None:
             val = await self.Member.find_one({"id": member.id}, {"pokemon": 0, "pokedex": 0})
             v = "" if val is None else pickle.dumps(val.to_mongo())
-            await self.bot.redis.hset(f"db:member", member.id, v)
+            await self.bot.redis.hset("db:member", member.id, v)
         elif len(val) == 0:
             return None
         else:
@@ -465,7 +556,7 @@ class Mongo(commands.Cog):
             {"$inc": {"next_idx": reserve}},
             projection={"next_idx": 1},
         )
-        await self.bot.redis.hdel(f"db:member", member.id)
+        await self.bot.redis.hdel("db:member", member.id)
         return result["next_idx"]
 
     async def reset_idx(self, member: discord.Member, value):
@@ -474,9 +565,298 @@ class Mongo(commands.Cog):
             {"$set": {"next_idx": value}},
             projection={"next_idx": 1},
         )
-        await self.bot.redis.hdel(f"db:member", member.id)
+        await self.bot.redis.hdel("db:member", member.id)
         return result["next_idx"]
 
+    async def reindex_pokemon(self, member: discord.Member):
+        """Re-numbers a member's pokémon from 1 in their current order, entirely
+        on the database server. Returns the number of pokémon re-numbered.
+
+        Pokémon minted while this runs are left alone, since they're given an
+        idx past any that existed when it started. The member's next_idx is
+        then only lowered if nothing was minted in the meantime.
+        """
+
+        result = await self.db.member.find_one({"_id": member.id}, {"next_idx": 1})
+        next_idx = result["next_idx"]
+
+        query = {"owner_id": member.id, "owned_by": "user", "idx": {"$lt": next_idx}}
+        num = await self.db.pokemon.count_documents(query)
+
+        pipeline = [
+            {"$match": query},
+            {"$setWindowFields": {"sortBy": {"idx": 1}, "output": {"idx": {"$documentNumber": {}}}}},
+            {"$project": {"idx": 1}},
+            {
+                "$merge": {
+                    "into": "pokemon",
+                    "on": "_id",
+                    # Don't touch pokémon that were traded or listed away in the meantime.
+                    "whenMatched": [
+                        {
+                            "$set": {
+                                "idx": {
+                                    "$cond": [
+                                        {
+                                            "$and": [
+                                                {"$eq": ["$owner_id", member.id]},
+                                                {"$eq": ["$owned_by", "user"]},
+                                            ]
+                                        },
+                                        "$$new.idx",
+                                        "$idx",
+                                    ]
+                                }
+                            }
+                        }
+                    ],
+                    "whenNotMatched": "discard",
+                }
+            },
+        ]
+        await self.db.pokemon.aggregate(pipeline, allowDiskUse=True).to_list(None)
+
+        await self.db.member.update_one({"_id": member.id, "next_idx": next_idx}, {"$set": {"next_idx": num + 1}})
+        await self.bot.redis.hdel("db:member", member.id)
+        await self.bump_collection_version(member)
+        return num
+
+    async def create_listing(self, pokemon_id, listing_id: int, price: int):
+        """Lists a pokémon on the market and adds its market index entry in a
+        single transaction, so it can't be bought in between and leave an entry
+        behind. Returns the pokémon as it was before it was listed.
+        """
+
+        market_data = {"_id": listing_id, "price": price}
+
+        async def create(s):
+            pokemon = await self.db.pokemon.find_one_and_update(
+                {"_id": pokemon_id}, {"$set": {"owned_by": "market", "market_data": market_data}}, session=s
+            )
+            await self.db.market_index.replace_one(
+                {"_id": listing_id}, self.market_index_entry(pokemon, market_data), upsert=True, session=s
+            )
+            return pokemon
+
+        async with await self.client.start_session() as s:
+            return await s.with_transaction(create)
+
+    async def purchase_listing(self, buyer_id: int, listing_id: int, price: int):
+        """Buys a market listing in a single transaction, debiting the buyer if
+        they can afford it, transferring the pokémon, crediting the seller, then
+        logs the purchase. Returns the listing as it was before the purchase.
+
+        Raises ``PurchaseFailed`` if the listing is gone or the buyer can't
+        afford it, in which case nothing is written.
+        """
+
+        async def purchase(s):
+            buyer = await self.db.member.find_one_and_update(
+                {"_id": buyer_id, "balance": {"$gte": price}},
+                {"$inc": {"balance": -price, "next_idx": 1}},
+                projection={"next_idx": 1},
+                session=s,
+            )
+            if buyer is None:
+                raise PurchaseFailed("not-enough-coins")
+
+            listing = await self.db.pokemon.find_one_and_update(
+                {
+                    "owned_by": "market",
+                    "owner_id": {"$ne": buyer_id},
+                    "market_data._id": listing_id,
+                    "market_data.price": price,
+                },
+                {
+                    "$set": {"owner_id": buyer_id, "owned_by": "user", "idx": buyer["next_idx"]},
+                    "$unset": {"market_data": 1},
+                },
+                session=s,
+            )
+            if listing is None:
+                raise PurchaseFailed("listing-no-longer-exists")
+
+            await self.db.market_index.delete_one({"_id": listing_id}, session=s)
+
+            await self.db.member.update_one({"_id": listing["owner_id"]}, {"$inc": {"balance": price}}, session=s)
+            return listing
+
+        # Concurrent buyers conflict on the listing document, and the losing
+        # transactions are retried, see that it's gone, and roll back.
+        async with await self.client.start_session() as s:
+            listing = await s.with_transaction(purchase)
+
+        self.audit_log.write(
+            {
+                "event": "market",
+                "user": buyer_id,
+                "item": listing["_id"],
+                "seller_id": listing["owner_id"],
+                "species_id": listing["species_id"],
+                "shiny": listing["shiny"],
+                "price": price,
+                "listing_id": listing_id,
+            }
+        )
+        return listing
+
+    async def place_auction_bid(self, auction_id: int, bidder_id: int, bid: int, *, queue=False):
+        """Places a bid on an auction in a single transaction, with one
+        conditional update of the auction, a conditional debit of the bidder
+        and a refund of the previous highest bidder. Auctions ending within five
+        minutes are extended. Returns the auction as it was before the bid,
+        and when it now ends.
+
+        Raises ``BidFailed`` if the bid isn't valid or the bidder can't afford
+        it, in which case nothing is written. If ``queue`` is set, bids on the
+        same auction wait for each other through Redis, rather than conflicting
+        in the database and retrying.
+        """
+
+        if queue:
+            try:
+                async with RedisLock(self.bot.redis, f"auction_bid:{auction_id}", 10, 10):
+                    return await self.place_auction_bid(auction_id, bidder_id, bid)
+            except LockTimeoutError:
+                raise BidFailed("auction-bid-busy")
+
+        now = datetime.utcnow()
+        extended = now + timedelta(minutes=5)
+
+        async def place_bid(s):
+            auction = await self.db.pokemon.find_one_and_update(
+                {
+                    "owned_by": "auction",
+                    "auction_data._id": auction_id,
+                    "auction_data.ends": {"$gt": now},
+                    "auction_data.bidder_id": {"$ne": bidder_id},
+                    "owner_id": {"$ne": bidder_id},
+                    "$expr": {"$lte": [{"$add": ["$auction_data.current_bid", "$auction_data.bid_increment"]}, bid]},
+                },
+                [
+                    {
+                        "$set": {
+                            "auction_data.current_bid": bid,
+                            "auction_data.bidder_id": bidder_id,
+                            "auction_data.ends": {"$max": ["$auction_data.ends", extended]},
+                        }
+                    }
+                ],
+                session=s,
+            )
+            if auction is None:
+                return None
+
+            result = await self.db.member.update_one(
+                {"_id": bidder_id, "balance": {"$gte": bid}}, {"$inc": {"balance": -bid}}, session=s
+            )
+            if result.modified_count == 0:
+                raise BidFailed("not-enough-coins")
+
+            if auction["auction_data"]["bidder_id"] is not None:
+                await self.db.member.update_one(
+                    {"_id": auction["auction_data"]["bidder_id"]},
+                    {"$inc": {"balance": auction["auction_data"]["current_bid"]}},
+                    session=s,
+                )
+            return auction
+
+        async with await self.client.start_session() as s:
+            auction = await s.with_transaction(place_bid)
+
+        if auction is None:
+            # Nothing was written, so just work out why.
+            auction = await self.db.pokemon.find_one({"owned_by": "auction", "auction_data._id": auction_id})
+            if auction is None:
+                raise BidFailed("auction-ended-already")
+            data = auction["auction_data"]
+            if data["ends"] <= now:
+                raise BidFailed("auction-ended")
+            if auction["owner_id"] == bidder_id:
+                raise BidFailed("cannot-self-bid")
+            if data["bidder_id"] == bidder_id:
+                raise BidFailed("already-highest-bidder")
+            raise BidFailed("bid-minimum", minimum=data["current_bid"] + data["bid_increment"])
+
+        await self.bot.redis.hdel("db:member", bidder_id, *filter(None, [auction["auction_data"]["bidder_id"]]))
+        return auction, max(auction["auction_data"]["ends"], extended)
+
+    async def execute_trade(self, users, pokecoins: dict, redeems: dict, pokemon: dict, evolutions: dict):
+        """Executes a trade between two users in a single transaction. Each
+        side's pokécoins and redeems are debited only if they can afford them,
+        and each side's pokémon are handed over, renumbered and evolved in one
+        bulk write, then the trade is logged.
+
+        ``pokecoins``, ``redeems`` and ``pokemon`` map each user id to what they
+        give away, and ``evolutions`` maps the ids of pokémon that evolve when
+        traded to their new species id.
+
+        Raises ``TradeFailed`` if either side can't afford their part or one of
+        their pokémon is no longer theirs to give, in which case nothing is
+        written.
+        """
+
+        a, b = users
+
+        async def execute(s):
+            next_idx = {}
+            for user, partner in ((a, b), (b, a)):
+                query = {"_id": user}
+                if pokecoins[user] > 0:
+                    query["balance"] = {"$gte": pokecoins[user]}
+                if redeems[user] > 0:
+                    query["redeems"] = {"$gte": redeems[user]}
+
+                member = await self.db.member.find_one_and_update(
+                    query,
+                    {
+                        "$inc": {
+                            "balance": pokecoins[partner] - pokecoins[user],
+                            "redeems": redeems[partner] - redeems[user],
+                            "next_idx": len(pokemon[partner]),
+                        }
+                    },
+                    projection={"next_idx": 1},
+                    session=s,
+                )
+                if member is None:
+                    member = await self.db.member.find_one({"_id": user}, {"balance": 1}, session=s)
+                    if member is None or member.get("balance", 0) < pokecoins[user]:
+                        raise TradeFailed("trade-needs-pokecoins")
+                    raise TradeFailed("trade-needs-redeems")
+                next_idx[user] = member["next_idx"]
+
+            for user, partner in ((a, b), (b, a)):
+                if len(pokemon[user]) == 0:
+                    continue
+                ops = []
+                for i, pokemon_id in enumerate(pokemon[user]):
+                    update = {"owner_id": partner, "idx": next_idx[partner] + i}
+                    if pokemon_id in evolutions:
+                        update["species_id"] = evolutions[pokemon_id]
+                    ops.append(
+                        pymongo.UpdateOne({"_id": pokemon_id, "owner_id": user, "owned_by": "user"}, {"$set": update})
+                    )
+                result = await self.db.pokemon.bulk_write(ops, ordered=False, session=s)
+                if result.matched_count != len(ops):
+                    raise TradeFailed("trade-pokemon-unavailable")
+
+        async with await self.client.start_session() as s:
+            await s.with_transaction(execute)
+
+        self.audit_log.write(
+            {
+                "event": "trade",
+                "users": [a, b],
+                "pokemon": {str(x): pokemon[x] for x in users},
+                "pokecoins": {str(x): pokecoins[x] for x in users},
+                "redeems": {str(x): redeems[x] for x in users},
+            }
+        )
+
+        await self.bot.redis.hdel("db:member", a, b)
+        await self.bump_collection_version(a, b)
+
     async def fetch_pokedex(self, member: discord.Member, start: int, end: int):
         filter_obj = {}
 
@@ -485,12 +865,72 @@ class Mongo(commands.Cog):
 
         return await self.Member.find_one({"id": member.id}, filter_obj)
 
+    def market_index_entry(self, pokemon, market_data):
+        """Builds the market index entry for a listed pokémon document."""
+
+        entry = {"_id": market_data["_id"], "pokemon_id": pokemon["_id"], "price": market_data["price"]}
+        entry.update({x: pokemon.get(x, MARKET_INDEX_DEFAULTS.get(x)) for x in MARKET_INDEX_FIELDS})
+        if entry["iv_total"] is None:
+            entry["iv_total"] = sum(pokemon[x] for x in constants.IV_FIELDS)
+        return entry
+
     def fetch_market_list(self, aggregations=[]):
-        pipeline = [
-            {"$match": {"owned_by": "market"}},
-            *aggregations,
-        ]
-        return self.db.pokemon.aggregate(pipeline, allowDiskUse=True)
+        """Runs a market search against the market index. The results are index
+        entries keyed by listing id, not full pokémon documents.
+        """
+
+        return self.db.market_index.aggregate(aggregations, allowDiskUse=True)
+
+    async def fetch_market_count(self, aggregations=[]):
+        result = await self.db.market_index.aggregate(
+            [*aggregations, {"$count": "num_matches"}], allowDiskUse=True
+        ).to_list(None)
+
+        if len(result) == 0:
+            return 0
+
+        return result[0]["num_matches"]
+
+    async def reconcile_market_index(self):
+        """Rebuilds the market index from the listings in the pokemon collection,
+        adding missing entries, fixing outdated ones and removing stale ones.
+        Returns the number of listings.
+        """
+
+        await self.db.pokemon.aggregate(
+            [
+                {"$match": {"owned_by": "market"}},
+                {
+                    "$project": {
+                        "_id": "$market_data._id",
+                        "pokemon_id": "$_id",
+                        "price": "$market_data.price",
+                        # $project leaves out fields a document doesn't have.
+                        **{
+                            x: {"$ifNull": [f"${x}", MARKET_INDEX_DEFAULTS.get(x)]}
+                            for x in MARKET_INDEX_FIELDS
+                            if x != "iv_total"
+                        },
+                        "iv_total": {"$ifNull": ["$iv_total", {"$sum": [f"${x}" for x in constants.IV_FIELDS]}]},
+                    }
+                },
+                {"$merge": {"into": "market_index", "on": "_id", "whenMatched": "replace"}},
+            ],
+            allowDiskUse=True,
+        ).to_list(None)
+
+        listing_ids = set()
+        async for x in self.db.pokemon.find({"owned_by": "market"}, {"market_data._id": 1}):
+            listing_ids.add(x["market_data"]["_id"])
+
+        stale = []
+        async for x in self.db.market_index.find({}, {"_id": 1}):
+            if x["_id"] not in listing_ids:
+                stale.append(x["_id"])
+        for i in range(0, len(stale), 1000):
+            await self.db.market_index.delete_many({"_id": {"$in": stale[i : i + 1000]}})
+
+        return len(listing_ids)
 
     def fetch_auction_list(self, guild, aggregations=[]):
         pipeline = [
@@ -512,7 +952,109 @@ class Mongo(commands.Cog):
 
         return result[0]["num_matches"]
 
+    async def fetch_collection_snapshot(self, member: discord.Member):
+        """Returns an up-to-date columnar snapshot of a member's collection, building
+        it if needed. Returns ``None`` if snapshots are disabled or the collection
+        is too small to benefit from one.
+        """
+
+        if self.snapshots is None:
+            return None
+
+        member_info = await self.fetch_member_info(member)
+        if member_info is None or member_info.next_idx < self.snapshot_min_size:
+            return None
+
+        # The version is read before building, so any write that lands while
+        # the snapshot is being built invalidates it.
+        version = await self.fetch_collection_version(member)
+        if (result := self.snapshots.get(member.id, version)) is not None:
+            return result
+
+        documents = await self.db.pokemon.find(
+            {"owner_id": member.id, "owned_by": "user"}, snapshot.PROJECTION
+        ).to_list(None)
+        result = await self.bot.loop.run_in_executor(
+            None, snapshot.CollectionSnapshot.from_documents, version, documents
+        )
+        self.snapshots.put(member.id, result)
+        return result
+
+    async def _evaluate_snapshot(self, member: discord.Member, aggregations):
+        if (result := await self.fetch_collection_snapshot(member)) is None:
+            return None, None
+        try:
+            return result, result.evaluate(aggregations)
+        except snapshot.UnsupportedPipeline:
+            return None, None
+
+    def _pipeline_key(self, member: discord.Member, version, aggregations):
+        def normalize(obj, ordered=False):
+            if isinstance(obj, dict):
+                items = [(k, normalize(v, ordered=k == "$sort")) for k, v in obj.items()]
+                return items if ordered else sorted(items)
+            if isinstance(obj, (list, tuple)):
+                return [normalize(x) for x in obj]
+            if isinstance(obj, (set, frozenset)):
+                return sorted(normalize(x) for x in obj)
+            return obj
+
+        digest = hashlib.sha1(json.dumps(normalize(aggregations), default=str).encode()).hexdigest()
+        return member.id, version, digest
+
+    async def _fetch_cached_pokemon_ids(self, member: discord.Member, version, aggregations):
+        """Returns the ordered ``_id`` values matched by a collection query, from
+        the query cache if the member's collection hasn't changed since. Returns
+        ``None`` if the result is too large to be cached.
+        """
+
+        key = self._pipeline_key(member, version, aggregations)
+
+        if (ids := self.query_cache.get(key)) is not None:
+            return ids if ids is not False else None
+
+        pipeline = [
+            {"$match": {"owner_id": member.id, "owned_by": "user"}},
+            *aggregations,
+            {"$project": {"_id": 1}},
+            {"$limit": QUERY_CACHE_MAX_IDS + 1},
+        ]
+        ids = [x["_id"] async for x in self.db.pokemon.aggregate(pipeline, allowDiskUse=True)]
+
+        # False marks the result as too large, so we don't retry every time.
+        if len(ids) > QUERY_CACHE_MAX_IDS:
+            self.query_cache[key] = False
+            return None
+
+        self.query_cache[key] = ids
+        return ids
+
+    async def _fetch_pokemon_by_ids(self, member: discord.Member, ids):
+        for i in range(0, len(ids), 100):
+            chunk = ids[i : i + 100]
+            documents = {
+                x["_id"]: x
+                async for x in self.db.pokemon.find({"_id": {"$in": chunk}, "owner_id": member.id, "owned_by": "user"})
+            }
+            for x in chunk:
+                if x in documents:
+                    yield self.bot.mongo.Pokemon.build_from_mongo(documents[x])
+
     async def fetch_pokemon_list(self, member: discord.Member, aggregations=[]):
+        collection, rows = await self._evaluate_snapshot(member, aggregations)
+
+        if rows is not None:
+            for i in range(0, len(rows), 100):
+                async for x in self._fetch_pokemon_by_ids(member, collection.object_ids(rows[i : i + 100])):
+                    yield x
+            return
+
+        version = await self.fetch_collection_version(member)
+        if (ids := await self._fetch_cached_pokemon_ids(member, version, aggregations)) is not None:
+            async for x in self._fetch_pokemon_by_ids(member, ids):
+                yield x
+            return
+
         pipeline = [
             {"$match": {"owner_id": member.id, "owned_by": "user"}},
             *aggregations,
@@ -521,6 +1063,18 @@ class Mongo(commands.Cog):
             yield self.bot.mongo.Pokemon.build_from_mongo(x)
 
     async def fetch_pokemon_count(self, member: discord.Member, aggregations=[]):
+        _, rows = await self._evaluate_snapshot(member, aggregations)
+        if rows is not None:
+            return len(rows)
+
+        version = await self.fetch_collection_version(member)
+        if (ids := await self._fetch_cached_pokemon_ids(member, version, aggregations)) is not None:
+            return len(ids)
+
+        key = (*self._pipeline_key(member, version, aggregations), "count")
+        if (count := self.query_cache.get(key)) is not None:
+            return count
+
         result = await self.db.pokemon.aggregate(
             [
                 {"$match": {"owner_id": member.id, "owned_by": "user"}},
@@ -530,10 +1084,9 @@ class Mongo(commands.Cog):
             allowDiskUse=True,
         ).to_list(None)
 
-        if len(result) == 0:
-            return 0
-
-        return result[0]["num_matches"]
+        count = 0 if len(result) == 0 else result[0]["num_matches"]
+        self.query_cache[key] = count
+        return count
 
     async def fetch_pokedex_count(self, member: discord.Member, aggregations=[]):
         result = await self.db.member.aggregate(
@@ -553,39 +1106,155 @@ class Mongo(commands.Cog):
 
         return result[0]["result"]
 
-    async def fetch_pokedex_sum(self, member: discord.Member, aggregations=[]):
-        result = await self.db.member.aggregate(
-            [
-                {"$match": {"_id": member.id}},
-                {"$project": {"pokedex": {"$objectToArray": "$pokedex"}}},
-                {"$unwind": {"path": "$pokedex"}},
-                {"$replaceRoot": {"newRoot": "$pokedex"}},
-                *aggregations,
-                {"$group": {"_id": "sum", "result": {"$sum": "$v"}}},
-            ],
-            allowDiskUse=True,
-        ).to_list(None)
+    def pokedex_inc(self, species, amount=1):
+        """Returns the ``$inc`` fields that add ``amount`` catches of a species to
+        a member's pokédex, keeping ``pokedex_counts`` in step with it.
+        """
+
+        inc = {f"pokedex.{species.dex_number}": amount, "pokedex_counts.total": amount}
+        for category in POKEDEX_CATEGORIES:
+            if species.dex_number in getattr(self.bot.data, f"list_{category}"):
+                inc[f"pokedex_counts.{category}"] = amount
+        return inc
+
+    def pokedex_counts_stale(self, member):
+        """Whether ``pokedex_counts`` on a member needs to be reconciled before
+        it can be trusted. Members that have never been reconciled may still
+        carry partial counts from ``pokedex_inc``.
+        """
+
+        return (member.pokedex_counts or {}).get("version") != POKEDEX_COUNTS_VERSION
+
+    def _pokedex_counts_expression(self):
+        def category_sum(keys):
+            return {
+                "$sum": {
+                    "$map": {
+                        "input": {"$filter": {"input": "$$dex", "cond": {"$in": ["$$this.k", keys]}}},
+                        "in": "$$this.v",
+                    }
+                }
+            }
+
+        return {
+            "$let": {
+                "vars": {"dex": {"$objectToArray": {"$ifNull": ["$pokedex", {}]}}},
+                "in": {
+                    "version": POKEDEX_COUNTS_VERSION,
+                    "total": {"$sum": "$$dex.v"},
+                    **{
+                        category: category_sum([str(x) for x in getattr(self.bot.data, f"list_{category}")])
+                        for category in POKEDEX_CATEGORIES
+                    },
+                },
+            }
+        }
+
+    async def reconcile_pokedex_counts(self, member_ids):
+        """Recomputes ``pokedex_counts`` from the pokédex for the given members.
+
+        This runs as a pipeline update, so each document is recomputed atomically
+        on the server and can't race with concurrent catches.
+        """
+
+        member_ids = [int(x) for x in member_ids]
+        if len(member_ids) == 0:
+            return
+
+        await self.db.member.update_many(
+            {"_id": {"$in": member_ids}},
+            [{"$set": {"pokedex_counts": self._pokedex_counts_expression()}}],
+        )
+        await self.bot.redis.hdel("db:member", *member_ids)
 
-        if len(result) == 0:
-            return 0
+    async def reconcile_all_pokedex_counts(self, *, batch_size=1000, stale_only=False):
+        """Recomputes ``pokedex_counts`` for every member in batches of ``batch_size``."""
 
-        return result[0]["result"]
+        query = {"pokedex_counts.version": {"$ne": POKEDEX_COUNTS_VERSION}} if stale_only else {}
+        count = 0
+        batch = []
+
+        async for x in self.db.member.find(query, {"_id": 1}).sort("_id", 1):
+            batch.append(x["_id"])
+            if len(batch) >= batch_size:
+                await self.reconcile_pokedex_counts(batch)
+                count += len(batch)
+                batch = []
+
+        await self.reconcile_pokedex_counts(batch)
+        return count + len(batch)
 
     async def update_member(self, member, update):
         if hasattr(member, "id"):
             member = member.id
         result = await self.db.member.update_one({"_id": member}, update)
-        await self.bot.redis.hdel(f"db:member", int(member))
+        await self.bot.redis.hdel("db:member", int(member))
         return result
 
-    async def update_pokemon(self, pokemon, update):
+    async def update_pokemon(self, pokemon, update, *, bump_version=True):
+        owner_id = pokemon.get("owner_id") if isinstance(pokemon, dict) else getattr(pokemon, "owner_id", None)
+
         if hasattr(pokemon, "id"):
             pokemon = pokemon.id
         if hasattr(pokemon, "_id"):
             pokemon = pokemon._id
         if isinstance(pokemon, dict) and "_id" in pokemon:
             pokemon = pokemon["_id"]
-        return await self.db.pokemon.update_one({"_id": pokemon}, update)
+        result = await self.db.pokemon.update_one({"_id": pokemon}, update)
+
+        if bump_version and owner_id is not None:
+            await self.bump_collection_version(owner_id)
+
+        return result
+
+    async def fetch_collection_version(self, member):
+        """Returns the current version of a member's pokémon collection. The
+        version increases every time any of their pokémon is written to.
+        """
+
+        if hasattr(member, "id"):
+            member = member.id
+        return int(await self.bot.redis.hget("collection_version", member) or 0)
+
+    async def bump_collection_version(self, *members):
+        """Marks the pokémon collections of the given members as changed. This
+        must be called after every write that touches a member's pokémon, so
+        anything derived from their collection can be invalidated.
+        """
+
+        for member in members:
+            if hasattr(member, "id"):
+                member = member.id
+            await self.bot.redis.hincrby("collection_version", int(member), 1)
+
+    async def fetch_pokemon_edge(self, member: discord.Member, *, last=False):
+        """Returns the pokémon with the lowest (or highest) idx in a member's
+        collection, with a single lookup on the idx index.
+        """
+
+        result = await self.db.pokemon.find_one(
+            {"owner_id": member.id, "owned_by": "user"}, sort=[("idx", -1 if last else 1)]
+        )
+
+        if result is None:
+            return None
+
+        return self.Pokemon.build_from_mongo(result)
+
+    async def fetch_pokemon_neighbor(self, member: discord.Member, idx: int, *, reverse=False):
+        """Returns the pokémon with the next (or previous) idx after the given
+        one in a member's collection, with a single lookup on the idx index.
+        """
+
+        result = await self.db.pokemon.find_one(
+            {"owner_id": member.id, "owned_by": "user", "idx": {"$lt" if reverse else "$gt": idx}},
+            sort=[("idx", -1 if reverse else 1)],
+        )
+
+        if result is None:
+            return None
+
+        return self.Pokemon.build_from_mongo(result)
 
     async def fetch_pokemon(self, member: discord.Member, idx: int):
         if isinstance(idx, ObjectId):
@@ -593,19 +1262,7 @@ class Mongo(commands.Cog):
             if result is not None and result["owner_id"] != member.id:
                 result = None
         elif idx == -1:
-            result = await self.db.pokemon.aggregate(
-                [
-                    {"$match": {"owner_id": member.id, "owned_by": "user"}},
-                    {"$sort": {"idx": -1}},
-                    {"$limit": 1},
-                ],
-                allowDiskUse=True,
-            ).to_list(None)
-
-            if len(result) == 0:
-                result = None
-            else:
-                result = result[0]
+            return await self.fetch_pokemon_edge(member, last=True)
         else:
             result = await self.db.pokemon.find_one({"owner_id": member.id, "idx": idx, "owned_by": "user"})
 
@@ -7,7 +7,6 @@ from operator import itemgetter
 
 from discord.errors import DiscordException
 from discord.ext import commands
-from pymongo import UpdateOne
 
 from helpers import checks, constants, converters, flags, pagination
 
@@ -34,22 +33,9 @@ class Pokemon(commands.Cog):
 
         await ctx.send(ctx._("reindexing-pokemon"))
 
-        num = await self.bot.mongo.fetch_pokemon_count(ctx.author)
-        await self.bot.mongo.reset_idx(ctx.author, value=num + 1)
-        mons = self.bot.mongo.db.pokemon.find({"owner_id": ctx.author.id, "owned_by": "user"}).sort("idx")
+        async with ctx.keep_command_lock():
+            await self.bot.mongo.reindex_pokemon(ctx.author)
 
-        ops = []
-
-        idx = 1
-        async for pokemon in mons:
-            ops.append(UpdateOne({"_id": pokemon["_id"]}, {"$set": {"idx": idx}}))
-            idx += 1
-
-            if len(ops) >= 1000:
-                await self.bot.mongo.db.pokemon.bulk_write(ops)
-                ops = []
-
-        await self.bot.mongo.db.pokemon.bulk_write(ops)
         await ctx.send(ctx._("successfully-reindexed-pokemon"))
 
     @checks.has_started()
@@ -185,6 +171,7 @@ class Pokemon(commands.Cog):
             {"_id": {"$in": [x.id async for x in pokemon]}},
             {"$set": {"nickname": nicknameall}},
         )
+        await self.bot.mongo.bump_collection_version(ctx.author)
 
         if nicknameall is None:
             await ctx.send(ctx._("nickall-completed-removed", number=num))
@@ -352,6 +339,7 @@ class Pokemon(commands.Cog):
             {"_id": {"$in": [x.id async for x in pokemon]}},
             {"$set": {"favorite": True}},
         )
+        await self.bot.mongo.bump_collection_version(ctx.author)
 
         await ctx.send(ctx._("favoriteall-completed", nowFavorited=unfavnum, totalSelected=num))
 
@@ -437,6 +425,7 @@ class Pokemon(commands.Cog):
             {"_id": {"$in": [x.id async for x in pokemon]}},
             {"$set": {"favorite": False}},
         )
+        await self.bot.mongo.bump_collection_version(ctx.author)
 
         await ctx.send(ctx._("unfavoriteall-completed", totalSelected=num, nowUnfavorited=favnum))
 
@@ -456,25 +445,19 @@ class Pokemon(commands.Cog):
 
             menu.current_page = 2
 
-            agg = None
+            result = None
 
             if pidx == 4:
-                agg = [{"$sort": {"idx": -1}}]
+                result = await self.bot.mongo.fetch_pokemon_edge(ctx.author, last=True)
             elif pidx == 3:
-                agg = [{"$match": {"idx": {"$gt": pokemon.idx}}}]
+                result = await self.bot.mongo.fetch_pokemon_neighbor(ctx.author, pokemon.idx)
             elif pidx == 1:
-                agg = [
-                    {"$match": {"idx": {"$lt": pokemon.idx}}},
-                    {"$sort": {"idx": -1}},
-                ]
+                result = await self.bot.mongo.fetch_pokemon_neighbor(ctx.author, pokemon.idx, reverse=True)
             elif pidx == 0:
-                agg = []
+                result = await self.bot.mongo.fetch_pokemon_edge(ctx.author)
 
-            if agg is not None:
-                it = self.bot.mongo.fetch_pokemon_list(ctx.author, agg)
-                async for x in it:
-                    pokemon = x
-                    break
+            if result is not None:
+                pokemon = result
 
             field_values = {}
             if pokemon.held_item:
@@ -749,6 +732,7 @@ class Pokemon(commands.Cog):
             {"owner_id": ctx.author.id, "_id": {"$in": list(ids)}},
             {"$set": {"owned_by": "released"}},
         )
+        await self.bot.mongo.bump_collection_version(ctx.author)
         await self.bot.mongo.update_member(
             ctx.author,
             {
@@ -847,6 +831,7 @@ class Pokemon(commands.Cog):
             {"owner_id": ctx.author.id, "_id": {"$in": [x.id async for x in pokemon]}},
             {"$set": {"owned_by": "released"}},
         )
+        await self.bot.mongo.bump_collection_version(ctx.author)
 
         await self.bot.mongo.update_member(
             ctx.author,
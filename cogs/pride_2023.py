@@ -248,6 +248,7 @@ class Pride(commands.Cog):
             )
             # Give the pokemon an everstone and favourite it, to prevent bug caused by evolution and prevent accidental release
             await self.bot.mongo.update_pokemon(pokemon_id, {"$set": {"held_item": 13001, "favorite": True}})
+            await self.bot.mongo.bump_collection_version(ctx.author)
 
             msg = f"{species} has been set as your Pride Buddy! Use `@Pokétwo pride buddy` to view more info."
             if species.id == 493:
@@ -499,7 +500,7 @@ class Pride(commands.Cog):
 
     @commands.Cog.listener()
     async def on_trade(self, trade):
-        a, b = trade["users"]
+        a, b = trade.users
         await self.on_quest_event(a, "trade", [])
         await self.on_quest_event(b, "trade", [])
 
@@ -1,5 +1,193 @@
+import asyncio
+import json
+import time
+
 import aioredis
-from discord.ext import commands
+from discord.ext import commands, tasks
+
+from helpers import metrics
+
+# Version of the message bus wire format. Messages of any other version are
+# acknowledged and dropped.
+BUS_VERSION = 1
+
+# The payload fields every message on each topic must have, and their types.
+BUS_TOPICS = {
+    "send_dm": {"user_id": int, "content": str},
+    "cancel_trade": {"user_id": int},
+    "move_request": {"cluster_idx": int, "user_id": int, "species_id": int, "actions": dict, "requested_at": int},
+    "move_decide": {"user_id": int, "action": dict, "requested_at": int, "waited": int},
+}
+
+# Every cluster reads as one consumer of the same group, so a topic without a
+# cluster is handled by whichever cluster reads it first.
+BUS_GROUP = "bot"
+
+# Streams are trimmed to roughly this many entries.
+BUS_MAX_LEN = 10000
+
+BUS_READ_COUNT = 100
+
+# How long a read blocks for, which is also how long it takes to pick up new
+# subscriptions.
+BUS_BLOCK_MS = 1000
+
+
+class MessageBus:
+    """Passes messages between clusters through Redis streams, one per topic
+    (and per cluster, for messages meant for a specific cluster).
+
+    Each message is a stream entry with the wire format version, the topic, the
+    time it was sent in milliseconds and its JSON-encoded payload. Messages are
+    read through a consumer group on a dedicated connection and acknowledged
+    once handled, so anything a cluster read but didn't handle before going
+    down is handled when it comes back up.
+    """
+
+    def __init__(self, bot: commands.Bot):
+        self.bot = bot
+        self.handlers = {}
+        self.stats = {}
+
+    def stream(self, topic, cluster=None):
+        if cluster is None:
+            return f"bus:{topic}"
+        return f"bus:{topic}:{cluster}"
+
+    def encode(self, topic, data):
+        try:
+            schema = BUS_TOPICS[topic]
+        except KeyError:
+            raise ValueError(f"unknown message bus topic {topic!r}")
+
+        for key, kind in schema.items():
+            if not isinstance(data.get(key), kind):
+                raise TypeError(f"{topic} messages need {key} of type {kind.__name__}")
+
+        return {"v": BUS_VERSION, "type": topic, "sent": int(time.time() * 1000), "data": json.dumps(data)}
+
+    async def publish(self, topic, data, *, cluster=None):
+        """Sends a message on a topic, optionally to a specific cluster only."""
+
+        await self.bot.redis.xadd(self.stream(topic, cluster), self.encode(topic, data), max_len=BUS_MAX_LEN)
+
+    def subscribe(self, topic, handler, *, cluster=None):
+        """Calls the coroutine function ``handler`` with the payload of every
+        message on a topic. Each stream has one handler per cluster.
+        """
+
+        self.handlers[self.stream(topic, cluster)] = (topic, handler)
+
+    def unsubscribe(self, topic, *, cluster=None):
+        self.handlers.pop(self.stream(topic, cluster), None)
+
+    async def create_group(self, stream):
+        try:
+            await self.bot.redis.xgroup_create(stream, BUS_GROUP, latest_id="0", mkstream=True)
+        except aioredis.ReplyError as e:
+            if not str(e).startswith("BUSYGROUP"):
+                raise
+
+    async def run(self):
+        conn = await aioredis.create_redis(**self.bot.config.REDIS_CONF, encoding="utf-8")
+        consumer = str(self.bot.cluster_idx)
+        ready = set()
+
+        try:
+            while True:
+                streams = list(self.handlers)
+                if len(streams) == 0:
+                    await asyncio.sleep(BUS_BLOCK_MS / 1000)
+                    continue
+
+                # Anything this cluster was handed before a restart, but never
+                # acknowledged, is read again before anything new.
+                for stream in streams:
+                    if stream in ready:
+                        continue
+                    await self.create_group(stream)
+                    while True:
+                        messages = await conn.xread_group(
+                            BUS_GROUP, consumer, [stream], timeout=None, count=BUS_READ_COUNT, latest_ids=["0"]
+                        )
+                        await asyncio.gather(*(self.handle(*x) for x in messages))
+                        if len(messages) < BUS_READ_COUNT:
+                            break
+                    ready.add(stream)
+
+                # Only messages never handed to any consumer in the group.
+                messages = await conn.xread_group(
+                    BUS_GROUP,
+                    consumer,
+                    streams,
+                    timeout=BUS_BLOCK_MS,
+                    count=BUS_READ_COUNT,
+                    latest_ids=[">"] * len(streams),
+                )
+                for message in messages:
+                    self.bot.loop.create_task(self.handle(*message))
+        finally:
+            conn.close()
+            await conn.wait_closed()
+
+    async def handle(self, stream, message_id, fields):
+        try:
+            topic, handler = self.handlers[stream]
+        except KeyError:
+            # Unsubscribed since it was read, so leave it for next time.
+            return
+
+        try:
+            if fields.get("v") != str(BUS_VERSION) or fields.get("type") != topic:
+                self.bot.log.warning("bus.dropped", stream=stream, message_id=message_id, version=fields.get("v"))
+            else:
+                stats = self.stats.setdefault(stream, {"delivered": 0, "latency_total": 0, "latency_max": 0})
+                latency = max(time.time() * 1000 - int(fields["sent"]), 0)
+                stats["delivered"] += 1
+                stats["latency_total"] += latency
+                stats["latency_max"] = max(stats["latency_max"], latency)
+
+                await handler(json.loads(fields["data"]))
+        except Exception:
+            self.bot.log.exception("bus.error", stream=stream, message_id=message_id)
+
+        await self.bot.redis.xack(stream, BUS_GROUP, message_id)
+
+    async def depth(self, stream):
+        """Returns how many messages on a stream have been read but not yet
+        acknowledged, and how many are yet to be read at all (on Redis 7 and
+        newer, otherwise None).
+        """
+
+        try:
+            groups = await self.bot.redis.execute("XINFO", "GROUPS", stream, encoding="utf-8")
+        except aioredis.ReplyError:
+            return 0, None
+
+        for group in groups:
+            group = dict(zip(group[::2], group[1::2]))
+            if group["name"] == BUS_GROUP:
+                return group["pending"], group.get("lag")
+        return 0, None
+
+
+class InstrumentedRedis(aioredis.Redis):
+    """Records how long each command sent through the pool takes."""
+
+    def execute(self, command, *args, **kwargs):
+        # The command is sent right away, as before, and only timed once
+        # something awaits its reply.
+        start = time.perf_counter()
+        reply = super().execute(command, *args, **kwargs)
+        return self._timed(command, start, reply)
+
+    async def _timed(self, command, start, reply):
+        try:
+            return await reply
+        finally:
+            if isinstance(command, bytes):
+                command = command.decode()
+            metrics.record("redis", command.upper(), time.perf_counter() - start)
 
 
 class Redis(commands.Cog):
@@ -8,10 +196,13 @@ class Redis(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
         self.pool = None
+        self.bus = MessageBus(bot)
         self._connect_task = self.bot.loop.create_task(self.connect())
+        self._bus_task = self.bot.loop.create_task(self.run_bus())
+        self.report_bus_stats.start()
 
     async def connect(self):
-        self.pool = await aioredis.create_redis_pool(**self.bot.config.REDIS_CONF)
+        self.pool = await aioredis.create_redis_pool(**self.bot.config.REDIS_CONF, commands_factory=InstrumentedRedis)
 
     async def close(self):
         self.pool.close()
@@ -20,7 +211,41 @@ class Redis(commands.Cog):
     async def wait_until_ready(self):
         await self._connect_task
 
+    async def run_bus(self):
+        await self.wait_until_ready()
+        await self.bot.wait_until_ready()
+
+        while True:
+            try:
+                await self.bus.run()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.bot.log.exception("bus.error")
+                await asyncio.sleep(5)
+
+    @tasks.loop(minutes=1)
+    async def report_bus_stats(self):
+        for stream in list(self.bus.handlers):
+            stats = self.bus.stats.pop(stream, {"delivered": 0, "latency_total": 0, "latency_max": 0})
+            pending, lag = await self.bus.depth(stream)
+            self.bot.log.info(
+                "bus.stats",
+                stream=stream,
+                delivered=stats["delivered"],
+                latency_avg_ms=stats["latency_total"] / stats["delivered"] if stats["delivered"] > 0 else None,
+                latency_max_ms=stats["latency_max"],
+                pending=pending,
+                lag=lag,
+            )
+
+    @report_bus_stats.before_loop
+    async def before_report_bus_stats(self):
+        await self.wait_until_ready()
+
     def cog_unload(self):
+        self._bus_task.cancel()
+        self.report_bus_stats.cancel()
         self.bot.loop.create_task(self.close())
 
 
@@ -172,6 +172,7 @@ class Shop(commands.Cog):
         await self.bot.mongo.update_member(ctx.author, update)
         if len(added_pokemon) > 0:
             await self.bot.mongo.db.pokemon.insert_many(added_pokemon)
+            await self.bot.mongo.bump_collection_version(ctx.author)
         self.bot.dispatch("open_box", ctx.author, amt)
         await ctx.send(embed=embed)
 
@@ -653,6 +654,7 @@ class Shop(commands.Cog):
                     )
 
             await self.bot.mongo.db.pokemon.update_one({"_id": pokemon.id, "level": pokemon.level - qty}, update)
+            await self.bot.mongo.bump_collection_version(ctx.author)
 
             if member.silence and pokemon.level == 100:
                 await ctx.author.send(embed=embed)
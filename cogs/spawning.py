@@ -66,7 +66,7 @@ class Spawning(commands.Cog):
                         xp_inc *= 2
                     pokemon.xp += xp_inc
 
-                    await self.bot.mongo.update_pokemon(pokemon, {"$inc": {"xp": xp_inc}})
+                    await self.bot.mongo.update_pokemon(pokemon, {"$inc": {"xp": xp_inc}}, bump_version=False)
 
                 if pokemon.xp >= pokemon.max_xp and pokemon.level < 100:
                     update = {"$set": {f"xp": 0, f"level": pokemon.level + 1}}
@@ -129,7 +129,7 @@ class Spawning(commands.Cog):
                         await message.author.send(embed=embed)
 
                 elif pokemon.level == 100 and pokemon.xp < pokemon.max_xp:
-                    await self.bot.mongo.update_pokemon(pokemon, {"$set": {"xp": pokemon.max_xp}})
+                    await self.bot.mongo.update_pokemon(pokemon, {"$set": {"xp": pokemon.max_xp}}, bump_version=False)
 
     @commands.Cog.listener()
     async def on_message(self, message: discord.Message):
@@ -346,6 +346,7 @@ class Spawning(commands.Cog):
                 "idx": await self.bot.mongo.fetch_next_idx(ctx.author),
             }
         )
+        await self.bot.mongo.bump_collection_version(ctx.author)
         if shiny:
             await self.bot.mongo.update_member(ctx.author, {"$inc": {"shinies_caught": 1}})
 
@@ -362,8 +363,7 @@ class Spawning(commands.Cog):
             await self.bot.mongo.update_member(
                 ctx.author,
                 {
-                    "$set": {f"pokedex.{species.dex_number}": 1},
-                    "$inc": {"balance": coins},
+                    "$inc": {"balance": coins, **self.bot.mongo.pokedex_inc(species)},
                 },
             )
 
@@ -392,7 +392,7 @@ class Spawning(commands.Cog):
             await self.bot.mongo.update_member(
                 ctx.author,
                 {
-                    "$inc": {"balance": inc_bal, f"pokedex.{species.dex_number}": 1},
+                    "$inc": {"balance": inc_bal, **self.bot.mongo.pokedex_inc(species)},
                 },
             )
 
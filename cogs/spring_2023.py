@@ -371,6 +371,7 @@ class Spring(commands.Cog):
             text.append(f"{self.bot.mongo.Pokemon.build_from_mongo(p):lni} ({sum(ivs) / 186:.2%} IV)")
 
         await self.bot.mongo.db.pokemon.insert_many(pokemon)
+        await self.bot.mongo.bump_collection_version(ctx.author)
         await self.bot.mongo.update_member(
             ctx.author, {"$inc": {f"spring_2023_{k}": -v * qty for k, v in Counter(flowers).items()}}
         )
@@ -1,20 +1,109 @@
 import asyncio
-from csv import field_size_limit
+import itertools
 import math
 import random
 from datetime import datetime, timedelta
-from itertools import zip_longest
 
 import discord
-from discord.ext import commands, tasks
+from discord.ext import commands
 
+from cogs.mongo import TradeFailed
 from data.models import deaccent
 from helpers import checks, constants, flags, pagination
 
 
-def chunks(lst, n):
-    for i in range(0, len(lst), n):
-        yield lst[i : i + n]
+TRADE_PAGE_SIZE = 20
+
+
+class TradeSession:
+    """The state of a trade between two users.
+
+    Each side's pokémon are kept in insertion order keyed by ``_id``, along
+    with an index from idx to ``_id``, so adding, removing and looking up a
+    pokémon don't depend on how many are in the trade.
+    """
+
+    __slots__ = (
+        "users",
+        "channel",
+        "pokemon",
+        "by_idx",
+        "pokecoins",
+        "redeems",
+        "confirmed",
+        "executing",
+        "last_updated",
+        "menu",
+    )
+
+    def __init__(self, a, b, channel):
+        self.users = [a, b]
+        self.channel = channel
+        self.pokemon = {a.id: {}, b.id: {}}
+        self.by_idx = {a.id: {}, b.id: {}}
+        self.pokecoins = {a.id: 0, b.id: 0}
+        self.redeems = {a.id: 0, b.id: 0}
+        self.confirmed = {a.id: False, b.id: False}
+        self.executing = False
+        self.last_updated = datetime.utcnow()
+        self.menu = None
+
+    def partner(self, user):
+        a, b = self.users
+        return b if user.id == a.id else a
+
+    def unconfirm(self):
+        for user_id in self.confirmed:
+            self.confirmed[user_id] = False
+
+    # Pokémon
+
+    def num_pokemon(self, user_id):
+        return len(self.pokemon[user_id])
+
+    def get_pokemon(self, user_id, idx):
+        if (pokemon_id := self.by_idx[user_id].get(idx)) is None:
+            return None
+        return self.pokemon[user_id][pokemon_id]
+
+    def add_pokemon(self, user_id, pokemon):
+        """Adds a pokémon to a side of the trade. Returns False if it's already in it."""
+
+        if pokemon.id in self.pokemon[user_id] or pokemon.idx in self.by_idx[user_id]:
+            return False
+        self.pokemon[user_id][pokemon.id] = pokemon
+        self.by_idx[user_id][pokemon.idx] = pokemon.id
+        return True
+
+    def remove_pokemon(self, user_id, idx):
+        """Removes a pokémon from a side of the trade by idx, returning it if it was in it."""
+
+        if (pokemon_id := self.by_idx[user_id].pop(idx, None)) is None:
+            return None
+        return self.pokemon[user_id].pop(pokemon_id)
+
+    # Pages
+
+    def num_items(self, user_id):
+        return (self.pokecoins[user_id] > 0) + (self.redeems[user_id] > 0) + len(self.pokemon[user_id])
+
+    def num_pages(self):
+        return max(1, *(math.ceil(self.num_items(x) / TRADE_PAGE_SIZE) for x in self.pokemon))
+
+    def page(self, user_id, pidx):
+        """Returns the items on one page of a side of the trade, as tuples of
+        ``("c", pokécoins)``, ``("r", redeems)`` or ``("p", pokémon)``.
+        """
+
+        items = []
+        if self.pokecoins[user_id] > 0:
+            items.append(("c", self.pokecoins[user_id]))
+        if self.redeems[user_id] > 0:
+            items.append(("r", self.redeems[user_id]))
+
+        start, end = pidx * TRADE_PAGE_SIZE, (pidx + 1) * TRADE_PAGE_SIZE
+        pokemon = itertools.islice(self.pokemon[user_id].values(), max(start - len(items), 0), end - len(items))
+        return items[start:end] + [("p", x) for x in pokemon]
 
 
 class Trading(commands.Cog):
@@ -24,17 +113,14 @@ class Trading(commands.Cog):
         self.bot = bot
         if not hasattr(self.bot, "trades"):
             self.bot.loop.create_task(self.clear_trades())
-        self.process_cancel_trades.start()
-
-    @tasks.loop(seconds=0.1)
-    async def process_cancel_trades(self):
-        with await self.bot.redis as r:
-            req = await r.blpop(f"cancel_trade:{self.bot.cluster_idx}")
-            await self.end_trade(int(req[1]))
+        self.bot.loop.create_task(self.subscribe())
 
-    @process_cancel_trades.before_loop
-    async def before_process_cancel_trades(self):
+    async def subscribe(self):
         await self.bot.wait_until_ready()
+        self.bot.bus.subscribe("cancel_trade", self.handle_cancel_trade, cluster=self.bot.cluster_idx)
+
+    async def handle_cancel_trade(self, data):
+        await self.end_trade(data["user_id"])
 
     @commands.Cog.listener()
     async def on_message(self, message):
@@ -72,7 +158,7 @@ class Trading(commands.Cog):
         cluster_id = int(await self.bot.redis.hget("trade", user_id))
         if cluster_id == self.bot.cluster_idx:
             if user_id in self.bot.trades:
-                a, b = self.bot.trades[user_id]["users"]
+                a, b = self.bot.trades[user_id].users
                 self.bot.dispatch("trade", self.bot.trades[user_id])
                 await self.bot.redis.hdel("trade", a.id, b.id)
                 del self.bot.trades[a.id]
@@ -81,47 +167,37 @@ class Trading(commands.Cog):
                 await self.bot.redis.hdel("trade", user_id)
             return True
         else:
-            await self.bot.redis.rpush(f"cancel_trade:{cluster_id}", user_id)
+            await self.bot.bus.publish("cancel_trade", {"user_id": user_id}, cluster=cluster_id)
             return False
 
     async def send_trade(self, ctx, user: discord.Member):
         # TODO this code is pretty shit. although it does work
 
         trade = self.bot.trades[user.id]
-        a, b = trade["users"]
+        a, b = trade.users
 
         done = False
 
-        if trade[a.id] and trade[b.id] and not trade["executing"]:
+        if trade.confirmed[a.id] and trade.confirmed[b.id] and not trade.executing:
             done = True
-            trade["executing"] = True
+            trade.executing = True
 
-        num_pages = max(math.ceil(len(x) / 20) for x in trade["pokemon"].values())
+        num_pages = trade.num_pages()
 
         if done:
             execmsg = await ctx.send(ctx._("executing-trade"))
 
-        users = {k: [("p", x) for x in v] for k, v in trade["pokemon"].items()}
-        for x in users:
-            if trade["redeems"][x] > 0:
-                users[x].insert(0, ("r", trade["redeems"][x]))
-            if trade["pokecoins"][x] > 0:
-                users[x].insert(0, ("c", trade["pokecoins"][x]))
-
-        embed_pages = list(zip_longest(*[list(chunks(x, 20)) for x in users.values()]))
-
-        if len(embed_pages) == 0:
-            embed_pages = [[[], []]]
-
         async def get_page(source, menu, pidx):
             embed = self.bot.Embed(title=ctx._("trade-between", a=a.display_name, b=b.display_name))
 
             if done:
                 embed.title = ctx._("trade-completed", a=a.display_name, b=b.display_name)
 
-            for mem, page in zip((a, b), embed_pages[pidx]):
+            for mem in (a, b):
+                page = trade.page(mem.id, pidx)
+
                 try:
-                    maxn = max(x.idx for t, x in page or [] if t == "p")
+                    maxn = max(x.idx for t, x in page if t == "p")
                 except ValueError:
                     maxn = 0
 
@@ -139,16 +215,16 @@ class Trading(commands.Cog):
 
                 val = "\n".join(
                     ctx._("trade-pokecoins", coins=x) if t == "c" else f"{x:,} redeems" if t == "r" else txt(x)
-                    for t, x in page or []
+                    for t, x in page
                 )
 
                 if val == "":
-                    if len(users[mem.id]) == 0:
+                    if trade.num_items(mem.id) == 0:
                         val = ctx._("trade-none")
                     else:
                         val = ctx._("trade-none-on-this-page")
 
-                sign = "🟢" if trade[mem.id] else "🔴"
+                sign = "🟢" if trade.confirmed[mem.id] else "🔴"
 
                 embed.add_field(name=f"{sign} {mem.display_name}", value=val[:1024])
 
@@ -161,137 +237,57 @@ class Trading(commands.Cog):
         embeds = []
 
         if done:
-            try:
-                bothsides = list(enumerate(trade["pokemon"].items()))
-
-                for u in trade["users"]:
-                    member = await self.bot.mongo.fetch_member_info(u)
-                    if member.balance < trade["pokecoins"][u.id]:
-                        await ctx.send(ctx._("trade-needs-pokecoins"))
-                        await self.end_trade(a.id)
-                        return
-                    if member.redeems < trade["redeems"][u.id]:
-                        await ctx.send(ctx._("trade-needs-redeems"))
-                        await self.end_trade(a.id)
-                        return
-
-                for idx, (i, side) in bothsides:
-                    _, (oi, _) = bothsides[(idx + 1) % 2]
-
-                    mem = ctx.guild.get_member(i) or await ctx.guild.fetch_member(i)
-                    omem = ctx.guild.get_member(oi) or await ctx.guild.fetch_member(oi)
-
-                    if trade["pokecoins"][i] > 0:
-                        res = await self.bot.mongo.db.member.find_one_and_update(
-                            {"_id": mem.id}, {"$inc": {"balance": -trade["pokecoins"][i]}}
-                        )
-                        await self.bot.redis.hdel("db:member", mem.id)
-                        if res["balance"] >= trade["pokecoins"][i]:
-                            await self.bot.mongo.update_member(omem, {"$inc": {"balance": trade["pokecoins"][i]}})
-                        else:
-                            await self.bot.mongo.update_member(mem, {"$inc": {"balance": trade["pokecoins"][i]}})
-                            return await ctx.send(ctx._("trade-needs-pokecoins"))
-
-                    if trade["redeems"][i] > 0:
-                        res = await self.bot.mongo.db.member.find_one_and_update(
-                            {"_id": mem.id}, {"$inc": {"redeems": -trade["redeems"][i]}}
-                        )
-                        await self.bot.redis.hdel("db:member", mem.id)
-                        if res["redeems"] >= trade["redeems"][i]:
-                            await self.bot.mongo.update_member(omem, {"$inc": {"redeems": trade["redeems"][i]}})
-                        else:
-                            await self.bot.mongo.update_member(mem, {"$inc": {"redeems": trade["redeems"][i]}})
-                            return await ctx.send(ctx._("trade-needs-redeems"))
-
-                for idx, (i, side) in bothsides:
-                    _, (oi, _) = bothsides[(idx + 1) % 2]
-
-                    mem = ctx.guild.get_member(i) or await ctx.guild.fetch_member(i)
-                    omem = ctx.guild.get_member(oi) or await ctx.guild.fetch_member(oi)
-
-                    idxs = set()
-
-                    num_pokes = len(list(x for x in side if type(x) != int))
-                    idx = await self.bot.mongo.fetch_next_idx(omem, num_pokes)
-
-                    for x in side:
-                        pokemon = x
-
-                        if pokemon.idx in idxs:
-                            continue
-
-                        idxs.add(pokemon.idx)
-
-                        update = {
-                            "$set": {
-                                "owner_id": omem.id,
-                                "idx": idx,
-                            }
-                        }
-                        idx += 1
-
-                        if pokemon.held_item != 13001:
-                            evos = [
-                                evo
-                                for evo in pokemon.species.trade_evolutions
-                                if (evo.trigger.item is None or evo.trigger.item.id == pokemon.held_item)
-                            ]
-
-                            if len(evos) > 0:
-                                evo = random.choice(evos)
-
-                                evo_embed = self.bot.Embed(title=ctx._("congratulations", name=omem.display_name))
-
-                                name = str(pokemon.species)
-
-                                if pokemon.nickname is not None:
-                                    name += f' "{pokemon.nickname}"'
-
-                                evo_embed.add_field(
-                                    name=ctx._("pokemon-evolving", pokemon=name),
-                                    value=ctx._("pokemon-turned-into", old=name, new=str(evo.target)),
-                                )
-
-                                self.bot.dispatch("evolve", mem, pokemon, evo.target)
-                                self.bot.dispatch("evolve", omem, pokemon, evo.target)
-
-                                update["$set"]["species_id"] = evo.target.id
-
-                                embeds.append(evo_embed)
-
-                        await self.bot.mongo.update_pokemon(
-                            pokemon,
-                            update,
-                        )
+            # Trade evolutions are decided up front, so the whole trade can be
+            # written in one transaction.
+            evolutions = {}
+            for user in trade.users:
+                for pokemon in trade.pokemon[user.id].values():
+                    if pokemon.held_item == 13001:
+                        continue
+                    evos = [
+                        evo
+                        for evo in pokemon.species.trade_evolutions
+                        if (evo.trigger.item is None or evo.trigger.item.id == pokemon.held_item)
+                    ]
+                    if len(evos) > 0:
+                        evolutions[pokemon.id] = (user, pokemon, random.choice(evos).target)
 
+            try:
+                await self.bot.mongo.execute_trade(
+                    [a.id, b.id],
+                    trade.pokecoins,
+                    trade.redeems,
+                    {x.id: list(trade.pokemon[x.id]) for x in trade.users},
+                    {k: target.id for k, (_, _, target) in evolutions.items()},
+                )
+            except TradeFailed as e:
+                await self.end_trade(a.id)
+                return await ctx.send(ctx._(str(e)))
             except:
                 await self.end_trade(a.id)
                 raise
 
-            try:
-                await execmsg.delete()
-            except:
-                pass
+            for user, pokemon, target in evolutions.values():
+                partner = trade.partner(user)
+                evo_embed = self.bot.Embed(title=ctx._("congratulations", name=partner.display_name))
 
-            try:
-                await self.bot.mongo.db.logs.insert_one(
-                    {
-                        "event": "trade",
-                        "users": [a.id, b.id],
-                        "pokemon": {
-                            str(a.id): [x.id for x in trade["pokemon"][a.id]],
-                            str(b.id): [x.id for x in trade["pokemon"][b.id]],
-                        },
-                        "pokecoins": {
-                            str(a.id): trade["pokecoins"][a.id],
-                            str(b.id): trade["pokecoins"][b.id],
-                        },
-                        "redeems": {
-                            str(a.id): trade["redeems"][a.id],
-                            str(b.id): trade["redeems"][b.id],
-                        },
-                    }
+                name = str(pokemon.species)
+
+                if pokemon.nickname is not None:
+                    name += f' "{pokemon.nickname}"'
+
+                evo_embed.add_field(
+                    name=ctx._("pokemon-evolving", pokemon=name),
+                    value=ctx._("pokemon-turned-into", old=name, new=str(target)),
                 )
+
+                self.bot.dispatch("evolve", user, pokemon, target)
+                self.bot.dispatch("evolve", partner, pokemon, target)
+
+                embeds.append(evo_embed)
+
+            try:
+                await execmsg.delete()
             except:
                 pass
 
@@ -302,11 +298,11 @@ class Trading(commands.Cog):
         pages = pagination.ContinuablePages(pagination.FunctionPageSource(num_pages, get_page))
         self.bot.menus[a.id] = pages
         self.bot.menus[b.id] = pages
-        if menu := trade.get("menu"):
+        if menu := trade.menu:
             menu.stop()
             await menu.message.delete()
         await pages.start(ctx)
-        trade["menu"] = pages
+        trade.menu = pages
 
         for evo_embed in embeds:
             await ctx.send(embed=evo_embed)
@@ -352,17 +348,7 @@ class Trading(commands.Cog):
         if await self.is_in_trade(user):
             return await ctx.send(ctx._("cannot-accept-trade-while-trading"))
 
-        trade = {
-            "pokemon": {ctx.author.id: [], user.id: []},
-            "redeems": {ctx.author.id: 0, user.id: 0},
-            "pokecoins": {ctx.author.id: 0, user.id: 0},
-            "users": [ctx.author, user],
-            ctx.author.id: False,
-            user.id: False,
-            "channel": ctx.channel,
-            "executing": False,
-            "last_updated": datetime.utcnow(),
-        }
+        trade = TradeSession(ctx.author, user, ctx.channel)
         self.bot.trades[ctx.author.id] = trade
         self.bot.trades[user.id] = trade
         await self.bot.redis.hset("trade", ctx.author.id, self.bot.cluster_idx)
@@ -378,7 +364,7 @@ class Trading(commands.Cog):
             return await ctx.send(ctx._("not-in-trade"))
 
         try:
-            if self.bot.trades[ctx.author.id]["executing"]:
+            if self.bot.trades[ctx.author.id].executing:
                 return await ctx.send(ctx._("trade-loading"))
         except KeyError:
             pass
@@ -397,14 +383,16 @@ class Trading(commands.Cog):
         if not await self.is_in_trade(ctx.author):
             return await ctx.send(ctx._("not-in-trade"))
 
-        if self.bot.trades[ctx.author.id]["executing"]:
+        if self.bot.trades[ctx.author.id].executing:
             return await ctx.send(ctx._("trade-loading"))
 
-        last_updated = self.bot.trades[ctx.author.id]["last_updated"]
+        last_updated = self.bot.trades[ctx.author.id].last_updated
         if datetime.utcnow() - last_updated < timedelta(seconds=3):
             return await ctx.reply(ctx._("trade-was-recently-modified"))
 
-        self.bot.trades[ctx.author.id][ctx.author.id] = not self.bot.trades[ctx.author.id][ctx.author.id]
+        self.bot.trades[ctx.author.id].confirmed[ctx.author.id] = not self.bot.trades[ctx.author.id].confirmed[
+            ctx.author.id
+        ]
 
         await self.send_trade(ctx, ctx.author)
 
@@ -418,10 +406,10 @@ class Trading(commands.Cog):
         if not await self.is_in_trade(ctx.author):
             return await ctx.send(ctx._("not-in-trade"))
 
-        if ctx.channel.id != self.bot.trades[ctx.author.id]["channel"].id:
+        if ctx.channel.id != self.bot.trades[ctx.author.id].channel.id:
             return await ctx.send(ctx._("same-channel-to-add"))
 
-        if self.bot.trades[ctx.author.id]["executing"]:
+        if self.bot.trades[ctx.author.id].executing:
             return await ctx.send(ctx._("trade-loading"))
 
         if len(args) == 0:
@@ -436,19 +424,12 @@ class Trading(commands.Cog):
 
             for what in args:
                 if what.isdigit():
-                    skip = False
-
                     if not 1 <= int(what) <= 2**31 - 1:
                         lines.append(ctx._("trade-add-firm-refusal", thing=what))
                         continue
 
-                    for x in self.bot.trades[ctx.author.id]["pokemon"][ctx.author.id]:
-                        if x.idx == int(what):
-                            lines.append(ctx._("trade-add-pokemon-already-in-trade", thing=what))
-                            skip = True
-                            break
-
-                    if skip:
+                    if self.bot.trades[ctx.author.id].get_pokemon(ctx.author.id, int(what)) is not None:
+                        lines.append(ctx._("trade-add-pokemon-already-in-trade", thing=what))
                         continue
 
                     number = int(what)
@@ -467,7 +448,7 @@ class Trading(commands.Cog):
                         lines.append(ctx._("trade-add-cannot-trade-favorited-pokemon", thing=what))
                         continue
 
-                    self.bot.trades[ctx.author.id]["pokemon"][ctx.author.id].append(pokemon)
+                    self.bot.trades[ctx.author.id].add_pokemon(ctx.author.id, pokemon)
                     updated = True
                 else:
                     lines.append(ctx._("trade-add-invalid-item-to-add", thing=what))
@@ -479,11 +460,9 @@ class Trading(commands.Cog):
             if not updated:
                 return
 
-        for k in self.bot.trades[ctx.author.id]:
-            if type(k) == int:
-                self.bot.trades[ctx.author.id][k] = False
+        self.bot.trades[ctx.author.id].unconfirm()
 
-        self.bot.trades[ctx.author.id]["last_updated"] = datetime.utcnow()
+        self.bot.trades[ctx.author.id].last_updated = datetime.utcnow()
         await self.send_trade(ctx, ctx.author)
 
     @checks.has_started()
@@ -496,24 +475,22 @@ class Trading(commands.Cog):
         if not await self.is_in_trade(ctx.author):
             return await ctx.send(ctx._("not-in-trade"))
 
-        if ctx.channel.id != self.bot.trades[ctx.author.id]["channel"].id:
+        if ctx.channel.id != self.bot.trades[ctx.author.id].channel.id:
             return await ctx.send(ctx._("same-channel-to-add"))
 
-        if self.bot.trades[ctx.author.id]["executing"]:
+        if self.bot.trades[ctx.author.id].executing:
             return await ctx.send(ctx._("trade-loading"))
 
         if amt < 0:
             return await ctx.send(ctx._("amount-must-be-positive"))
 
         member = await self.bot.mongo.fetch_member_info(ctx.author)
-        if self.bot.trades[ctx.author.id]["pokecoins"][ctx.author.id] + amt > member.balance:
+        if self.bot.trades[ctx.author.id].pokecoins[ctx.author.id] + amt > member.balance:
             return await ctx.send(ctx._("not-enough-coins"))
 
-        self.bot.trades[ctx.author.id]["pokecoins"][ctx.author.id] += amt
+        self.bot.trades[ctx.author.id].pokecoins[ctx.author.id] += amt
 
-        for k in self.bot.trades[ctx.author.id]:
-            if type(k) == int:
-                self.bot.trades[ctx.author.id][k] = False
+        self.bot.trades[ctx.author.id].unconfirm()
 
         await self.send_trade(ctx, ctx.author)
 
@@ -527,24 +504,22 @@ class Trading(commands.Cog):
         if not await self.is_in_trade(ctx.author):
             return await ctx.send(ctx._("not-in-trade"))
 
-        if ctx.channel.id != self.bot.trades[ctx.author.id]["channel"].id:
+        if ctx.channel.id != self.bot.trades[ctx.author.id].channel.id:
             return await ctx.send(ctx._("same-channel-to-add"))
 
-        if self.bot.trades[ctx.author.id]["executing"]:
+        if self.bot.trades[ctx.author.id].executing:
             return await ctx.send(ctx._("trade-loading"))
 
         if amt < 0:
             return await ctx.send(ctx._("amount-must-be-positive"))
 
         member = await self.bot.mongo.fetch_member_info(ctx.author)
-        if self.bot.trades[ctx.author.id]["redeems"][ctx.author.id] + amt > member.redeems:
+        if self.bot.trades[ctx.author.id].redeems[ctx.author.id] + amt > member.redeems:
             return await ctx.send(ctx._("not-enough-redeems"))
 
-        self.bot.trades[ctx.author.id]["redeems"][ctx.author.id] += amt
+        self.bot.trades[ctx.author.id].redeems[ctx.author.id] += amt
 
-        for k in self.bot.trades[ctx.author.id]:
-            if type(k) == int:
-                self.bot.trades[ctx.author.id][k] = False
+        self.bot.trades[ctx.author.id].unconfirm()
 
         await self.send_trade(ctx, ctx.author)
 
@@ -560,10 +535,10 @@ class Trading(commands.Cog):
         if not await self.is_in_trade(ctx.author):
             return await ctx.send(ctx._("not-in-trade"))
 
-        if ctx.channel.id != self.bot.trades[ctx.author.id]["channel"].id:
+        if ctx.channel.id != self.bot.trades[ctx.author.id].channel.id:
             return await ctx.send(ctx._("same-channel-to-remove"))
 
-        if self.bot.trades[ctx.author.id]["executing"]:
+        if self.bot.trades[ctx.author.id].executing:
             return await ctx.send(ctx._("trade-loading"))
 
         if len(args) == 0:
@@ -577,11 +552,8 @@ class Trading(commands.Cog):
             updated = False
             for what in args:
                 if what.isdigit():
-                    for idx, x in enumerate(trade["pokemon"][ctx.author.id]):
-                        if x.idx == int(what):
-                            del trade["pokemon"][ctx.author.id][idx]
-                            updated = True
-                            break
+                    if trade.remove_pokemon(ctx.author.id, int(what)) is not None:
+                        updated = True
                     else:
                         await ctx.send(ctx._("trade-unknown-item", thing=what))
                 else:
@@ -591,9 +563,7 @@ class Trading(commands.Cog):
             if not updated:
                 return
 
-        for k in self.bot.trades[ctx.author.id]:
-            if type(k) == int:
-                self.bot.trades[ctx.author.id][k] = False
+        self.bot.trades[ctx.author.id].unconfirm()
 
         await self.send_trade(ctx, ctx.author)
 
@@ -607,23 +577,21 @@ class Trading(commands.Cog):
         if not await self.is_in_trade(ctx.author):
             return await ctx.send(ctx._("not-in-trade"))
 
-        if ctx.channel.id != self.bot.trades[ctx.author.id]["channel"].id:
+        if ctx.channel.id != self.bot.trades[ctx.author.id].channel.id:
             return await ctx.send(ctx._("same-channel-to-remove"))
 
-        if self.bot.trades[ctx.author.id]["executing"]:
+        if self.bot.trades[ctx.author.id].executing:
             return await ctx.send(ctx._("trade-loading"))
 
         if amt < 0:
             return await ctx.send(ctx._("amount-must-be-positive"))
 
-        if self.bot.trades[ctx.author.id]["pokecoins"][ctx.author.id] - amt < 0:
+        if self.bot.trades[ctx.author.id].pokecoins[ctx.author.id] - amt < 0:
             return await ctx.send(ctx._("not-that-many-pokecoins"))
 
-        self.bot.trades[ctx.author.id]["pokecoins"][ctx.author.id] -= amt
+        self.bot.trades[ctx.author.id].pokecoins[ctx.author.id] -= amt
 
-        for k in self.bot.trades[ctx.author.id]:
-            if type(k) == int:
-                self.bot.trades[ctx.author.id][k] = False
+        self.bot.trades[ctx.author.id].unconfirm()
 
         await self.send_trade(ctx, ctx.author)
 
@@ -637,23 +605,21 @@ class Trading(commands.Cog):
         if not await self.is_in_trade(ctx.author):
             return await ctx.send(ctx._("not-in-trade"))
 
-        if ctx.channel.id != self.bot.trades[ctx.author.id]["channel"].id:
+        if ctx.channel.id != self.bot.trades[ctx.author.id].channel.id:
             return await ctx.send(ctx._("same-channel-to-add"))
 
-        if self.bot.trades[ctx.author.id]["executing"]:
+        if self.bot.trades[ctx.author.id].executing:
             return await ctx.send(ctx._("trade-loading"))
 
         if amt < 0:
             return await ctx.send(ctx._("amount-must-be-positive"))
 
-        if self.bot.trades[ctx.author.id]["redeems"][ctx.author.id] - amt < 0:
+        if self.bot.trades[ctx.author.id].redeems[ctx.author.id] - amt < 0:
             return await ctx.send(ctx._("not-that-many-redeems"))
 
-        self.bot.trades[ctx.author.id]["redeems"][ctx.author.id] -= amt
+        self.bot.trades[ctx.author.id].redeems[ctx.author.id] -= amt
 
-        for k in self.bot.trades[ctx.author.id]:
-            if type(k) == int:
-                self.bot.trades[ctx.author.id][k] = False
+        self.bot.trades[ctx.author.id].unconfirm()
 
         await self.send_trade(ctx, ctx.author)
 
@@ -706,10 +672,10 @@ class Trading(commands.Cog):
         if not await self.is_in_trade(ctx.author):
             return await ctx.send(ctx._("not-in-trade"))
 
-        if ctx.channel.id != self.bot.trades[ctx.author.id]["channel"].id:
+        if ctx.channel.id != self.bot.trades[ctx.author.id].channel.id:
             return await ctx.send(ctx._("same-channel-to-add"))
 
-        if self.bot.trades[ctx.author.id]["executing"]:
+        if self.bot.trades[ctx.author.id].executing:
             return await ctx.send(ctx._("trade-loading"))
 
         member = await self.bot.mongo.fetch_member_info(ctx.author)
@@ -733,7 +699,7 @@ class Trading(commands.Cog):
 
         # confirm
 
-        trade_size = len(self.bot.trades[ctx.author.id]["pokemon"][ctx.author.id])
+        trade_size = self.bot.trades[ctx.author.id].num_pokemon(ctx.author.id)
 
         if 3000 - trade_size < 0:
             return await ctx.send(ctx._("too-many-pokemon-in-trade"))
@@ -753,19 +719,10 @@ class Trading(commands.Cog):
 
         pokemon = self.bot.mongo.fetch_pokemon_list(ctx.author, aggregations)
 
-        self.bot.trades[ctx.author.id]["pokemon"][ctx.author.id].extend(
-            [
-                x
-                async for x in pokemon
-                if all(
-                    (type(i) == int or x.idx != i.idx for i in self.bot.trades[ctx.author.id]["pokemon"][ctx.author.id])
-                )
-            ]
-        )
+        async for x in pokemon:
+            self.bot.trades[ctx.author.id].add_pokemon(ctx.author.id, x)
 
-        for k in self.bot.trades[ctx.author.id]:
-            if type(k) == int:
-                self.bot.trades[ctx.author.id][k] = False
+        self.bot.trades[ctx.author.id].unconfirm()
 
         await self.send_trade(ctx, ctx.author)
 
@@ -778,14 +735,12 @@ class Trading(commands.Cog):
         if not await self.is_in_trade(ctx.author):
             return await ctx.send(ctx._("not-in-trade"))
 
-        other_id = next(x for x in self.bot.trades[ctx.author.id] if type(x) == int and x != ctx.author.id)
+        trade = self.bot.trades[ctx.author.id]
+        other_id = trade.partner(ctx.author).id
         other = ctx.guild.get_member(other_id) or await ctx.guild.fetch_member(other_id)
 
-        try:
-            pokemon = next(
-                x for x in self.bot.trades[ctx.author.id]["pokemon"][other_id] if type(x) != int and x.idx == number
-            )
-        except StopIteration:
+        pokemon = trade.get_pokemon(other_id, number)
+        if pokemon is None:
             return await ctx.send(ctx._("couldnt-find-pokemon-in-trade"))
 
         field_values = {}
@@ -834,7 +789,7 @@ class Trading(commands.Cog):
         await ctx.send(embed=embed)
 
     def cog_unload(self):
-        self.process_cancel_trades.cancel()
+        self.bot.bus.unsubscribe("cancel_trade", cluster=self.bot.cluster_idx)
 
 
 async def setup(bot: commands.Bot):
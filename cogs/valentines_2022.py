@@ -109,6 +109,7 @@ class Valentines(commands.Cog):
                 "nickname": f"Gift from {ctx.author}",
             }
         )
+        await self.bot.mongo.bump_collection_version(user)
 
         embed = discord.Embed(
             title="Valentine's Day Card \N{HEART WITH RIBBON}",
@@ -230,6 +230,7 @@ class Valentines(commands.Cog):
             return await ctx.send("I could not send your card to that user! The user might have their DMs off.")
 
         await self.bot.mongo.db.pokemon.insert_one(pokemon.to_mongo())
+        await self.bot.mongo.bump_collection_version(user)
         await ctx.send("Your gift has been sent.")
 
 
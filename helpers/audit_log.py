@@ -0,0 +1,198 @@
+"""
+A buffered writer for the ``logs`` audit collection. Entries are kept in memory
+and inserted in batches, whenever a batch fills up or every
+``AUDIT_LOG_FLUSH_INTERVAL`` seconds, whichever is sooner.
+
+Batches that can't be inserted are appended to a local spill file of BSON
+documents, and inserted once Mongo is back. Until then, everything written is
+spilled at each flush without trying Mongo, so entries don't pile up in memory
+while each insert waits to time out.
+
+Entries are stamped with the ``time`` they were written, which is when what
+they record happened. Their ``_id`` is only assigned when they're inserted, so
+that the market price statistics, which read the logs in ``_id`` order, don't
+skip over entries that were held back.
+"""
+
+import asyncio
+import os
+import tempfile
+import time
+from datetime import datetime
+
+import bson
+import bson.errors
+import pymongo.errors
+
+from helpers import metrics
+
+# How many entries are inserted at once, at most.
+AUDIT_LOG_BATCH_SIZE = 500
+
+# The longest an entry waits in memory before it's inserted, in seconds.
+AUDIT_LOG_FLUSH_INTERVAL = 1
+
+# How long to wait between attempts to insert spilled entries, in seconds.
+AUDIT_LOG_REPLAY_INTERVAL = 30
+
+DEFAULT_SPILL_DIR = os.path.join(tempfile.gettempdir(), "poketwo-audit-log")
+
+AUDIT_LOG_FLUSH_DURATION = metrics.REGISTRY.register(
+    metrics.Histogram(
+        "poketwo_audit_log_flush_duration_seconds", "How long inserting a batch of audit log entries took."
+    )
+)
+AUDIT_LOG_BATCH_SIZES = metrics.REGISTRY.register(
+    metrics.Histogram(
+        "poketwo_audit_log_batch_size",
+        "How many audit log entries were inserted at once.",
+        buckets=(1, 2, 5, 10, 25, 50, 100, 250, AUDIT_LOG_BATCH_SIZE),
+    )
+)
+AUDIT_LOG_ENTRIES = metrics.REGISTRY.register(
+    metrics.Counter(
+        "poketwo_audit_log_entries_total",
+        "What happened to audit log entries: inserted, spilled to disk, replayed from disk, or dropped.",
+        ("outcome",),
+    )
+)
+
+
+class AuditLog:
+    def __init__(self, collection, spill_path, *, log):
+        self.collection = collection
+        self.spill_path = spill_path
+        self.log = log
+        self.buffer = []
+        # Whether Mongo took the last insert. Once it doesn't, entries are
+        # spilled until a replay gets through.
+        self.available = True
+        self._full = asyncio.Event()
+        self._task = None
+        self._closing = False
+        self._last_replay = 0
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    def write(self, entry):
+        """Queues an entry to be inserted. Never blocks, and never fails."""
+
+        entry.setdefault("time", datetime.utcnow())
+        self.buffer.append(entry)
+        if len(self.buffer) >= AUDIT_LOG_BATCH_SIZE:
+            self._full.set()
+
+    async def run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._full.wait(), AUDIT_LOG_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+
+            try:
+                await self.flush()
+                if not self._closing and time.monotonic() - self._last_replay > AUDIT_LOG_REPLAY_INTERVAL:
+                    await self.replay()
+            except Exception:
+                self.log.exception("audit_log.error")
+
+    async def flush(self):
+        """Inserts everything in the buffer, spilling whatever can't be."""
+
+        while len(self.buffer) > 0:
+            if not self.available:
+                batch, self.buffer = self.buffer, []
+                self.spill(batch)
+                return
+            batch = self.buffer[:AUDIT_LOG_BATCH_SIZE]
+            del self.buffer[:AUDIT_LOG_BATCH_SIZE]
+            await self.insert(batch)
+
+    async def insert(self, batch, *, outcome="inserted"):
+        start = time.perf_counter()
+        try:
+            await self.collection.insert_many(batch, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            # These entries were rejected, and would be every time, so there's
+            # no point in spilling them.
+            errors = e.details["writeErrors"]
+            for error in errors:
+                self.log.error("audit_log.dropped", entry=batch[error["index"]], error=error["errmsg"])
+            AUDIT_LOG_ENTRIES.inc("dropped", amount=len(errors))
+            AUDIT_LOG_ENTRIES.inc(outcome, amount=len(batch) - len(errors))
+            return True
+        except pymongo.errors.PyMongoError as e:
+            self.log.warning("audit_log.insert_failed", count=len(batch), error=str(e))
+            self.available = False
+            self.spill(batch)
+            return False
+
+        AUDIT_LOG_FLUSH_DURATION.observe(time.perf_counter() - start)
+        AUDIT_LOG_BATCH_SIZES.observe(len(batch))
+        AUDIT_LOG_ENTRIES.inc(outcome, amount=len(batch))
+        return True
+
+    def spill(self, entries):
+        # Appended BSON documents are self-delimiting, so a file cut short by a
+        # crash only loses the last entry.
+        try:
+            os.makedirs(os.path.dirname(self.spill_path), exist_ok=True)
+            with open(self.spill_path, "ab") as f:
+                for entry in entries:
+                    entry.pop("_id", None)
+                    f.write(bson.encode(entry))
+        except Exception:
+            self.log.exception("audit_log.dropped", count=len(entries))
+            AUDIT_LOG_ENTRIES.inc("dropped", amount=len(entries))
+        else:
+            AUDIT_LOG_ENTRIES.inc("spilled", amount=len(entries))
+
+    async def replay(self):
+        """Inserts entries that were spilled to disk, if there are any."""
+
+        self._last_replay = time.monotonic()
+
+        # Entries spilled while this runs go to a new file.
+        replaying = f"{self.spill_path}.replaying"
+        if not os.path.exists(replaying):
+            try:
+                os.replace(self.spill_path, replaying)
+            except FileNotFoundError:
+                # Nothing to try Mongo with, so try it with the next flush.
+                self.available = True
+                return
+
+        entries = []
+        with open(replaying, "rb") as f:
+            try:
+                for entry in bson.decode_file_iter(f):
+                    entries.append(entry)
+            except bson.errors.InvalidBSON:
+                self.log.warning("audit_log.spill_truncated", path=replaying, count=len(entries))
+
+        self.log.info("audit_log.replaying", count=len(entries))
+        for i in range(0, len(entries), AUDIT_LOG_BATCH_SIZE):
+            if not await self.insert(entries[i : i + AUDIT_LOG_BATCH_SIZE], outcome="replayed"):
+                # The rest can wait for the next replay.
+                self.spill(entries[i + AUDIT_LOG_BATCH_SIZE :])
+                break
+        else:
+            self.available = True
+
+        # Only now, so a crash partway through inserts some entries twice rather
+        # than losing them.
+        os.remove(replaying)
+
+    async def close(self):
+        """Stops flushing periodically, and flushes what's left."""
+
+        if self._task is not None:
+            # Lets a flush or replay in progress finish, rather than cancelling
+            # it partway through an insert Mongo might still complete.
+            self._closing = True
+            self._full.set()
+            await self._task
+            self._task = None
+        await self.flush()
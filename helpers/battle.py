@@ -0,0 +1,211 @@
+"""
+The battle engine. This resolves battle turns synchronously over plain battle
+state, without anything to do with Discord, so it can be driven by the
+Battling cog, or run headless in bulk by the simulation harness.
+"""
+
+import data.constants
+from data import models
+
+# A battle ends after this many turns in a row where both trainers passed.
+MAX_PASSED_TURNS = 3
+
+
+class Battler:
+    """The state of one pokémon in a battle. Stats are worked out once when the
+    battle starts, rather than on every access like on the pokémon itself.
+    Anything else, like its idx or IVs, comes from the pokémon it's for.
+    """
+
+    __slots__ = (
+        "pokemon",
+        "species",
+        "level",
+        "moves",
+        "max_hp",
+        "hp",
+        "atk",
+        "defn",
+        "satk",
+        "sdef",
+        "spd",
+        "stages",
+        "ailments",
+    )
+
+    def __init__(self, species, level, moves, max_hp, atk, defn, satk, sdef, spd, *, hp=None, pokemon=None):
+        self.pokemon = pokemon
+        self.species = species
+        self.level = level
+        self.moves = moves
+        self.max_hp = max_hp
+        self.hp = max_hp if hp is None else hp
+        self.atk = atk
+        self.defn = defn
+        self.satk = satk
+        self.sdef = sdef
+        self.spd = spd
+        self.stages = models.StatStages()
+        self.ailments = set()
+
+    @classmethod
+    def from_pokemon(cls, pokemon):
+        return cls(
+            pokemon.species,
+            pokemon.level,
+            list(pokemon.moves),
+            pokemon.max_hp,
+            pokemon.atk,
+            pokemon.defn,
+            pokemon.satk,
+            pokemon.sdef,
+            pokemon.spd,
+            hp=pokemon.hp,
+            pokemon=pokemon,
+        )
+
+    def __getattr__(self, name):
+        if name in Battler.__slots__:
+            raise AttributeError(name)
+        return getattr(self.pokemon, name)
+
+
+class Side:
+    """One trainer's party, and which of it is out."""
+
+    __slots__ = ("pokemon", "selected_idx")
+
+    def __init__(self, pokemon=None):
+        self.pokemon = pokemon or []
+        self.selected_idx = 0
+
+    @property
+    def selected(self):
+        if self.selected_idx == -1:
+            return None
+        return self.pokemon[self.selected_idx]
+
+
+class Step:
+    """What happened when one trainer's action was carried out: the kind of
+    action, the index of the side that took it, its priority, the pokémon that
+    took it, and for moves, the move, its target and its result. ``fainted`` is
+    the pokémon that fainted afterwards, if any.
+    """
+
+    __slots__ = ("kind", "side", "priority", "battler", "move", "target", "result", "fainted")
+
+    def __init__(self, kind, side, priority, battler=None, move=None, target=None, result=None):
+        self.kind = kind
+        self.side = side
+        self.priority = priority
+        self.battler = battler
+        self.move = move
+        self.target = target
+        self.result = result
+        self.fainted = None
+
+
+def get_priority(action, selected):
+    if action["type"] == "move":
+        s = selected.spd
+        if "Paralysis" in selected.ailments:
+            s *= 0.5
+        return (
+            action["value"].priority * 1e20 + selected.spd * data.constants.STAT_STAGE_MULTIPLIERS[selected.stages.spd]
+        )
+
+    return 1e99
+
+
+class BattleEngine:
+    """Resolves the turns of a battle between two sides. Actions are dicts with
+    a ``type`` of move, switch, pass or flee, and a ``value`` of the move or
+    the index of the pokémon to switch to.
+    """
+
+    __slots__ = ("sides", "passed_turns", "over", "winner")
+
+    def __init__(self, sides):
+        self.sides = sides
+        self.passed_turns = 0
+        self.over = False
+        self.winner = None
+
+    def end(self, winner=None):
+        self.over = True
+        self.winner = winner
+
+    def resolve_turn(self, actions):
+        """Carries out one action from each side, and returns the steps that
+        happened in the order they happened. The battle may be over afterwards,
+        in which case ``winner`` is the index of the winning side, or None if
+        both trainers passed too many times.
+        """
+
+        if self.over:
+            return []
+
+        if actions[0]["type"] == "pass" and actions[1]["type"] == "pass":
+            self.passed_turns += 1
+
+        if self.passed_turns >= MAX_PASSED_TURNS:
+            self.end()
+            return []
+
+        order = [
+            (get_priority(action, self.sides[i].selected), i, action, self.sides[i], self.sides[1 - i])
+            for i, action in enumerate(actions)
+        ]
+
+        for side in self.sides:
+            if "Burn" in side.selected.ailments:
+                side.selected.hp = max(side.selected.hp - 1 / 16 * side.selected.max_hp, 0)
+            if "Poison" in side.selected.ailments:
+                side.selected.hp = max(side.selected.hp - 1 / 8 * side.selected.max_hp, 0)
+
+        steps = []
+
+        for priority, i, action, side, opponent in sorted(order, key=lambda x: x[0], reverse=True):
+            step = Step(action["type"], i, priority)
+            steps.append(step)
+
+            if action["type"] == "flee":
+                self.end(1 - i)
+                return steps
+
+            elif action["type"] == "switch":
+                side.selected_idx = action["value"]
+                step.battler = side.selected
+
+            elif action["type"] == "move":
+                step.battler = side.selected
+                step.move = action["value"]
+                step.target = opponent.selected
+                step.result = result = step.move.calculate_turn(side.selected, opponent.selected)
+
+                if result.success:
+                    opponent.selected.hp -= result.damage
+                    side.selected.hp += result.healing
+                    side.selected.hp = max(min(side.selected.hp, side.selected.max_hp), 0)
+
+                    if result.ailment:
+                        opponent.selected.ailments.add(result.ailment)
+
+                    for change in result.stat_changes:
+                        target = side.selected if step.move.target_id == 7 else opponent.selected
+                        setattr(target.stages, change.stat, getattr(target.stages, change.stat) + change.change)
+
+            if opponent.selected.hp <= 0:
+                opponent.selected.hp = 0
+                step.fainted = opponent.selected
+
+                try:
+                    opponent.selected_idx = next(idx for idx, x in enumerate(opponent.pokemon) if x.hp > 0)
+                except StopIteration:
+                    opponent.selected_idx = -1
+                    self.end(i)
+
+                break
+
+        return steps
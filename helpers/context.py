@@ -1,3 +1,5 @@
+import asyncio
+import contextlib
 import typing
 from typing import Any
 
@@ -131,41 +133,64 @@ class ConfirmationYesNoView(discord.ui.View):
 class PoketwoContext(commands.Context):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.log = self.bot.log.bind(
-            guild=self.guild and self.guild.name,
-            guild_id=self.guild and self.guild.id,
-            channel=self.guild and self.channel.name,
-            channel_id=self.channel.id,
-            user_id=self.author.id,
-            user=str(self.author),
-            message=self.message.content,
-            message_id=self.message.id,
-            command=self.command and self.command.qualified_name,
-            command_args=self.args,
-            command_kwargs=self.kwargs,
-        )
+        self.command_lock = None
+        self.locale = None
+
+    @property
+    def log(self) -> structlog.BoundLogger:
+        # The context's fields are only added to events that are actually
+        # logged, see helpers.logs.add_context_fields.
+        return self.bot.log.bind(_ctx=self)
+
+    def log_fields(self) -> dict[str, typing.Any]:
+        return {
+            "guild": self.guild and self.guild.name,
+            "guild_id": self.guild and self.guild.id,
+            "channel": self.guild and self.channel.name,
+            "channel_id": self.channel.id,
+            "user_id": self.author.id,
+            "user": str(self.author),
+            "message": self.message.content,
+            "message_id": self.message.id,
+            "command": self.command and self.command.qualified_name,
+            "command_args": self.args,
+            "command_kwargs": self.kwargs,
+        }
 
     def _(self, message_id: str, **kwargs: typing.Any) -> str:
-        """Formats a localization string from a message while setting the last
-        known prefix value.
+        """Formats a localization string from a message in the user's locale,
+        with commands formatted with the prefix they used.
         """
-        # TODO: In the future, pass on the user's preferred language.
-        # HACK: Reach into the Lang cog and update its last known prefix value,
-        # so Fluent localizations that use the `COMMAND` function format
-        # correctly.
-        #
-        # This could be done properly if terms weren't forced to be
-        # parameterized with solely literals; that prevents us from passing it
-        # the usual way.
-        self.bot.get_cog("Lang")._last_known_prefix = self.clean_prefix
-        return self.bot._(message_id, **kwargs)
+        with self.bot.get_cog("Lang").localize(self.locale, self.clean_prefix):
+            return self.bot._(message_id, **kwargs)
 
     def localized_embed(self, *args, **kwargs) -> discord.Embed:
-        """A shortcut for ``bot.localized_embed``. See original for more
-        information.
+        """A shortcut for ``bot.localized_embed`` in the user's locale. See
+        original for more information.
+        """
+        with self.bot.get_cog("Lang").localize(self.locale, self.clean_prefix):
+            return self.bot.localized_embed(*args, **kwargs)
+
+    @contextlib.asynccontextmanager
+    async def keep_command_lock(self, interval=20):
+        """Keeps renewing the per-user command lock while the block runs, for
+        commands that may take longer than the lock's timeout.
         """
-        # TODO: In the future, pass on the user's preferred language.
-        return self.bot.localized_embed(*args, **kwargs)
+
+        if self.command_lock is None:
+            yield
+            return
+
+        async def renew():
+            while True:
+                await asyncio.sleep(interval)
+                await self.command_lock.renew()
+
+        task = asyncio.create_task(renew())
+        try:
+            yield
+        finally:
+            task.cancel()
 
     async def confirm(
         self, message=None, *, file=None, embed=None, timeout=40, delete_after=False, cls=ConfirmationView
@@ -0,0 +1,160 @@
+"""
+Binary snapshots of the game data, so clusters can load a fully linked
+``data.DataManager`` straight from disk instead of parsing the source data on
+every start and reload.
+
+Snapshots are keyed by a hash of everything in the data package, so any change
+to the data or the code that builds it means they're ignored and rebuilt. Build
+one ahead of time with ``python -m helpers.data_snapshot [path]``.
+"""
+
+import hashlib
+import os
+import pickle
+import sys
+import time
+
+import data
+
+# Bumped whenever the snapshot format changes.
+SNAPSHOT_VERSION = 1
+
+MAGIC = b"P2DATA"
+
+DEFAULT_PATH = os.path.join(os.path.dirname(__file__), "..", "gamedata.snapshot")
+
+IGNORED_DIRS = {"__pycache__", ".git"}
+
+
+def source_hash(assets_base_url=None):
+    """Hashes every file in the data package, along with everything else the
+    built DataManager depends on.
+    """
+
+    root = os.path.dirname(data.__file__)
+    h = hashlib.sha256()
+    h.update(f"{SNAPSHOT_VERSION}:{sys.version_info[:2]}:{assets_base_url}".encode())
+
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(x for x in dirnames if x not in IGNORED_DIRS)
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            h.update(os.path.relpath(path, root).encode())
+            with open(path, "rb") as f:
+                h.update(f.read())
+
+    return h.digest()
+
+
+def header(digest):
+    return MAGIC + SNAPSHOT_VERSION.to_bytes(2, "little") + digest
+
+
+def is_current(path, digest):
+    """Returns whether there's a snapshot built from the current source data."""
+
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(header(digest))) == header(digest)
+    except FileNotFoundError:
+        return False
+
+
+def dump(instance, path, digest):
+    """Writes a snapshot of a DataManager. The file is replaced atomically,
+    so clusters starting at the same time never see a partial snapshot.
+    """
+
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(header(digest))
+            pickle.dump(instance, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def load(path, digest):
+    """Returns the DataManager in a snapshot, or None if there isn't one or
+    it was built from different source data.
+    """
+
+    try:
+        with open(path, "rb") as f:
+            if f.read(len(header(digest))) != header(digest):
+                return None
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def load_or_parse(assets_base_url=None, path=DEFAULT_PATH, *, log=None):
+    """Loads the game data from a snapshot if there's an up to date one, and
+    otherwise parses it from source and writes a new snapshot. Returns the
+    DataManager and which of the two happened.
+    """
+
+    start = time.perf_counter()
+    digest = source_hash(assets_base_url)
+
+    try:
+        instance = load(path, digest)
+    except Exception:
+        if log is not None:
+            log.exception("data.snapshot_error", path=path)
+        instance = None
+
+    if instance is not None:
+        source = "snapshot"
+    else:
+        source = "parsed"
+        instance = data.DataManager(assets_base_url)
+        try:
+            dump(instance, path, digest)
+        except Exception:
+            if log is not None:
+                log.warning("data.snapshot_not_written", path=path, exc_info=True)
+
+    if log is not None:
+        log.info("data.loaded", source=source, elapsed_ms=round((time.perf_counter() - start) * 1000, 1))
+
+    return instance, source
+
+
+def build(assets_base_url=None, path=DEFAULT_PATH):
+    """Parses the source data and writes a snapshot, unless there's already an
+    up to date one. Returns whether one was written.
+    """
+
+    digest = source_hash(assets_base_url)
+    if is_current(path, digest):
+        return False
+    dump(data.DataManager(assets_base_url), path, digest)
+    return True
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_PATH
+    assets_base_url = os.getenv("ASSETS_BASE_URL")
+
+    start = time.perf_counter()
+    digest = source_hash(assets_base_url)
+    hashed = time.perf_counter()
+    instance = data.DataManager(assets_base_url)
+    parsed = time.perf_counter()
+    dump(instance, path, digest)
+    built = time.perf_counter()
+    load(path, digest)
+    loaded = time.perf_counter()
+
+    print(f"wrote {path} ({os.path.getsize(path) / 1024 / 1024:.1f} MiB)")
+    print(f"hashing source data:  {(hashed - start) * 1000:>8.1f} ms")
+    print(f"parsing source data:  {(parsed - hashed) * 1000:>8.1f} ms")
+    print(f"writing snapshot:     {(built - parsed) * 1000:>8.1f} ms")
+    print(f"loading snapshot:     {(loaded - built) * 1000:>8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
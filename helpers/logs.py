@@ -0,0 +1,141 @@
+"""
+The logging pipeline. Log calls only do what has to happen on the calling
+thread: dropping sampled out events, adding context and putting the event on a
+bounded queue. A writer thread takes events off the queue, renders them as JSON
+and writes them out, so the event loop never waits on serialization or stdout.
+
+Events can be sampled by name through ``LOG_SAMPLE_RATES``, e.g.
+``pokemon_spawned=0.1`` keeps a tenth of spawn events. Kept events carry their
+``sample_rate``. When the queue is full, events are dropped rather than
+blocking, and counted in ``poketwo_log_events_dropped_total``.
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+
+import structlog
+
+from helpers import metrics
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# How many events can wait to be written before new ones are dropped.
+LOG_QUEUE_SIZE = 10000
+
+LOG_EVENTS_DROPPED = metrics.REGISTRY.register(
+    metrics.Counter(
+        "poketwo_log_events_dropped_total",
+        "How many log events were sampled out, or dropped since the log queue was full.",
+        ("event", "reason"),
+    )
+)
+
+
+def dumps(obj, default=None):
+    if orjson is not None:
+        return orjson.dumps(obj, default=default, option=orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(obj, default=default)
+
+
+def parse_sample_rates(value):
+    """Parses sample rates in the form ``event=rate,event=rate``."""
+
+    rates = {}
+    for item in filter(None, (x.strip() for x in (value or "").split(","))):
+        event, _, rate = item.partition("=")
+        rates[event.strip()] = float(rate)
+    return rates
+
+
+class Sampler:
+    """A structlog processor that keeps only a fraction of events of each name
+    that has a sample rate.
+    """
+
+    def __init__(self, rates=None):
+        self.rates = dict(rates or {})
+
+    def __call__(self, logger, name, event_dict):
+        rate = self.rates.get(event_dict.get("event"))
+        if rate is None:
+            return event_dict
+        if rate < 1 and random.random() >= rate:
+            LOG_EVENTS_DROPPED.inc(event_dict.get("event"), "sampled")
+            raise structlog.DropEvent
+        event_dict["sample_rate"] = rate
+        return event_dict
+
+
+def add_context_fields(logger, name, event_dict):
+    """Adds the fields of a command context bound as ``_ctx``. They're only
+    worked out for events that get this far, instead of for every context.
+    """
+
+    if (ctx := event_dict.pop("_ctx", None)) is not None:
+        return {**ctx.log_fields(), **event_dict}
+    return event_dict
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Records from structlog carry the event dict, which the writer thread
+        # renders. Anything else is formatted now, since its arguments can
+        # change before then.
+        if not isinstance(record.msg, dict):
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            event = record.msg.get("event") if isinstance(record.msg, dict) else record.name
+            LOG_EVENTS_DROPPED.inc(event, "queue_full")
+
+
+class QueueListener(logging.handlers.QueueListener):
+    def stop(self):
+        # Stopped when the bot closes, and again at exit in case it never did.
+        if self._thread is None:
+            return
+        # Unlike the default, waits for room on a full queue.
+        self.queue.put(self._sentinel)
+        self._thread.join()
+        self._thread = None
+
+
+def start_writer(formatter, *, queue_size=LOG_QUEUE_SIZE):
+    """Attaches a queue handler to the root logger, and starts the thread that
+    writes out what's queued. Returns the listener, whose ``stop`` method
+    writes out anything still queued.
+    """
+
+    # Nothing renders where events were logged from, or the thread and process
+    # they were logged by, so don't look them up for every record. See
+    # https://docs.python.org/3/howto/logging.html#optimization.
+    logging._srcfile = None
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+
+    log_queue = queue.Queue(queue_size)
+    listener = QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root_logger = logging.getLogger()
+    root_logger.addHandler(QueueHandler(log_queue))
+    root_logger.setLevel(logging.INFO)
+
+    return listener
@@ -0,0 +1,167 @@
+"""
+A monitor of the event loop's health: how late it runs callbacks, what tasks
+are alive, and what it was doing whenever it stalled.
+
+The loop runs a heartbeat callback every ``HEARTBEAT_INTERVAL`` seconds, and how
+late each one runs is the loop's lag. A watchdog thread checks on the heartbeat,
+and when it's more than ``STALL_THRESHOLD`` seconds late, captures the stack of
+the loop's thread, which is whatever callback is blocking it. Neither needs
+asyncio's debug mode, so it's cheap enough to leave on, and can be started and
+stopped at any time.
+"""
+
+import asyncio
+import collections
+import sys
+import threading
+import time
+import traceback
+
+from helpers import metrics
+
+# Seconds between heartbeats.
+HEARTBEAT_INTERVAL = 0.1
+
+# How late a heartbeat has to be for the loop to count as stalled, in seconds.
+STALL_THRESHOLD = 0.25
+
+# Seconds between counts of live tasks.
+TASK_COUNT_INTERVAL = 5
+
+# How many stalls to keep the stacks of.
+RECENT_STALLS = 10
+
+LOOP_LAG = metrics.REGISTRY.register(
+    metrics.Histogram("poketwo_event_loop_lag_seconds", "How late the event loop ran heartbeat callbacks.")
+)
+LOOP_STALLS = metrics.REGISTRY.register(
+    metrics.Counter("poketwo_event_loop_stalls_total", "How many times the event loop was blocked for too long.")
+)
+LOOP_TASKS = metrics.REGISTRY.register(
+    metrics.Gauge("poketwo_event_loop_tasks", "How many tasks are alive, by coroutine.", ("coroutine",))
+)
+
+
+def task_name(task):
+    coro = task.get_coro()
+    return getattr(coro, "__qualname__", None) or type(coro).__name__
+
+
+def count_tasks(loop):
+    """Returns how many live tasks there are running each coroutine."""
+
+    return collections.Counter(task_name(x) for x in asyncio.all_tasks(loop))
+
+
+class Stall:
+    __slots__ = ("started_at", "detected_at", "duration", "stack")
+
+    def __init__(self, started_at, detected_at, stack):
+        self.started_at = started_at
+        self.detected_at = detected_at
+        self.duration = None
+        self.stack = stack
+
+    def format(self):
+        if self.duration is None:
+            heading = f"Stalled for over {(self.detected_at - self.started_at) * 1000:.0f} ms so far"
+        else:
+            heading = f"Stalled for {self.duration * 1000:.0f} ms"
+        return heading + "\n" + "".join(self.stack)
+
+
+class LoopMonitor:
+    def __init__(self, loop, log, *, stall_threshold=STALL_THRESHOLD):
+        self.loop = loop
+        self.log = log
+        self.stall_threshold = stall_threshold
+        self.stalls = collections.deque(maxlen=RECENT_STALLS)
+        self.tasks = collections.Counter()
+        self.lag = 0
+        self.max_lag = 0
+        self.stall_count = 0
+
+        self._lock = threading.Lock()
+        self._stall = None
+        self._expected = None
+        self._loop_thread_id = None
+        self._handles = []
+        self._stopped = None
+        self._watchdog = None
+
+    @property
+    def running(self):
+        return self._watchdog is not None
+
+    def start(self):
+        """Starts monitoring. Must be called from the loop's thread."""
+
+        if self.running:
+            return
+
+        self._loop_thread_id = threading.get_ident()
+        self._expected = time.perf_counter() + HEARTBEAT_INTERVAL
+        self._handles = [
+            self.loop.call_later(HEARTBEAT_INTERVAL, self._heartbeat),
+            self.loop.call_soon(self._count_tasks),
+        ]
+        self._stopped = threading.Event()
+        self._watchdog = threading.Thread(target=self._watch, name="loop-monitor", daemon=True)
+        self._watchdog.start()
+        self.log.info("loop_monitor.started", stall_threshold_ms=self.stall_threshold * 1000)
+
+    def stop(self):
+        if not self.running:
+            return
+
+        for handle in self._handles:
+            handle.cancel()
+        self._stopped.set()
+        self._watchdog = None
+        LOOP_TASKS.clear()
+        self.log.info("loop_monitor.stopped")
+
+    def _heartbeat(self):
+        now = time.perf_counter()
+        lag = max(now - self._expected, 0)
+        self.lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        LOOP_LAG.observe(lag)
+
+        with self._lock:
+            stall, self._stall = self._stall, None
+            self._expected = now + HEARTBEAT_INTERVAL
+
+        if stall is not None:
+            stall.duration = now - stall.started_at
+            self.log.warning(
+                "loop_monitor.stall",
+                duration_ms=round(stall.duration * 1000, 1),
+                stack="".join(stall.stack),
+            )
+
+        self._handles[0] = self.loop.call_later(HEARTBEAT_INTERVAL, self._heartbeat)
+
+    def _count_tasks(self):
+        self.tasks = count_tasks(self.loop)
+        LOOP_TASKS.clear()
+        for name, count in self.tasks.items():
+            LOOP_TASKS.set(count, name)
+        self._handles[1] = self.loop.call_later(TASK_COUNT_INTERVAL, self._count_tasks)
+
+    def _watch(self):
+        # Checking a few times per threshold bounds how long past it a stall
+        # goes unnoticed, without waking up too often.
+        stopped = self._stopped
+        while not stopped.wait(self.stall_threshold / 4):
+            with self._lock:
+                now = time.perf_counter()
+                if self._stall is not None or now - self._expected < self.stall_threshold:
+                    continue
+                frame = sys._current_frames().get(self._loop_thread_id)
+                stack = traceback.format_stack(frame) if frame is not None else []
+                stall = self._stall = Stall(self._expected, now, stack)
+
+            self.stall_count += 1
+            self.stalls.append(stall)
+            LOOP_STALLS.inc()
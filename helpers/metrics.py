@@ -0,0 +1,238 @@
+"""
+In-process metrics, exposed in the Prometheus text format by the Metrics cog,
+and the timing of each command along with its calls to backends (Mongo, Redis,
+HTTP and the Discord API).
+
+Calls to backends are attributed to the command being run through a context
+variable, so calls made from tasks a command starts count towards it too.
+"""
+
+import bisect
+import contextlib
+import threading
+import time
+from contextvars import ContextVar
+from types import SimpleNamespace
+
+import aiohttp
+
+# Upper bounds of the buckets of histograms of durations, in seconds.
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Upper bounds of the buckets of histograms of how many calls a command made.
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250)
+
+BACKENDS = ("mongo", "redis", "http", "discord")
+
+
+def _format_labels(labelnames, labels, **extra):
+    pairs = [*zip(labelnames, labels), *extra.items()]
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = {}
+        # Mongo calls are recorded from motor's executor threads.
+        self.lock = threading.Lock()
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.kind}"
+        with self.lock:
+            values = list(self.values.items())
+        for labels, value in values:
+            yield from self.render_value(labels, value)
+
+    def render_value(self, labels, value):
+        yield f"{self.name}{_format_labels(self.labelnames, labels)} {value}"
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets
+
+    def observe(self, value, *labels):
+        with self.lock:
+            try:
+                counts = self.values[labels]
+            except KeyError:
+                # A count per bucket, then the +Inf bucket, then the sum.
+                counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def render_value(self, labels, counts):
+        total = 0
+        for bound, count in zip((*self.buckets, "+Inf"), counts):
+            total += count
+            yield f"{self.name}_bucket{_format_labels(self.labelnames, labels, le=bound)} {total}"
+        yield f"{self.name}_sum{_format_labels(self.labelnames, labels)} {counts[-1]}"
+        yield f"{self.name}_count{_format_labels(self.labelnames, labels)} {total}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        return self.metrics.setdefault(metric.name, metric)
+
+    def render(self):
+        return "\n".join(line for metric in list(self.metrics.values()) for line in metric.render()) + "\n"
+
+
+REGISTRY = Registry()
+
+BACKEND_DURATION = REGISTRY.register(
+    Histogram(
+        "poketwo_backend_request_duration_seconds",
+        "How long calls to backends took.",
+        ("backend", "operation"),
+    )
+)
+COMMAND_DURATION = REGISTRY.register(
+    Histogram("poketwo_command_duration_seconds", "How long commands took, end to end.", ("command",))
+)
+COMMAND_BACKEND_DURATION = REGISTRY.register(
+    Histogram(
+        "poketwo_command_backend_duration_seconds",
+        "How long each command spent in calls to each backend.",
+        ("command", "backend"),
+    )
+)
+COMMAND_BACKEND_CALLS = REGISTRY.register(
+    Histogram(
+        "poketwo_command_backend_calls",
+        "How many calls to each backend each command made.",
+        ("command", "backend"),
+        buckets=COUNT_BUCKETS,
+    )
+)
+
+
+class CommandTrace:
+    """The calls to each backend made while running a command, and how long
+    they took in total.
+    """
+
+    __slots__ = ("calls", "durations")
+
+    def __init__(self):
+        self.calls = dict.fromkeys(BACKENDS, 0)
+        self.durations = dict.fromkeys(BACKENDS, 0)
+
+    def add(self, backend, duration):
+        self.calls[backend] += 1
+        self.durations[backend] += duration
+
+
+current_trace: ContextVar[CommandTrace | None] = ContextVar("current_trace", default=None)
+
+
+def record(backend, operation, duration):
+    """Records a call to a backend, and attributes it to the command being run,
+    if any.
+    """
+
+    BACKEND_DURATION.observe(duration, backend, operation)
+    if (trace := current_trace.get()) is not None:
+        trace.add(backend, duration)
+
+
+@contextlib.contextmanager
+def trace_command(command, log, slow_threshold=None):
+    """Times a command and the calls to backends it makes within the block.
+    If it took longer than ``slow_threshold`` seconds, logs where the time
+    went.
+    """
+
+    trace = CommandTrace()
+    token = current_trace.set(trace)
+    start = time.perf_counter()
+    try:
+        yield trace
+    finally:
+        duration = time.perf_counter() - start
+        current_trace.reset(token)
+
+        COMMAND_DURATION.observe(duration, command)
+        for backend in BACKENDS:
+            COMMAND_BACKEND_CALLS.observe(trace.calls[backend], command, backend)
+            if trace.calls[backend] > 0:
+                COMMAND_BACKEND_DURATION.observe(trace.durations[backend], command, backend)
+
+        if slow_threshold is not None and duration > slow_threshold:
+            # Calls may have been made concurrently, so the time not accounted
+            # for by backends is only a lower bound.
+            log.warning(
+                "command.slow",
+                duration_ms=round(duration * 1000, 1),
+                other_ms=round(max(duration - sum(trace.durations.values()), 0) * 1000, 1),
+                **{f"{x}_ms": round(trace.durations[x] * 1000, 1) for x in BACKENDS if trace.calls[x] > 0},
+                **{f"{x}_calls": trace.calls[x] for x in BACKENDS if trace.calls[x] > 0},
+            )
+
+
+def http_trace_config():
+    """Returns an aiohttp trace config that records requests made through a
+    session, by host.
+    """
+
+    async def on_request_start(session, context, params):
+        context.start = time.perf_counter()
+
+    async def on_request_end(session, context, params):
+        record("http", params.url.host, time.perf_counter() - context.start)
+
+    config = aiohttp.TraceConfig(trace_config_ctx_factory=SimpleNamespace)
+    config.on_request_start.append(on_request_start)
+    config.on_request_end.append(on_request_end)
+    config.on_request_exception.append(on_request_end)
+    return config
+
+
+def instrument_discord_http(http):
+    """Records every request a discord.py HTTP client makes, by route."""
+
+    request = http.request
+
+    async def timed_request(route, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await request(route, *args, **kwargs)
+        finally:
+            record("discord", f"{route.method} {route.path}", time.perf_counter() - start)
+
+    http.request = timed_request
@@ -0,0 +1,191 @@
+"""
+Tools for finding out where a cluster spends its time and memory while it's
+serving traffic, run through admin commands.
+
+``SamplingProfiler`` samples the stack of every thread from a thread of its own,
+so code being profiled runs unchanged, and costs roughly the same no matter how
+busy the cluster is. ``MemoryTracker`` diffs tracemalloc snapshots, doing the
+heavy lifting off the event loop.
+"""
+
+import collections
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+# Seconds between samples.
+PROFILE_INTERVAL = 0.01
+
+# Frames further down the stack than this are left out of samples.
+PROFILE_MAX_DEPTH = 128
+
+DEFAULT_PROFILE_DIR = os.path.join(tempfile.gettempdir(), "poketwo-profiles")
+
+# How many frames of the stack tracemalloc keeps for each allocation. More
+# frames make tracing slower and take more memory.
+MEMORY_TRACE_FRAMES = 5
+
+# Allocations by these aren't interesting.
+MEMORY_IGNORED = (tracemalloc.__file__, "<frozen importlib._bootstrap>", "<frozen importlib._bootstrap_external>")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def short_filename(filename):
+    if filename.startswith(ROOT):
+        return os.path.relpath(filename, ROOT)
+    for path in sorted(sys.path, key=len, reverse=True):
+        if path and filename.startswith(path + os.sep):
+            return os.path.relpath(filename, path)
+    return filename
+
+
+class SamplingProfiler:
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        # Thread name -> stack -> how many samples it was in, where stacks are
+        # tuples of (function, filename, line) from the outermost frame in.
+        self.samples = collections.defaultdict(collections.Counter)
+        self.sample_count = 0
+        self.started_at = None
+        self.stopped_at = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and not self._stopped.is_set()
+
+    @property
+    def duration(self):
+        return (self.stopped_at or time.perf_counter()) - self.started_at
+
+    def start(self):
+        self.started_at = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        self.stopped_at = time.perf_counter()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            names = {x.ident: x.name for x in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < PROFILE_MAX_DEPTH:
+                    code = frame.f_code
+                    stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+                    frame = frame.f_back
+                self.samples[names.get(ident, str(ident))][tuple(reversed(stack))] += 1
+            self.sample_count += 1
+
+    def collapsed(self):
+        """Returns the samples as collapsed stacks, one line per stack, with the
+        thread as the outermost frame. This is what flamegraph.pl and most
+        other flame graph tools take.
+        """
+
+        lines = []
+        for thread, stacks in self.samples.items():
+            for stack, count in stacks.most_common():
+                frames = ";".join(f"{x} ({short_filename(filename)}:{line})" for x, filename, line in stack)
+                lines.append(f"{thread};{frames} {count}")
+        return "\n".join(lines) + "\n"
+
+    def speedscope(self, name):
+        """Returns the samples in speedscope's file format, with a profile per
+        thread. See https://www.speedscope.app/file-format-schema.json.
+        """
+
+        # The sampling thread has to wait its turn for the GIL, so samples are
+        # further apart than asked for, more so the busier the process is.
+        interval = self.duration / self.sample_count if self.sample_count > 0 else self.interval
+        frames = {}
+        profiles = []
+
+        for thread, stacks in self.samples.items():
+            samples = []
+            weights = []
+            for stack, count in stacks.most_common():
+                samples.append([frames.setdefault(x, len(frames)) for x in stack])
+                weights.append(count * interval)
+            profiles.append(
+                {
+                    "type": "sampled",
+                    "name": thread,
+                    "unit": "seconds",
+                    "startValue": 0,
+                    "endValue": sum(weights),
+                    "samples": samples,
+                    "weights": weights,
+                }
+            )
+
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": name,
+            "exporter": "poketwo",
+            "shared": {
+                "frames": [
+                    {"name": function, "file": short_filename(filename), "line": line}
+                    for function, filename, line in frames
+                ]
+            },
+            "profiles": profiles,
+        }
+
+    def write(self, directory, name):
+        """Writes the samples as speedscope JSON and as collapsed stacks, and
+        returns the paths of both.
+        """
+
+        os.makedirs(directory, exist_ok=True)
+        speedscope_path = os.path.join(directory, f"{name}.speedscope.json")
+        collapsed_path = os.path.join(directory, f"{name}.collapsed.txt")
+
+        with open(speedscope_path, "w") as f:
+            json.dump(self.speedscope(name), f)
+        with open(collapsed_path, "w") as f:
+            f.write(self.collapsed())
+
+        return speedscope_path, collapsed_path
+
+
+class MemoryTracker:
+    def __init__(self):
+        self.previous = None
+
+    @property
+    def running(self):
+        return tracemalloc.is_tracing()
+
+    def start(self, frames=MEMORY_TRACE_FRAMES):
+        tracemalloc.start(frames)
+
+    def stop(self):
+        tracemalloc.stop()
+        self.previous = None
+
+    def snapshot(self):
+        """Takes a snapshot, and returns how much memory is traced and how
+        allocations grew since the last snapshot, largest growth first, or None
+        if this is the first. Slow, so best run in an executor.
+        """
+
+        snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, x) for x in MEMORY_IGNORED])
+        previous, self.previous = self.previous, snapshot
+
+        total, _ = tracemalloc.get_traced_memory()
+        if previous is None:
+            return total, None
+        return total, snapshot.compare_to(previous, "traceback")
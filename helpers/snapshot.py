@@ -0,0 +1,215 @@
+from collections import OrderedDict
+
+from bson.objectid import ObjectId
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# The fields kept in a snapshot, along with the dtype of each column and the
+# value used when a document doesn't have the field set.
+COLUMNS = {
+    "idx": ("int64", 0),
+    "species_id": ("int32", 0),
+    "level": ("int16", 0),
+    "iv_hp": ("int16", 0),
+    "iv_atk": ("int16", 0),
+    "iv_defn": ("int16", 0),
+    "iv_satk": ("int16", 0),
+    "iv_sdef": ("int16", 0),
+    "iv_spd": ("int16", 0),
+    "iv_total": ("int16", 0),
+    "shiny": ("bool", False),
+    "favorite": ("bool", False),
+    "has_color": ("bool", False),
+}
+
+PROJECTION = {"_id": 1, **{x: 1 for x in COLUMNS}}
+
+
+class UnsupportedPipeline(Exception):
+    """Raised when a pipeline uses a stage or field the snapshot can't evaluate."""
+
+
+class CollectionSnapshot:
+    """A columnar, read-only copy of the fields of a member's pokémon collection
+    that ``Pokemon.create_filter`` is able to filter and sort on.
+
+    Aggregation pipelines are evaluated against the columns with vectorized
+    NumPy operations, producing the matching documents' ``_id`` values in order.
+    """
+
+    __slots__ = ("version", "ids", "columns", "nbytes")
+
+    def __init__(self, version, ids, columns):
+        self.version = version
+        self.ids = ids
+        self.columns = columns
+        self.nbytes = ids.nbytes + sum(x.nbytes for x in columns.values())
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_documents(cls, version, documents):
+        ids = np.array([x["_id"].binary for x in documents], dtype="S12")
+        columns = {
+            field: np.array([x.get(field) or default for x in documents], dtype=dtype)
+            for field, (dtype, default) in COLUMNS.items()
+        }
+
+        # iv_total is missing on some very old documents.
+        missing = columns["iv_total"] == 0
+        if missing.any():
+            computed = sum(columns[x].astype("int16") for x in COLUMNS if x.startswith("iv_") and x != "iv_total")
+            columns["iv_total"][missing] = computed[missing]
+
+        return cls(version, ids, columns)
+
+    def object_ids(self, rows):
+        return [ObjectId(x) for x in self.ids[rows].tolist()]
+
+    # Evaluation
+
+    def _column(self, field):
+        if field == "_id":
+            return self.ids
+        try:
+            return self.columns[field]
+        except KeyError:
+            raise UnsupportedPipeline(field)
+
+    def _value(self, field, value):
+        if field != "_id":
+            return value
+        if isinstance(value, ObjectId):
+            return value.binary
+        if isinstance(value, (list, tuple, set)):
+            return [x.binary for x in value if isinstance(x, ObjectId)]
+        return value
+
+    def _condition(self, field, condition):
+        column = self._column(field)
+
+        if not isinstance(condition, dict):
+            return column == self._value(field, condition)
+
+        mask = np.ones(len(column), dtype=bool)
+        for op, value in condition.items():
+            if op == "$not":
+                mask &= ~self._condition(field, value)
+                continue
+
+            value = self._value(field, value)
+            if op == "$eq":
+                mask &= column == value
+            elif op == "$ne":
+                mask &= column != value
+            elif op == "$lt":
+                mask &= column < value
+            elif op == "$lte":
+                mask &= column <= value
+            elif op == "$gt":
+                mask &= column > value
+            elif op == "$gte":
+                mask &= column >= value
+            elif op == "$in":
+                mask &= np.isin(column, value)
+            elif op == "$nin":
+                mask &= ~np.isin(column, value)
+            else:
+                raise UnsupportedPipeline(op)
+
+        return mask
+
+    def _match(self, query):
+        mask = np.ones(len(self), dtype=bool)
+        for key, value in query.items():
+            if key == "$or":
+                mask &= np.logical_or.reduce([self._match(x) for x in value])
+            elif key == "$and":
+                mask &= np.logical_and.reduce([self._match(x) for x in value])
+            elif key.startswith("$"):
+                raise UnsupportedPipeline(key)
+            else:
+                mask &= self._condition(key, value)
+        return mask
+
+    def _sort(self, rows, spec):
+        # np.lexsort sorts by the last key first, and is stable, so ties keep
+        # their natural order like they would in Mongo.
+        keys = []
+        for field, direction in reversed(spec.items()):
+            column = self._column(field)[rows]
+            if field == "_id":
+                column = np.argsort(np.argsort(column, kind="stable"), kind="stable")
+            column = column.astype("int64")
+            keys.append(column if direction == 1 else -column)
+        return rows[np.lexsort(keys)]
+
+    def evaluate(self, pipeline):
+        """Returns the row numbers matched by an aggregation pipeline, in the
+        order it would return them. Raises ``UnsupportedPipeline`` for
+        anything that can't be evaluated against the snapshot.
+        """
+
+        rows = np.arange(len(self))
+
+        for stage in pipeline:
+            if len(stage) != 1:
+                raise UnsupportedPipeline(stage)
+            ((op, value),) = stage.items()
+
+            if op == "$match":
+                rows = rows[self._match(value)[rows]]
+            elif op == "$sort":
+                rows = self._sort(rows, value)
+            elif op == "$skip":
+                rows = rows[value:]
+            elif op == "$limit":
+                rows = rows[:value]
+            else:
+                raise UnsupportedPipeline(op)
+
+        return rows
+
+
+class SnapshotCache:
+    """Keeps collection snapshots for many members within a memory budget,
+    evicting the least recently used ones first.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.nbytes = 0
+        self.snapshots = OrderedDict()
+
+    def __len__(self):
+        return len(self.snapshots)
+
+    def get(self, user_id, version):
+        snapshot = self.snapshots.get(user_id)
+        if snapshot is None:
+            return None
+        if snapshot.version != version:
+            self.remove(user_id)
+            return None
+        self.snapshots.move_to_end(user_id)
+        return snapshot
+
+    def put(self, user_id, snapshot):
+        self.remove(user_id)
+        if snapshot.nbytes > self.budget:
+            return
+
+        while self.nbytes + snapshot.nbytes > self.budget:
+            _, evicted = self.snapshots.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+
+        self.snapshots[user_id] = snapshot
+        self.nbytes += snapshot.nbytes
+
+    def remove(self, user_id):
+        if (snapshot := self.snapshots.pop(user_id, None)) is not None:
+            self.nbytes -= snapshot.nbytes
@@ -0,0 +1,101 @@
+"""
+The worker side of the cluster supervisor in launcher.py. A worker talks to
+the supervisor over a socket it inherits, exchanging one JSON object per line:
+it reports its stats every few seconds, and asks for permission before each
+shard IDENTIFYs, so that clusters on the same host stagger their IDENTIFYs.
+"""
+
+import asyncio
+import json
+import math
+import socket
+import time
+
+# Seconds between stats reports to the supervisor.
+REPORT_INTERVAL = 5
+
+# Seconds between measurements of the event loop's lag.
+LAG_SAMPLE_INTERVAL = 0.5
+
+
+class SupervisorClient:
+    def __init__(self, bot, fd):
+        self.bot = bot
+        self.fd = fd
+        self.reader = None
+        self.writer = None
+        self.identify_waiters = {}
+        self.connected = False
+        self.loop_lag = 0
+        self._tasks = []
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_unix_connection(sock=socket.socket(fileno=self.fd))
+        self.connected = True
+        self._tasks = [
+            asyncio.create_task(self.read()),
+            asyncio.create_task(self.report()),
+            asyncio.create_task(self.sample_loop_lag()),
+        ]
+
+    async def send(self, message):
+        self.writer.write(json.dumps(message).encode() + b"\n")
+        await self.writer.drain()
+
+    async def read(self):
+        try:
+            while line := await self.reader.readline():
+                message = json.loads(line)
+                if message["type"] == "identify":
+                    if (future := self.identify_waiters.pop(message["shard_id"], None)) is not None:
+                        future.set_result(None)
+        finally:
+            # The supervisor is gone, so nothing will let waiting shards
+            # IDENTIFY, and there's nobody to report to.
+            self.connected = False
+            for future in self.identify_waiters.values():
+                if not future.done():
+                    future.set_exception(ConnectionResetError("lost the connection to the supervisor"))
+            self.identify_waiters.clear()
+            for task in self._tasks:
+                if task is not asyncio.current_task():
+                    task.cancel()
+
+    async def acquire_identify(self, shard_id):
+        """Waits until the supervisor allows a shard to IDENTIFY. Raises
+        ``ConnectionError`` if the connection to the supervisor is lost.
+        """
+
+        if not self.connected:
+            raise ConnectionResetError("lost the connection to the supervisor")
+        future = self.identify_waiters[shard_id] = asyncio.get_running_loop().create_future()
+        await self.send({"type": "identify", "shard_id": shard_id})
+        await future
+
+    async def sample_loop_lag(self):
+        # How much later than asked for a sleep wakes up is how long the event
+        # loop was busy with something else. Reports carry the worst since the
+        # last report.
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(LAG_SAMPLE_INTERVAL)
+            self.loop_lag = max(self.loop_lag, time.perf_counter() - start - LAG_SAMPLE_INTERVAL)
+
+    async def report(self):
+        while True:
+            await asyncio.sleep(REPORT_INTERVAL)
+            await self.send(
+                {
+                    "type": "stats",
+                    "loop_lag_ms": round(self.loop_lag * 1000, 1),
+                    "shard_latency_ms": {x: round(y * 1000, 1) for x, y in self.bot.latencies if not math.isnan(y)},
+                    "guilds": len(self.bot.guilds),
+                }
+            )
+            self.loop_lag = 0
+
+    def close(self):
+        for task in self._tasks:
+            task.cancel()
+        if self.writer is not None:
+            self.writer.close()
@@ -1,6 +1,14 @@
 suspended-users = Suspended {$users}.
 temporarily-suspended-users = Suspended {$users} for {$duration}.
 unsuspended-users = Unsuspended {$users}.
+reconcilepokedex-completed = {$count ->
+  [one] Reconciled pokédex counts for {$count} user.
+  *[other] Reconciled pokédex counts for {$count} users.
+}
+reconcilemarket-completed = {$count ->
+  [one] Rebuilt the market index with {$count} listing.
+  *[other] Rebuilt the market index with {$count} listings.
+}
 addredeem-completed = {$redeems ->
   [one] Gave **{$user}** {$redeems} redeem.
   *[other] Gave **{$user}** {$redeems} redeems.
@@ -21,3 +29,31 @@ addbox-completed = {$boxes ->
 }
 give-completed = Gave **{$user}** a {$pokemon}.
 setup-completed = Gave **{$user}** {$number} {-pokemon}.
+loopmonitor-started = Started monitoring the event loop.
+loopmonitor-stopped = Stopped monitoring the event loop.
+loopmonitor-not-running = The event loop monitor isn't running.
+loopmonitor-status =
+  {"*"}*Lag:** {$lag} ms, at most {$maxLag} ms
+  {"*"}*Stalls over {$threshold} ms:** {$stalls}
+  {"*"}*Live tasks:** {$tasks}
+  ```
+  {$topTasks}
+  ```
+profile-already-running = There's already a profiler running on this cluster.
+profile-started = Profiling cluster **{$cluster}** for {$seconds} seconds...
+profile-not-running = There's no profiler running on this cluster.
+profile-completed = Took {$samples} samples over {$seconds} seconds. Saved to `{$path}`.
+memory-not-running = Memory allocations aren't being traced on this cluster.
+memory-started = Started tracing memory allocations, keeping {$frames} frames of each.
+memory-stopped = Stopped tracing memory allocations.
+memory-snapshot-first = Took a first snapshot, with {$size} traced. Take another to see what grew.
+memory-snapshot =
+  {"*"}*Traced:** {$size} ({$diff} since the last snapshot)
+  ```
+  {$top}
+  ```
+  ```
+  {$structures}
+  ```
+logsample-set = Logging {NUMBER($rate, style: "percent")} of `{$event}` events on this cluster.
+logsample-cleared = Logging every `{$event}` event on this cluster.
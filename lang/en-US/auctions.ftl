@@ -72,6 +72,7 @@ lowerstart-completed =
 ## Command: auction bid
 cannot-self-bid = You can't bid on your own auction.
 already-highest-bidder = You are already the highest bidder.
+auction-bid-busy = This auction is receiving a lot of bids right now. Please try again.
 bid-minimum =
   {$minimum ->
     [one] Your bid must be at least {NUMBER($minimum)} Pokécoin.
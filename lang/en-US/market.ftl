@@ -6,6 +6,23 @@ listing-no-longer-exists = That listing no longer exists.
 marketplace-title = Pokétwo Marketplace
 no-listings-found = No listings found.
 
+## Command: market stats
+no-market-stats = No **{$pokemon}** has been sold on the market recently.
+market-stats-embed =
+  .title = {$pokemon} – Market Prices
+  .field-prices-name = Prices
+  .field-prices-value =
+    {"*"}*Median:** {$median} pc
+    {"*"}*Typical range:** {$low} – {$high} pc
+  .field-volume-name = Sales
+  .field-volume-value =
+    {"*"}*Today:** {$today}
+    {"*"}*Last 7 days:** {$week}
+    {"*"}*Last 30 days:** {$month}
+  .field-recent-name = Most Recent Sales
+  .field-recent-value = {$recent}
+  .footer-text = Based on the last {$count} sales.
+
 ## Command: market add
 price-must-be-positive = The price must be positive!
 price-too-high = Price is too high!
@@ -14,6 +14,7 @@ attempting-to-cancel-trade = Attempting to cancel trade...
 trade-has-been-canceled = The trade has been canceled.
 trade-needs-redeems = The trade could not be executed as one user does not have enough redeems.
 trade-needs-pokecoins = The trade could not be executed as one user does not have enough Pokécoins.
+trade-pokemon-unavailable = The trade could not be executed as one of the {-pokemon} is no longer available.
 trade-between = Trade between {$a} and {$b}
 trade-completed = ✅ Completed trade between {$a} and {$b}.
 executing-trade = Executing trade...
@@ -1,14 +1,22 @@
+import asyncio
+import json
 import os
 import re
+import signal
+import socket
+import sys
+import time
 from collections import namedtuple
 from urllib.parse import quote_plus
 
 import discord
 import discord.gateway
 import discord.http
+import structlog
 import yarl
 
 import bot
+from helpers import data_snapshot, logs
 
 Config = namedtuple(
     "Config",
@@ -23,9 +31,36 @@ Config = namedtuple(
         "EXT_SERVER_URL",
         "ASSETS_BASE_URL",
         "LANG_ROOT",
+        "LANG_MEMORY_BUDGET",
+        "DATA_SNAPSHOT_PATH",
+        "COLLECTION_SNAPSHOT_MIN_SIZE",
+        "COLLECTION_SNAPSHOT_BUDGET",
+        "AUCTION_BID_QUEUE",
+        "METRICS_HOST",
+        "METRICS_PORT",
+        "SLOW_COMMAND_THRESHOLD",
+        "LOOP_MONITOR",
+        "LOOP_STALL_THRESHOLD",
+        "PROFILE_DIR",
+        "LOG_SAMPLE_RATES",
+        "AUDIT_LOG_SPILL_DIR",
     ],
 )
 
+# How long shards in the same bucket have to wait between IDENTIFYs.
+IDENTIFY_INTERVAL = 5
+
+# How long to wait before restarting a worker that crashed, doubling for each
+# crash in a row, up to the maximum.
+RESTART_BACKOFF = 5
+RESTART_BACKOFF_MAX = 300
+
+# Workers that stay up this long have their crashes in a row reset.
+RESTART_STABLE_AFTER = 600
+
+# Workers that don't stop within this long after being asked to are killed.
+STOP_TIMEOUT = 30
+
 
 def patch_with_gateway(env_gateway):
     class ProductionHTTPClient(discord.http.HTTPClient):
@@ -66,7 +101,199 @@ def patch_with_gateway(env_gateway):
     bot.ClusterBot = ProductionBot
 
 
-if __name__ == "__main__":
+class Worker:
+    """A cluster run by the supervisor, and what it last reported."""
+
+    def __init__(self, cluster_idx, cpus):
+        self.cluster_idx = cluster_idx
+        self.cpus = cpus
+        self.process = None
+        self.writer = None
+        self.started_at = None
+        self.restarts = 0
+        self.restarting = False
+        self.crashes = 0
+        self.stats = {}
+        self.reported_at = None
+
+    @property
+    def rss(self):
+        try:
+            with open(f"/proc/{self.process.pid}/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (AttributeError, OSError):
+            return None
+
+    def to_dict(self):
+        now = time.time()
+        return {
+            "cluster_idx": self.cluster_idx,
+            "pid": self.process and self.process.pid,
+            "running": self.process is not None and self.process.returncode is None,
+            "cpus": sorted(self.cpus) if self.cpus else None,
+            "uptime_s": self.started_at and round(now - self.started_at),
+            "restarts": self.restarts,
+            "rss": self.rss,
+            "reported_s_ago": self.reported_at and round(now - self.reported_at, 1),
+            **self.stats,
+        }
+
+
+class Supervisor:
+    """Runs several clusters on one host, one worker process each, running
+    launcher.py as a single cluster. Workers are pinned to CPUs, restarted
+    with backoff when they crash, and take turns to IDENTIFY their shards.
+
+    The game data snapshot is built once up front, so that workers load it
+    from the same file in the page cache rather than each parsing the game
+    data. Stats on every worker can be read from a Unix socket: send a line
+    with ``stats`` for them as JSON, or ``restart <cluster idx>`` to restart a
+    worker.
+    """
+
+    def __init__(self, cluster_idxs, socket_path, max_concurrency, config):
+        self.log = structlog.get_logger()
+        self.config = config
+        self.socket_path = socket_path
+        self.max_concurrency = max_concurrency
+
+        # Each worker gets a CPU to itself, if there are enough to go around.
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else []
+        if len(cpus) < len(cluster_idxs):
+            cpus = None
+        self.workers = {idx: Worker(idx, cpus and {cpus[i]}) for i, idx in enumerate(cluster_idxs)}
+
+        self.next_identify = {}
+        self.stopping = False
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        stopped = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stopped.set)
+
+        start = time.perf_counter()
+        path = self.config.DATA_SNAPSHOT_PATH or data_snapshot.DEFAULT_PATH
+        built = await loop.run_in_executor(None, data_snapshot.build, self.config.ASSETS_BASE_URL, path)
+        self.log.info("supervisor.game_data", built=built, elapsed_s=round(time.perf_counter() - start, 2))
+
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        # Anyone who can connect can restart workers, so only this user can,
+        # from the moment the socket exists.
+        umask = os.umask(0o177)
+        try:
+            server = await asyncio.start_unix_server(self.handle_control, path=self.socket_path)
+        finally:
+            os.umask(umask)
+
+        tasks = [asyncio.create_task(self.supervise(x)) for x in self.workers.values()]
+        await stopped.wait()
+
+        self.log.info("supervisor.stopping")
+        self.stopping = True
+        server.close()
+        await asyncio.gather(*(self.stop(x) for x in self.workers.values()))
+        for task in tasks:
+            task.cancel()
+        os.remove(self.socket_path)
+
+    async def supervise(self, worker):
+        while not self.stopping:
+            await self.spawn(worker)
+            code = await worker.process.wait()
+            if self.stopping:
+                return
+
+            worker.restarts += 1
+            if worker.restarting:
+                worker.restarting = False
+                continue
+
+            if time.time() - worker.started_at > RESTART_STABLE_AFTER:
+                worker.crashes = 0
+            delay = min(RESTART_BACKOFF * 2**worker.crashes, RESTART_BACKOFF_MAX)
+            worker.crashes += 1
+
+            self.log.warning("supervisor.worker_exited", cluster_idx=worker.cluster_idx, code=code, restart_in=delay)
+            await asyncio.sleep(delay)
+
+    async def spawn(self, worker):
+        parent, child = socket.socketpair()
+        env = {**os.environ, "CLUSTER_IDX": str(worker.cluster_idx), "SUPERVISOR_FD": str(child.fileno())}
+        env.pop("CLUSTER_NAME", None)
+        env.pop("NUM_WORKERS", None)
+
+        worker.process = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), env=env, pass_fds=(child.fileno(),)
+        )
+        child.close()
+        worker.started_at = time.time()
+        worker.stats = {}
+        worker.reported_at = None
+
+        if worker.cpus:
+            os.sched_setaffinity(worker.process.pid, worker.cpus)
+
+        reader, worker.writer = await asyncio.open_unix_connection(sock=parent)
+        asyncio.create_task(self.handle_worker(worker, reader, worker.writer))
+        self.log.info("supervisor.worker_started", cluster_idx=worker.cluster_idx, pid=worker.process.pid)
+
+    async def stop(self, worker):
+        if worker.process is None or worker.process.returncode is not None:
+            return
+        worker.process.terminate()
+        try:
+            await asyncio.wait_for(worker.process.wait(), STOP_TIMEOUT)
+        except asyncio.TimeoutError:
+            worker.process.kill()
+            await worker.process.wait()
+
+    async def handle_worker(self, worker, reader, writer):
+        while line := await reader.readline():
+            message = json.loads(line)
+            if message["type"] == "stats":
+                message.pop("type")
+                worker.stats = message
+                worker.reported_at = time.time()
+            elif message["type"] == "identify":
+                asyncio.create_task(self.grant_identify(writer, message["shard_id"]))
+        writer.close()
+
+    async def grant_identify(self, writer, shard_id):
+        # Shards in the same bucket can only IDENTIFY one at a time, at most
+        # once every IDENTIFY_INTERVAL seconds.
+        bucket = shard_id % self.max_concurrency
+        now = time.monotonic()
+        at = max(now, self.next_identify.get(bucket, 0))
+        self.next_identify[bucket] = at + IDENTIFY_INTERVAL
+
+        await asyncio.sleep(at - now)
+        if not writer.is_closing():
+            writer.write(json.dumps({"type": "identify", "shard_id": shard_id}).encode() + b"\n")
+
+    async def handle_control(self, reader, writer):
+        try:
+            while line := await reader.readline():
+                command, *args = line.decode().split()
+                if command == "stats":
+                    response = {"workers": [x.to_dict() for x in self.workers.values()]}
+                elif command == "restart" and len(args) == 1 and int(args[0]) in self.workers:
+                    worker = self.workers[int(args[0])]
+                    worker.restarting = True
+                    await self.stop(worker)
+                    response = {"ok": True}
+                else:
+                    response = {"error": f"unknown command {line.decode().strip()!r}"}
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        except (ValueError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+def make_config():
     uri = os.getenv("DATABASE_URI")
 
     if uri is None:
@@ -76,13 +303,7 @@ if __name__ == "__main__":
             os.environ["DATABASE_HOST"],
         )
 
-    if os.getenv("API_BASE") is not None:
-        discord.http.Route.BASE = os.getenv("API_BASE")
-
-    if os.getenv("API_GATEWAY") is not None:
-        patch_with_gateway(os.getenv("API_GATEWAY"))
-
-    config = Config(
+    return Config(
         DEBUG=os.getenv("DEBUG") in ("1", "True", "true"),
         DATABASE_URI=uri,
         DATABASE_NAME=os.environ["DATABASE_NAME"],
@@ -96,13 +317,49 @@ if __name__ == "__main__":
         EXT_SERVER_URL=os.getenv("EXT_SERVER_URL", os.environ["SERVER_URL"]),
         ASSETS_BASE_URL=os.getenv("ASSETS_BASE_URL"),
         LANG_ROOT=os.getenv("LANG_ROOT"),
+        LANG_MEMORY_BUDGET=int(os.getenv("LANG_MEMORY_BUDGET", 64 * 1024 * 1024)),
+        DATA_SNAPSHOT_PATH=os.getenv("DATA_SNAPSHOT_PATH"),
+        COLLECTION_SNAPSHOT_MIN_SIZE=int(os.getenv("COLLECTION_SNAPSHOT_MIN_SIZE", 0)) or None,
+        COLLECTION_SNAPSHOT_BUDGET=int(os.getenv("COLLECTION_SNAPSHOT_BUDGET", 256 * 1024 * 1024)),
+        AUCTION_BID_QUEUE=os.getenv("AUCTION_BID_QUEUE") in ("1", "True", "true"),
+        METRICS_HOST=os.getenv("METRICS_HOST"),
+        METRICS_PORT=int(os.getenv("METRICS_PORT", 0)) or None,
+        SLOW_COMMAND_THRESHOLD=float(os.getenv("SLOW_COMMAND_THRESHOLD", 2.5)) or None,
+        LOOP_MONITOR=os.getenv("LOOP_MONITOR") in ("1", "True", "true"),
+        LOOP_STALL_THRESHOLD=float(os.getenv("LOOP_STALL_THRESHOLD", 0)) or None,
+        PROFILE_DIR=os.getenv("PROFILE_DIR"),
+        LOG_SAMPLE_RATES=logs.parse_sample_rates(os.getenv("LOG_SAMPLE_RATES")),
+        AUDIT_LOG_SPILL_DIR=os.getenv("AUDIT_LOG_SPILL_DIR"),
     )
 
+
+def main():
+    if os.getenv("API_BASE") is not None:
+        discord.http.Route.BASE = os.getenv("API_BASE")
+
+    if os.getenv("API_GATEWAY") is not None:
+        patch_with_gateway(os.getenv("API_GATEWAY"))
+
+    config = make_config()
+
     num_shards = int(os.getenv("NUM_SHARDS", 1))
     num_clusters = int(os.getenv("NUM_CLUSTERS", 1))
     cluster_name = os.getenv("CLUSTER_NAME", str(os.getenv("CLUSTER_IDX", 0)))
     cluster_idx = int(re.search(r"\d+", cluster_name).group(0))
 
+    # Supervisor mode runs NUM_WORKERS clusters on this host, starting from
+    # CLUSTER_IDX.
+    num_workers = int(os.getenv("NUM_WORKERS", 0))
+    if num_workers > 0:
+        supervisor = Supervisor(
+            range(cluster_idx, cluster_idx + num_workers),
+            os.getenv("SUPERVISOR_SOCKET", "/tmp/poketwo-supervisor.sock"),
+            int(os.getenv("MAX_CONCURRENCY", 1)),
+            config,
+        )
+        asyncio.run(supervisor.run())
+        return
+
     shard_ids = list(range(cluster_idx, num_shards, num_clusters))
 
     intents = discord.Intents.default()
@@ -118,4 +375,9 @@ if __name__ == "__main__":
         allowed_mentions=discord.AllowedMentions(everyone=False, roles=False),
         intents=intents,
         config=config,
+        supervisor_fd=int(os.environ["SUPERVISOR_FD"]) if "SUPERVISOR_FD" in os.environ else None,
     )
+
+
+if __name__ == "__main__":
+    main()
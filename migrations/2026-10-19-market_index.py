@@ -0,0 +1,42 @@
+"""
+This is a one-shot script used to create the market_index collection and its
+indices, and fill it with the current listings. Afterwards it is kept up to
+date by the market commands, and can be rebuilt with the reconcilemarket
+admin command.
+19 October 2026
+"""
+
+import config
+from pymongo import ASCENDING, DESCENDING, MongoClient
+
+IV_FIELDS = ["iv_hp", "iv_atk", "iv_defn", "iv_satk", "iv_sdef", "iv_spd"]
+FIELDS = ["owner_id", "species_id", "level", "shiny", "has_color", *IV_FIELDS]
+DEFAULTS = {"shiny": False, "has_color": False}
+
+client = MongoClient(config.DATABASE_URI)
+db = client[config.DATABASE_NAME]
+
+# Searches are usually filtered by species, then sorted by one of these.
+for field in ("price", "iv_total", "level", "_id"):
+    db.market_index.create_index([(field, DESCENDING)])
+    db.market_index.create_index([("species_id", ASCENDING), (field, DESCENDING)])
+
+db.market_index.create_index([("owner_id", ASCENDING), ("_id", DESCENDING)])
+db.market_index.create_index([("pokemon_id", ASCENDING)])
+
+db.pokemon.aggregate(
+    [
+        {"$match": {"owned_by": "market"}},
+        {
+            "$project": {
+                "_id": "$market_data._id",
+                "pokemon_id": "$_id",
+                "price": "$market_data.price",
+                **{x: {"$ifNull": [f"${x}", DEFAULTS.get(x)]} for x in FIELDS},
+                "iv_total": {"$ifNull": ["$iv_total", {"$sum": [f"${x}" for x in IV_FIELDS]}]},
+            }
+        },
+        {"$merge": {"into": "market_index", "on": "_id", "whenMatched": "replace"}},
+    ],
+    allowDiskUse=True,
+)